@@ -0,0 +1,24 @@
+-- Variant of AnalyticsStreamJob.sql for batched uplink (app.py --batch-bytes).
+-- Every message carries {"DeviceID", "rasptimestamp", "readings": [...]}; CROSS APPLY flattens the array
+-- so each reading lands as its own row in "IoT-database-bme280", same columns as the per-reading job.
+WITH src AS (
+  SELECT
+    CAST(e.DeviceID AS NVARCHAR(MAX))              AS deviceId,
+    CAST(r.ArrayValue.temperature AS float)        AS temperature,
+    CAST(r.ArrayValue.humidity AS float)           AS humidity,
+    CAST(r.ArrayValue.pressure AS float)           AS pressure,
+    CAST(r.ArrayValue.device_ts AS bigint)         AS device_ts,
+    CAST(e.rasptimestamp AS bigint)                AS rasptimestamp
+  FROM "IoThub-aardbei" e
+  CROSS APPLY GetArrayElements(e.readings) AS r
+)
+SELECT
+  deviceId,
+  temperature,
+  humidity,
+  pressure,
+  device_ts,
+  rasptimestamp,
+  System.Timestamp AS stored_ts
+INTO "IoT-database-bme280"
+FROM src;
@@ -0,0 +1,196 @@
+# backlog.py -- store-and-forward buffer for readings that are not published yet
+"""
+Readings are packed as 16 byte records (uint32 device_ts, float32 temp_c, hum_pct, pres_hpa)
+into a bytearray allocated once and used as a ring, so buffering a reading allocates nothing.
+float32 is what MicroPython uses for floats on the ESP32, so nothing is lost by packing. With
+record_size=RAW_RECORD_SIZE the records are raw sensor readouts instead (see push_raw).
+
+When the RAM ring is full its oldest half is moved to an optional spill file on flash, itself a
+fixed-size ring that drops its oldest records once full. The spill file keeps its position in
+a header, so what it holds survives a reset; `dump` and `load` carry the RAM records through a
+deep sleep. Replay hands out batches oldest first: the spill file, then RAM.
+"""
+import struct
+
+RECORD_FMT = "<Ifff"
+RECORD_SIZE = 16
+RAW_RECORD_SIZE = 12  # uint32 device_ts, 8 byte BME280 readout of registers 0xF7..0xFE
+
+SPILL_MAGIC = b"BMEB"
+SPILL_HEADER_FMT = "<4sIIII"  # magic, record size, capacity, start, count
+SPILL_HEADER_SIZE = 20
+
+
+class SpillFile:
+    """Fixed-size ring of records in a flash file, only written while the RAM ring overflows"""
+
+    def __init__(self, path, capacity, record_size=RECORD_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.record_size = record_size
+        self.start = 0
+        self.count = 0
+        self.f = None
+        try:
+            f = open(path, "r+b")
+        except OSError:
+            f = None
+        if f is not None:
+            header = f.read(SPILL_HEADER_SIZE)
+            if len(header) == SPILL_HEADER_SIZE:
+                magic, record_size, capacity, start, count = struct.unpack(SPILL_HEADER_FMT, header)
+                if (magic == SPILL_MAGIC and record_size == self.record_size and capacity == self.capacity
+                        and start < capacity and count <= capacity):
+                    self.f, self.start, self.count = f, start, count
+            if self.f is None:
+                f.close()
+        if self.f is None:
+            # missing, damaged, another capacity or record size: start over
+            self.f = open(path, "w+b")
+            self._write_header()
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(struct.pack(SPILL_HEADER_FMT, SPILL_MAGIC, self.record_size, self.capacity, self.start, self.count))
+        self.f.flush()
+
+    def append(self, chunk):
+        """
+        Append the records in `chunk` (a memoryview), dropping the oldest ones if the file is full.
+        Returns the number of records dropped.
+        """
+        n = len(chunk) // self.record_size
+        dropped = 0
+        if n > self.capacity:
+            dropped += n - self.capacity
+            chunk = chunk[(n - self.capacity) * self.record_size:]
+            n = self.capacity
+        over = self.count + n - self.capacity
+        if over > 0:
+            dropped += over
+            self.start = (self.start + over) % self.capacity
+            self.count -= over
+        # the write position never lies past the end of the file, it only grows by appending
+        pos = (self.start + self.count) % self.capacity
+        first = min(n, self.capacity - pos)
+        self.f.seek(SPILL_HEADER_SIZE + pos * self.record_size)
+        self.f.write(chunk[:first * self.record_size])
+        if first < n:
+            self.f.seek(SPILL_HEADER_SIZE)
+            self.f.write(chunk[first * self.record_size:])
+        self.count += n
+        self._write_header()
+        return dropped
+
+    def read(self, into):
+        """Read the oldest contiguous records into the memoryview `into`, returns the filled part"""
+        k = min(self.count, self.capacity - self.start, len(into) // self.record_size)
+        self.f.seek(SPILL_HEADER_SIZE + self.start * self.record_size)
+        self.f.readinto(into[:k * self.record_size])
+        return into[:k * self.record_size]
+
+    def drop(self, n):
+        self.count -= n
+        self.start = 0 if self.count == 0 else (self.start + n) % self.capacity
+        self._write_header()
+
+
+class Backlog:
+    """
+    RAM ring of `capacity` records, spilling to `spill_path` (up to `spill_capacity` records)
+    when given. `peek` returns up to `batch` of the oldest records and `drop` removes them once
+    they are published; nothing may be pushed in between, a push can move or overwrite them.
+    """
+
+    def __init__(self, capacity, batch=16, spill_path=None, spill_capacity=0, record_size=RECORD_SIZE):
+        self.capacity = capacity
+        self.record_size = record_size
+        self.buf = bytearray(capacity * self.record_size)
+        self.mv = memoryview(self.buf)
+        self.batch = memoryview(bytearray(batch * self.record_size))
+        self.start = 0
+        self.count = 0
+        self.dropped = 0  # readings lost because RAM and flash were both full
+        self.spill = None
+        if spill_path and spill_capacity:
+            try:
+                self.spill = SpillFile(spill_path, spill_capacity, record_size)
+            except OSError as e:
+                print("Spill file unavailable:", e)
+
+    def __len__(self):
+        return self.count + (self.spill.count if self.spill else 0)
+
+    def push(self, device_ts, temp_c, hum_pct, pres_hpa):
+        if self.count == self.capacity:
+            self._evict(max(1, self.capacity // 2))
+        i = (self.start + self.count) % self.capacity
+        struct.pack_into(RECORD_FMT, self.buf, i * self.record_size, device_ts, temp_c, hum_pct, pres_hpa)
+        self.count += 1
+
+    def push_raw(self, device_ts, readout):
+        """Buffer a raw reading: `readout` is the sensor's 8 byte burst readout (copied)"""
+        if self.count == self.capacity:
+            self._evict(max(1, self.capacity // 2))
+        off = ((self.start + self.count) % self.capacity) * self.record_size
+        struct.pack_into("<I", self.buf, off, device_ts)
+        self.buf[off + 4:off + self.record_size] = readout
+        self.count += 1
+
+    def _evict(self, n):
+        """Move the `n` oldest RAM records to the spill file (or drop them without one)"""
+        if self.spill:
+            first = min(n, self.capacity - self.start)
+            try:
+                self.dropped += self.spill.append(self.mv[self.start * self.record_size:(self.start + first) * self.record_size])
+                if first < n:
+                    self.dropped += self.spill.append(self.mv[:(n - first) * self.record_size])
+            except OSError as e:
+                print("Spill write failed:", e)
+                self.dropped += n
+        else:
+            self.dropped += n
+        self.start = (self.start + n) % self.capacity
+        self.count -= n
+
+    def peek(self):
+        """Up to `batch` of the oldest records as a memoryview, empty if there are none"""
+        if self.spill and self.spill.count:
+            return self.spill.read(self.batch)
+        k = min(self.count, self.capacity - self.start, len(self.batch) // self.record_size)
+        return self.mv[self.start * self.record_size:(self.start + k) * self.record_size]
+
+    def drop(self, n):
+        """Remove the `n` records handed out by the last `peek`"""
+        if self.spill and self.spill.count:
+            self.spill.drop(n)
+        else:
+            self.count -= n
+            self.start = 0 if self.count == 0 else (self.start + n) % self.capacity
+
+    def dump(self, limit):
+        """
+        The RAM records, oldest first, as bytes for RTC memory before a deep sleep. All but the
+        newest `limit` are moved to the spill file first.
+        """
+        if self.count > limit:
+            self._evict(self.count - limit)
+        first = min(self.count, self.capacity - self.start)
+        head = self.mv[self.start * self.record_size:(self.start + first) * self.record_size]
+        return bytes(head) + bytes(self.mv[:(self.count - first) * self.record_size])
+
+    def load(self, data):
+        """Push the records of a `dump` back into the RAM ring after waking up"""
+        data = memoryview(data)
+        for off in range(0, len(data) - self.record_size + 1, self.record_size):
+            if self.count == self.capacity:
+                self._evict(max(1, self.capacity // 2))
+            i = (self.start + self.count) % self.capacity
+            self.buf[i * self.record_size:(i + 1) * self.record_size] = data[off:off + self.record_size]
+            self.count += 1
+
+
+def records(view):
+    """Yield (device_ts, temp_c, hum_pct, pres_hpa) for every (compensated) record in `view`"""
+    for off in range(0, len(view), RECORD_SIZE):
+        yield struct.unpack_from(RECORD_FMT, view, off)
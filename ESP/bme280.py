@@ -54,9 +54,27 @@ BME280_OSAMPLE_4 = 3
 BME280_OSAMPLE_8 = 4
 BME280_OSAMPLE_16 = 5
 
+# IIR filter coefficient (config register bits 4..2)
+BME280_FILTER_OFF = 0
+BME280_FILTER_2 = 1
+BME280_FILTER_4 = 2
+BME280_FILTER_8 = 3
+BME280_FILTER_16 = 4
+
+# Standby time between conversions in normal mode (config register bits 7..5)
+BME280_STANDBY_0_5 = 0
+BME280_STANDBY_62_5 = 1
+BME280_STANDBY_125 = 2
+BME280_STANDBY_250 = 3
+BME280_STANDBY_500 = 4
+BME280_STANDBY_1000 = 5
+BME280_STANDBY_10 = 6
+BME280_STANDBY_20 = 7
+
 BME280_REGISTER_CONTROL_HUM = 0xF2
 BME280_REGISTER_STATUS = 0xF3
 BME280_REGISTER_CONTROL = 0xF4
+BME280_REGISTER_CONFIG = 0xF5
 
 MODE_SLEEP = const(0)
 MODE_FORCED = const(1)
@@ -70,22 +88,12 @@ class BME280:
                  mode=BME280_OSAMPLE_8,
                  address=BME280_I2CADDR,
                  i2c=None,
+                 filter=BME280_FILTER_OFF,
+                 standby=BME280_STANDBY_1000,
+                 power_mode=MODE_FORCED,
                  **kwargs):
-        # Check that mode is valid.
-        if type(mode) is tuple and len(mode) == 3:
-            self._mode_hum, self._mode_temp, self._mode_press = mode
-        elif type(mode) == int:
-            self._mode_hum, self._mode_temp, self._mode_press = mode, mode, mode
-        else:
-            raise ValueError("Wrong type for the mode parameter, must be int or a 3 element tuple")
-
-        for mode in (self._mode_hum, self._mode_temp, self._mode_press):
-            if mode not in [BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4,
-                            BME280_OSAMPLE_8, BME280_OSAMPLE_16]:
-                raise ValueError(
-                    'Unexpected mode value {0}. Set mode to one of '
-                    'BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4, '
-                    'BME280_OSAMPLE_8 or BME280_OSAMPLE_16'.format(mode))
+        self._set_oversampling(mode)
+        self._filter = self._standby = self._power_mode = None
 
         self.address = address
         if i2c is None:
@@ -96,6 +104,8 @@ class BME280:
         # load calibration data
         dig_88_a1 = self.i2c.readfrom_mem(self.address, 0x88, 26)
         dig_e1_e7 = self.i2c.readfrom_mem(self.address, 0xE1, 7)
+        # kept as read, for compensating raw readouts elsewhere
+        self.calibration = dig_88_a1 + dig_e1_e7
 
         self.dig_T1, self.dig_T2, self.dig_T3, self.dig_P1, \
             self.dig_P2, self.dig_P3, self.dig_P4, self.dig_P5, \
@@ -113,10 +123,83 @@ class BME280:
         self._l8_barray = bytearray(8)
         self._l3_resultarray = array("i", [0, 0, 0])
 
+        self.t_fine = 0
+        self.configure(filter=filter, standby=standby, power_mode=power_mode)
+
+    def _set_oversampling(self, mode):
+        # Check that mode is valid.
+        if type(mode) is tuple and len(mode) == 3:
+            mode_hum, mode_temp, mode_press = mode
+        elif type(mode) == int:
+            mode_hum, mode_temp, mode_press = mode, mode, mode
+        else:
+            raise ValueError("Wrong type for the mode parameter, must be int or a 3 element tuple")
+
+        for mode in (mode_hum, mode_temp, mode_press):
+            if mode not in [BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4,
+                            BME280_OSAMPLE_8, BME280_OSAMPLE_16]:
+                raise ValueError(
+                    'Unexpected mode value {0}. Set mode to one of '
+                    'BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4, '
+                    'BME280_OSAMPLE_8 or BME280_OSAMPLE_16'.format(mode))
+        self._mode_hum, self._mode_temp, self._mode_press = mode_hum, mode_temp, mode_press
+
+    def configure(self, mode=None, filter=None, standby=None, power_mode=None):
+        """ Changes oversampling, IIR filter, standby time and power mode.
+            Settings left at None are kept.
+
+            Args:
+                mode: oversampling, one BME280_OSAMPLE_* value or a
+                (humidity, temperature, pressure) tuple of them
+                filter: IIR filter coefficient, one of BME280_FILTER_*
+                standby: time between conversions in normal mode, one of
+                BME280_STANDBY_*
+                power_mode: MODE_FORCED (one conversion per read) or
+                MODE_NORMAL (continuous conversions, reads return the
+                latest completed one without waiting)
+        """
+        if mode is not None:
+            self._set_oversampling(mode)
+        if filter is not None:
+            if filter not in range(BME280_FILTER_OFF, BME280_FILTER_16 + 1):
+                raise ValueError('Unexpected filter value {0}'.format(filter))
+            self._filter = filter
+        if standby is not None:
+            if standby not in range(BME280_STANDBY_0_5, BME280_STANDBY_20 + 1):
+                raise ValueError('Unexpected standby value {0}'.format(standby))
+            self._standby = standby
+        if power_mode is not None:
+            if power_mode not in (MODE_FORCED, MODE_NORMAL):
+                raise ValueError('Unexpected power mode {0}'.format(power_mode))
+            self._power_mode = power_mode
+
+        # config is only reliably written in sleep mode, ctrl_hum takes
+        # effect with the following write of ctrl_meas
         self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_SLEEP
         self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
                              self._l1_barray)
-        self.t_fine = 0
+        self._l1_barray[0] = self._standby << 5 | self._filter << 2
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONFIG,
+                             self._l1_barray)
+        self._l1_barray[0] = self._mode_hum
+        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
+                             self._l1_barray)
+        if self._power_mode == MODE_NORMAL:
+            self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_NORMAL
+            self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
+                                 self._l1_barray)
+            # let the first conversion complete, until then the data
+            # registers hold their reset values
+            time.sleep_ms(self.measurement_time_ms())
+
+    def measurement_time_ms(self):
+        """ Maximum duration of one conversion with the current oversampling,
+            in ms (datasheet, appendix B).
+        """
+        t = 1.25 + 2.3 * (1 << (self._mode_temp - 1))
+        t += 2.3 * (1 << (self._mode_press - 1)) + 0.575
+        t += 2.3 * (1 << (self._mode_hum - 1)) + 0.575
+        return int(t) + 1
 
     def read_raw_data(self, result):
         """ Reads the raw (uncompensated) data from the sensor.
@@ -128,26 +211,24 @@ class BME280:
                 None
         """
 
-        self._l1_barray[0] = self._mode_hum
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL_HUM,
-                             self._l1_barray)
-        self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_FORCED
-        self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
-                             self._l1_barray)
-
-        # wait up to about 5 ms for the conversion to start
-        for _ in range(5):
-            if self.i2c.readfrom_mem(self.address, BME280_REGISTER_STATUS, 1)[0] & 0x08:
-                break;  # The conversion is started.
-            time.sleep_ms(1)  # still not busy
-        # Wait for conversion to complete
-        for _ in range(BME280_TIMEOUT):
-            if self.i2c.readfrom_mem(self.address, BME280_REGISTER_STATUS, 1)[0] & 0x08:
-                time.sleep_ms(10)  # still busy
+        if self._power_mode != MODE_NORMAL:
+            # forced mode: trigger one conversion and wait for it. In
+            # normal mode the sensor converts continuously and the burst
+            # readout below returns the latest completed conversion
+            self._l1_barray[0] = self._mode_temp << 5 | self._mode_press << 2 | MODE_FORCED
+            self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
+                                 self._l1_barray)
+
+            # sleep for the conversion time instead of polling through it
+            time.sleep_ms(self.measurement_time_ms())
+            # Wait for conversion to complete
+            for _ in range(BME280_TIMEOUT):
+                if self.i2c.readfrom_mem(self.address, BME280_REGISTER_STATUS, 1)[0] & 0x08:
+                    time.sleep_ms(10)  # still busy
+                else:
+                    break  # Sensor ready
             else:
-                break  # Sensor ready
-        else:
-            raise RuntimeError("Sensor BME280 not ready")
+                raise RuntimeError("Sensor BME280 not ready")
 
         # burst readout from 0xF7 to 0xFE, recommended by datasheet
         self.i2c.readfrom_mem_into(self.address, 0xF7, self._l8_barray)
@@ -163,6 +244,17 @@ class BME280:
         result[1] = raw_press
         result[2] = raw_hum
 
+    def read_raw_readout(self):
+        """ Reads the data from the sensor without decoding or compensating it.
+
+            Returns:
+                the 8 byte burst readout of registers 0xF7..0xFE (pressure,
+                temperature, humidity). This is a buffer of the driver,
+                overwritten by the next read
+        """
+        self.read_raw_data(self._l3_resultarray)
+        return self._l8_barray
+
     def read_compensated_data(self, result=None):
         """ Reads the data from the sensor and returns the compensated data.
 
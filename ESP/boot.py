@@ -1,5 +1,6 @@
 # boot.py -- run on boot-up
 from machine import I2C, Pin
+import machine
 import bme280
 import network, time
 import secrets
@@ -24,15 +25,18 @@ def wifi_connect():
         print("Wi-Fi connection failed")
 
 # ---- Run at boot ----
-wifi_connect()
+# waking from deep sleep (SLEEP_MODE = "deep" in main.py): the RTC kept the time and main.py
+# brings Wi-Fi up itself when it publishes
+if machine.reset_cause() != machine.DEEPSLEEP_RESET:
+    wifi_connect()
 
-# Sync NTP time
-try:
-    ntptime.settime()
-    print("NTP time synced")
-    print("Current time (UTC):", time.localtime())
-except Exception as e:
-    print("NTP sync failed:", e)
+    # Sync NTP time
+    try:
+        ntptime.settime()
+        print("NTP time synced")
+        print("Current time (UTC):", time.localtime())
+    except Exception as e:
+        print("NTP sync failed:", e)
 
 
 print("boot.py -- ran on boot-up")
\ No newline at end of file
@@ -1,13 +1,57 @@
 # main.py -- put your code here!
 print("main.py... running")
 
-import json, ubinascii, time, secrets, usocket, sys
-from umqtt.robust import MQTTClient
+import json, ubinascii, time, secrets, usocket, sys, struct, machine
+from umqtt.simple import MQTTClient
+import backlog, bme280
 
 # MQTT broker info (your Raspberry Pi)
 MQTT_HOST = "pi4b-iot"   # change to your Pi IP
 MQTT_PORT = 1883             # 1883 = no TLS
-MQTT_TOPIC = b"iot/bme280/esp32"
+MQTT_TOPIC_PREFIX = b"iot/bme280/"  # the Pi subscribes to iot/bme280/+, last level is this device's id
+MQTT_QOS = 1                 # 1: a message leaves the backlog only once the broker acknowledged it
+
+SAMPLE_INTERVAL_S = 10
+RECONNECT_S = 5              # wait between Wi-Fi / MQTT reconnect attempts, sampling goes on meanwhile
+NTP_RESYNC_EVERY = 100       # samples
+
+# power: "awake" keeps Wi-Fi and MQTT up and idles in time.sleep between samples,
+# "light" / "deep" power the radio down and sleep the CPU between samples (machine.lightsleep /
+# machine.deepsleep), waking Wi-Fi and MQTT every PUBLISH_EVERY samples to publish the backlog
+SLEEP_MODE = "awake"
+PUBLISH_EVERY = 6
+
+# BME280: "normal" converts continuously (SENSOR_STANDBY between conversions) through the IIR
+# filter and a sample is one burst read of the latest conversion; "forced" runs one conversion
+# per sample and waits for it. Deep sleep always uses forced: the board restarts every sample.
+SENSOR_MODE = "normal"
+SENSOR_OVERSAMPLING = bme280.BME280_OSAMPLE_8  # or a (humidity, temperature, pressure) tuple
+SENSOR_FILTER = bme280.BME280_FILTER_4
+SENSOR_STANDBY = bme280.BME280_STANDBY_1000
+
+# deep sleep restarts boot.py and main.py: this state and the buffered readings live in RTC memory
+RTC_MAGIC = b"BMES"
+RTC_HEADER_FMT = "<4sIIqI"   # magic, samples since NTP sync, samples since publish, next sample (unix s), record size
+RTC_HEADER_SIZE = 24
+RTC_MEMORY = 2048            # bytes of RTC user memory on the ESP32 port
+
+# store-and-forward: readings are buffered until published, oldest first
+BUFFER_RECORDS = 1024        # RAM ring, 16 bytes per reading, 12 raw (~2.8 h at 10 s)
+SPILL_FILE = "backlog.bin"   # flash file the RAM ring spills into when full, None to disable
+SPILL_RECORDS = 16384        # 256 KiB of flash (~45 h at 10 s)
+REPLAY_BATCH = 16            # readings per MQTT message while catching up
+
+# payload: "binary" (26 bytes per reading, see RasPi/payload.py), "json" (~90 bytes per reading)
+# or "raw": the sensor's ADC readout as is (22 bytes per reading), compensated on the Pi with
+# the calibration published (retained) once per MQTT session
+PAYLOAD_FORMAT = "binary"
+PAYLOAD_MAGIC = 0xB7
+PAYLOAD_VERSION_READINGS = 1
+PAYLOAD_VERSION_RAW = 2
+PAYLOAD_VERSION_CALIBRATION = 3
+PAYLOAD_HEADER_FMT = "<BB6sH"  # magic, version, device MAC, record count; backlog records follow
+PAYLOAD_HEADER_SIZE = 10
+RECORD_SIZE = backlog.RAW_RECORD_SIZE if PAYLOAD_FORMAT == "raw" else backlog.RECORD_SIZE
 
 # LED pin (devboard)
 led = Pin(2, Pin.OUT)
@@ -21,6 +65,31 @@ def unix_time_now():
     else:
         return int(time.time())
 
+def unix_time_ms():
+    if sys.implementation.name == "micropython":
+        return time.time_ns() // 1000000 + EPOCH_DELTA * 1000
+    else:
+        return time.time_ns() // 1000000
+
+def device_id():
+    wlan = network.WLAN(network.STA_IF)
+    mac  = ubinascii.hexlify(wlan.config('mac')).decode()  # e.g. "a4cf12ff01ab"
+    return "esp32-" + mac                                  # string, safe ASCII
+
+def network_up():
+    # never blocks: (re)starts a Wi-Fi connect if needed and reports whether we are online
+    wlan = network.WLAN(network.STA_IF)
+    if wlan.isconnected():
+        return True
+    try:
+        if not wlan.active():
+            wlan.active(True)
+        if wlan.status() != network.STAT_CONNECTING:
+            wlan.connect(secrets.WIFI_SSID, secrets.WIFI_PASS)
+    except OSError as e:
+        print("Wi-Fi connect error:", e)
+    return False
+
 def mqtt_connect():
     # Resolve MQTT_HOST to IP address
     try:
@@ -30,10 +99,7 @@ def mqtt_connect():
         print("Could not resolve IP for", MQTT_HOST, ":", e)
         addr_info = None
 
-    wlan = network.WLAN(network.STA_IF)
-    mac  = ubinascii.hexlify(wlan.config('mac')).decode()  # e.g. "a4cf12ff01ab"
-    cid  = "esp32-" + mac                                  # string, safe ASCII
-    cid = cid.encode()                               # bytes for umqtt
+    cid = device_id().encode()                       # bytes for umqtt
     
     client = MQTTClient(
         client_id=cid,
@@ -41,74 +107,210 @@ def mqtt_connect():
         port=MQTT_PORT,
         user=secrets.MQTT_USER,
         password=secrets.MQTT_PASS,
-        keepalive=10
+        keepalive=max(10, 2 * SAMPLE_INTERVAL_S)
     )
     
     client.connect()
     
     print("Connected to MQTT broker:", MQTT_HOST, "(", addr_info if addr_info else "unknown IP" , ")")
+
+    if PAYLOAD_FORMAT == "raw":
+        # once per session and retained, so the Pi has it before any raw reading, even after a restart
+        wlan = network.WLAN(network.STA_IF)
+        calibration = struct.pack(PAYLOAD_HEADER_FMT, PAYLOAD_MAGIC, PAYLOAD_VERSION_CALIBRATION,
+                                  wlan.config('mac'), 1) + bme.calibration
+        client.publish(MQTT_TOPIC_PREFIX + device_id().encode(), calibration, retain=True, qos=MQTT_QOS)
     
     return client
 
+def publish_backlog(client, topic, buf, deadline, packet):
+    # Publish buffered readings oldest first until the buffer is empty or `deadline` (unix time)
+    # has passed, up to REPLAY_BATCH readings per message. Returns the number published.
+    # `packet` is the bytearray binary payloads are assembled in: the header is packed in place
+    # and the backlog records are copied behind it as they are, so no buffer is allocated per message.
+    mac = network.WLAN(network.STA_IF).config('mac')
+    version = PAYLOAD_VERSION_RAW if PAYLOAD_FORMAT == "raw" else PAYLOAD_VERSION_READINGS
+    published = 0
+    while len(buf) and unix_time_now() < deadline:
+        batch = buf.peek()
+        n = len(batch) // RECORD_SIZE
+        if PAYLOAD_FORMAT != "json":
+            struct.pack_into(PAYLOAD_HEADER_FMT, packet, 0, PAYLOAD_MAGIC, version, mac, n)
+            end = PAYLOAD_HEADER_SIZE + len(batch)
+            packet[PAYLOAD_HEADER_SIZE:end] = batch
+            client.publish(topic, memoryview(packet)[:end], qos=MQTT_QOS)
+        else:
+            readings = [{
+                "temp_c": t,
+                "hum_pct": h,
+                "pres_hpa": p,
+                "device_ts": ts,  # epoch UTC
+            } for ts, t, h, p in backlog.records(batch)]
+            client.publish(topic, json.dumps(readings[0] if n == 1 else readings), qos=MQTT_QOS)
+        buf.drop(n)
+        published += n
+        print("Published", n, "reading" if n == 1 else "buffered readings")
+    return published
+
+def sync_ntp():
+    try:
+        ntptime.settime()
+        print("NTP time synced")
+        print("Current time (UTC):", time.localtime())
+    except Exception as e:
+        print("NTP sync failed:", e)
+
+def blink_error():
+    # flash led multiple times on error
+    for _ in range(10):
+        led.value(1)
+        time.sleep(0.1)
+        led.value(0)
+        time.sleep(0.1)
+
+def publish_window(topic, buf, deadline, packet, resync):
+    # Sleep modes: bring Wi-Fi and MQTT up, publish the backlog until `deadline`, then power the
+    # radio down again. Returns True if the broker was reached.
+    wlan = network.WLAN(network.STA_IF)
+    connected = False
+    led.value(1)
+    try:
+        while not network_up():
+            if unix_time_now() >= deadline:
+                print("Wi-Fi unavailable,", len(buf), "readings buffered")
+                return False
+            time.sleep(0.2)
+        client = mqtt_connect()
+        connected = True
+        try:
+            publish_backlog(client, topic, buf, deadline, packet)
+            if resync:
+                sync_ntp()
+        finally:
+            client.disconnect()
+    except Exception as e:
+        print("Publish error:", e, "-", len(buf), "readings buffered")
+        blink_error()
+    finally:
+        led.value(0)
+        wlan.active(False)
+    return connected
+
+def load_state(buf):
+    # Restore the sampling state and buffered readings kept in RTC memory over a deep sleep.
+    # Returns (samples since NTP sync, samples since publish, next sample time).
+    data = machine.RTC().memory()
+    if len(data) < RTC_HEADER_SIZE:
+        return 0, 0, 0
+    magic, seq, pending, next_ts, record_size = struct.unpack_from(RTC_HEADER_FMT, data)
+    if magic != RTC_MAGIC or record_size != RECORD_SIZE:
+        return 0, 0, 0
+    buf.load(memoryview(data)[RTC_HEADER_SIZE:])
+    machine.RTC().memory(b"")  # consumed: a later reset must not load these readings again
+    return seq, pending, next_ts
+
+def save_state(buf, seq, pending, next_ts):
+    records = buf.dump((RTC_MEMORY - RTC_HEADER_SIZE) // RECORD_SIZE)
+    machine.RTC().memory(struct.pack(RTC_HEADER_FMT, RTC_MAGIC, seq, pending, next_ts, RECORD_SIZE) + records)
+
+def idle_until(next_ts, buf, seq, pending):
+    # Wait for the next sample: time.sleep while awake, otherwise sleep the CPU. Deep sleep
+    # does not return, the board restarts through boot.py and main.py with the state in RTC memory.
+    ms = next_ts * 1000 - unix_time_ms()
+    if ms <= 0:
+        return
+    if SLEEP_MODE == "deep":
+        save_state(buf, seq, pending, next_ts)
+        machine.deepsleep(ms)
+    elif SLEEP_MODE == "light":
+        machine.lightsleep(ms)
+    else:
+        time.sleep_ms(ms)
+
 def main():
-    print("Starting main loop...")
+    print("Starting main loop... (sleep mode: %s)" % SLEEP_MODE)
 
+    buf = backlog.Backlog(BUFFER_RECORDS, REPLAY_BATCH, SPILL_FILE, SPILL_RECORDS, RECORD_SIZE)
+    packet = bytearray(PAYLOAD_HEADER_SIZE + REPLAY_BATCH * RECORD_SIZE)
+    seq, pending, next_ts = load_state(buf)
+    try:
+        if SENSOR_MODE == "normal" and SLEEP_MODE != "deep":
+            bme.configure(SENSOR_OVERSAMPLING, SENSOR_FILTER, SENSOR_STANDBY, bme280.MODE_NORMAL)
+        else:
+            bme.configure(SENSOR_OVERSAMPLING, SENSOR_FILTER, power_mode=bme280.MODE_FORCED)
+    except Exception as e:
+        print("Sensor configuration error:", e)
+    if len(buf):
+        print(len(buf), "buffered readings left from before the reset")
+    if SLEEP_MODE != "awake":
+        network.WLAN(network.STA_IF).active(False)  # boot.py may have connected: only wake it to publish
+    topic = MQTT_TOPIC_PREFIX + device_id().encode()
+    client = None
+    retry_at = 0
+    dropped = 0
     while True:
+        current_timestamp = unix_time_now()  # get current time
         try:
-            client = mqtt_connect()
-            break
+            if PAYLOAD_FORMAT == "raw":
+                buf.push_raw(current_timestamp, bme.read_raw_readout())  # no float math on the ESP
+            else:
+                t, p, h = bme.read_compensated_data()
+                buf.push(current_timestamp, t, h, p)
         except Exception as e:
-            print("MQTT connection error:", e)
-            print("\nCurrent BME280 data:")
-            print(bme.values)
-            print("\nRetrying in 5 seconds...\n")
-            time.sleep(5)
-    seq = 0
-    while True:
-        if seq > 100: #resync ntp
-            try:
-                ntptime.settime()
-                print("NTP time synced")
-                print("Current time (UTC):", time.localtime())
-            except Exception as e:
-                print("NTP sync failed:", e)
-            seq = 0
-       
-        try:
-            t, p, h = bme.read_compensated_data()
-            current_timestamp = unix_time_now()  # get current time
-            payload = {
-                "temp_c": t,
-                "hum_pct": h,
-                "pres_hpa": p,
-                "device_ts": current_timestamp,  # epoch UTC
-            }
-            msg = json.dumps(payload)
+            print("Sensor error:", e)
+        seq += 1
+        pending += 1
+        if buf.dropped != dropped:
+            print("Buffer full, dropped", buf.dropped - dropped, "oldest readings")
+            dropped = buf.dropped
+        # keep the schedule across wakes, unless it fell behind (e.g. a long publish window)
+        next_ts = next_ts + SAMPLE_INTERVAL_S if next_ts > current_timestamp else current_timestamp + SAMPLE_INTERVAL_S
+
+        if SLEEP_MODE != "awake":
+            if pending >= PUBLISH_EVERY:
+                resync = seq > NTP_RESYNC_EVERY
+                if publish_window(topic, buf, next_ts, packet, resync):
+                    if resync:
+                        seq = 0
+                    # still catching up: try again after the next sample instead of a whole period
+                    pending = PUBLISH_EVERY - 1 if len(buf) else 0
+                else:
+                    pending = 0
+            idle_until(next_ts, buf, seq, pending)
+            continue
 
+        # (re)connect without holding up sampling: one attempt per RECONNECT_S
+        if client is None and unix_time_now() >= retry_at:
+            retry_at = unix_time_now() + RECONNECT_S
+            if network_up():
+                try:
+                    client = mqtt_connect()
+                except Exception as e:
+                    print("MQTT connection error:", e)
+            if client is None:
+                print(len(buf), "readings buffered, retrying in", RECONNECT_S, "seconds")
+
+        if client is not None:
             # Flash LED while sending
             led.value(1)
-            
             try:
-                client.publish(MQTT_TOPIC, msg)
-                print("Published:", msg)
+                if not publish_backlog(client, topic, buf, next_ts, packet):
+                    client.ping()  # nothing to send: keep the MQTT session alive
+                if seq > NTP_RESYNC_EVERY:  # resync ntp
+                    sync_ntp()
+                    seq = 0
             except Exception as e:
-                print("Publish error:", e)
-                # flash led multiple times on error
-                for _ in range(10):
-                    led.value(1)
-                    time.sleep(0.1)
-                    led.value(0)
-                    time.sleep(0.1)
-            
-            time.sleep(0.05) 
+                print("Publish error:", e, "-", len(buf), "readings buffered")
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+                client = None
+                retry_at = unix_time_now() + RECONNECT_S
+                blink_error()
+            time.sleep(0.05)
             led.value(0)
 
-            seq += 1
-            while unix_time_now() < current_timestamp + 10:  # wait 10 seconds before next reading
-                pass
-            
-        except Exception as e:
-            print("Error:", e)
-            time.sleep(5)
+        idle_until(next_ts, buf, seq, pending)
 
 main()
\ No newline at end of file
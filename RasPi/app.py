@@ -19,8 +19,51 @@ parser.add_argument("-mh", "--mqtt-host", type=str, help="MQTT host, if not set
                     default=config.MQTT_HOST if hasattr(config, 'MQTT_HOST') else None)
 parser.add_argument("-mpo", "--mqtt-port", type=int, help="MQTT port, if not set will use config.MQTT_PORT",
                     default=config.MQTT_PORT if hasattr(config, 'MQTT_PORT') else 1883)
-parser.add_argument("-mt", "--mqtt-topic", type=str, help="MQTT topic, if not set will use config.MQTT_TOPIC",
-                    default=config.MQTT_TOPIC if hasattr(config, 'MQTT_TOPIC') else "iot/bme280/esp32")
+parser.add_argument("-mt", "--mqtt-topic", type=str, help="MQTT topic, the last level is the device id (use + for all devices), if not set will use config.MQTT_TOPIC",
+                    default=config.MQTT_TOPIC if hasattr(config, 'MQTT_TOPIC') else "iot/bme280/+")
+parser.add_argument("-mc", "--mqtt-client-id", type=str, help="MQTT client id, if not set will use config.MQTT_CLIENT_ID",
+                    default=config.MQTT_CLIENT_ID if hasattr(config, 'MQTT_CLIENT_ID') else "raspberrypi-client")
+parser.add_argument("-mq", "--mqtt-qos", type=int, choices=[0, 1], help="MQTT subscription QoS, 1 keeps a persistent session and acknowledges each message once its readings are committed (default: config.MQTT_QOS)",
+                    default=config.MQTT_QOS if hasattr(config, 'MQTT_QOS') else 0)
+parser.add_argument("-mi", "--mqtt-inflight", type=int, help="QoS 1 messages the broker sends before waiting for acks, the writer commits once half of them wait for theirs (default: config.MQTT_INFLIGHT)",
+                    default=config.MQTT_INFLIGHT if hasattr(config, 'MQTT_INFLIGHT') else 800)
+parser.add_argument("-b", "--batch-bytes", type=int, help="Pack readings into JSON-array messages of at most this many bytes, 0 sends one message per reading (default: config.UPLINK_BATCH_BYTES)",
+                    default=config.UPLINK_BATCH_BYTES if hasattr(config, 'UPLINK_BATCH_BYTES') else 0)
+parser.add_argument("-a", "--async-send", action="store_true", help="Send with the asyncio IoT Hub client, keeping --inflight messages in flight",
+                    default=config.UPLINK_ASYNC if hasattr(config, 'UPLINK_ASYNC') else False)
+parser.add_argument("-i", "--inflight", type=int, help="Max concurrent unacknowledged messages in --async-send mode (default: config.UPLINK_INFLIGHT)",
+                    default=config.UPLINK_INFLIGHT if hasattr(config, 'UPLINK_INFLIGHT') else 8)
+parser.add_argument("-ht", "--hub-tier", choices=["F1", "B1", "B2", "B3", "S1", "S2", "S3", "none"],
+                    help="IoT Hub tier whose throttling and daily message quota pace the uplink, none sends as fast as it can (default: config.IOTHUB_TIER)",
+                    default=config.IOTHUB_TIER if hasattr(config, 'IOTHUB_TIER') else "none")
+parser.add_argument("-hu", "--hub-units", type=int, help="IoT Hub units of the tier (default: config.IOTHUB_UNITS)",
+                    default=config.IOTHUB_UNITS if hasattr(config, 'IOTHUB_UNITS') else 1)
+parser.add_argument("-hs", "--hub-share", type=float, help="Share of the hub's quota and send rate this Pi may use, 0-1 (default: config.IOTHUB_SHARE)",
+                    default=config.IOTHUB_SHARE if hasattr(config, 'IOTHUB_SHARE') else 1.0)
+parser.add_argument("-rc", "--ring-capacity", type=int, help="Readings kept in the shared-memory ring buffer read by webapp.py, 0 disables it (default: config.RING_CAPACITY)",
+                    default=config.RING_CAPACITY if hasattr(config, 'RING_CAPACITY') else 131072)
+parser.add_argument("-wb", "--writer-batch", type=int, help="Max rows per DB commit (default: config.WRITER_BATCH_SIZE)",
+                    default=config.WRITER_BATCH_SIZE if hasattr(config, 'WRITER_BATCH_SIZE') else 200)
+parser.add_argument("-wf", "--writer-flush", type=int, help="Max time a row waits before commit, in milliseconds (default: config.WRITER_FLUSH_MS)",
+                    default=config.WRITER_FLUSH_MS if hasattr(config, 'WRITER_FLUSH_MS') else 500)
+parser.add_argument("-wq", "--writer-queue", type=int, help="Max rows waiting for the DB writer (default: config.WRITER_QUEUE_LIMIT)",
+                    default=config.WRITER_QUEUE_LIMIT if hasattr(config, 'WRITER_QUEUE_LIMIT') else 10000)
+parser.add_argument("-rd", "--retention-days", type=int, help="Drop stored readings older than this many days once they are synced to IoT Hub, 0 keeps everything (default: config.RETENTION_DAYS)",
+                    default=config.RETENTION_DAYS if hasattr(config, 'RETENTION_DAYS') else 0)
+parser.add_argument("-ad", "--archive-days", type=int, help="Move synced readings older than this many days from SQLite into compressed archive files, 0 disables (default: config.ARCHIVE_AFTER_DAYS)",
+                    default=config.ARCHIVE_AFTER_DAYS if hasattr(config, 'ARCHIVE_AFTER_DAYS') else 0)
+parser.add_argument("-wd", "--writer-drop", choices=["newest", "oldest", "block"],
+                    help="What to do when the writer queue is full: drop the incoming row, drop the oldest queued row, or block the MQTT loop (default: config.WRITER_DROP_POLICY)",
+                    default=config.WRITER_DROP_POLICY if hasattr(config, 'WRITER_DROP_POLICY') else "newest")
+parser.add_argument("-ll", "--log-level", choices=["debug", "info", "success", "warning", "error"],
+                    help="Lowest level logged, debug adds a line per received and sent message (default: config.LOG_LEVEL)",
+                    default=config.LOG_LEVEL if hasattr(config, 'LOG_LEVEL') else "info")
+parser.add_argument("-lf", "--log-format", choices=["rich", "plain", "json"], help="Log output: rich markup, plain text or a JSON object per line (default: config.LOG_FORMAT)",
+                    default=config.LOG_FORMAT if hasattr(config, 'LOG_FORMAT') else "rich")
+parser.add_argument("-lr", "--log-rate", type=int, help="Max log lines per second from one line of code, the rest is counted and summarized, 0 = unlimited (default: config.LOG_RATE)",
+                    default=config.LOG_RATE if hasattr(config, 'LOG_RATE') else 5)
+parser.add_argument("-me", "--metrics-port", type=int, help="Port serving Prometheus metrics at /metrics, 0 disables (default: config.METRICS_PORT)",
+                    default=config.METRICS_PORT if hasattr(config, 'METRICS_PORT') else 0)
 
 ARGS = parser.parse_args()
 
@@ -28,123 +71,534 @@ from azure.iot.device import IoTHubDeviceClient
 from azure.iot.device import Message
 from azure.iot.device.exceptions import ConnectionFailedError, ConnectionDroppedError, OperationTimeout, OperationCancelled, NoConnectionError
 from log import console, log
+# printed by a background thread: the MQTT and writer threads never wait for the terminal
+log.configure(ARGS.log_level, ARGS.log_format, ARGS.log_rate, background=True)
+import rollup
+import ringbuf
+import storage
+import archive
+import payload
+import metrics
+import compensate
 from dotenv import load_dotenv
 import json
 import time
+import queue
+import random
+import itertools
+import asyncio
 import sqlite3
+import threading
 import paho.mqtt.client as mqtt
 
 load_dotenv()
 
+DB_FILE = storage.DB_FILE
+
+# ============ METRICS ============
+MQTT_RECEIVED = metrics.Counter("mqtt_messages_received_total", "MQTT messages received")
+MQTT_PARSED = metrics.Counter("mqtt_messages_parsed_total", "MQTT messages decoded, by payload kind", ["payload"])
+MQTT_REJECTED = metrics.Counter("mqtt_messages_rejected_total", "MQTT messages dropped without storing their readings", ["reason"])
+MQTT_READINGS = metrics.Counter("mqtt_readings_received_total", "Readings in the decoded MQTT messages")
+WRITER_QUEUE = metrics.Gauge("writer_queue_depth", "Items waiting for the DB writer")
+WRITER_DROPPED = metrics.Counter("writer_dropped_rows_total", "Rows dropped because the writer queue was full")
+WRITER_ROWS = metrics.Counter("writer_rows_stored_total", "Rows committed to the database")
+WRITER_ERRORS = metrics.Counter("writer_commit_errors_total", "Commits that failed, losing their rows")
+COMMIT_ROWS = metrics.Histogram("writer_commit_rows", "Rows per DB commit",
+                                buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000))
+COMMIT_SECONDS = metrics.Histogram("writer_commit_seconds", "Duration of a DB commit, rollup update included")
+IOTHUB_SECONDS = metrics.Histogram("iothub_send_seconds", "Duration of successful IoT Hub sends")
+IOTHUB_MESSAGES = metrics.Counter("iothub_messages_sent_total", "Messages acknowledged by IoT Hub")
+IOTHUB_READINGS = metrics.Counter("iothub_readings_sent_total", "Readings in the messages acknowledged by IoT Hub")
+IOTHUB_FAILURES = metrics.Counter("iothub_send_failures_total", "Failed IoT Hub sends, by exception", ["error"])
+IOTHUB_UNITS = metrics.Counter("iothub_metered_units_total", "Metering units (4 KB, 0.5 KB on F1) of the messages acknowledged by IoT Hub")
+UPLINK_PACED = metrics.Counter("uplink_paced_seconds_total", "Time sends waited for the hub tier's rate and quota")
+
+def uplink_backlog():
+    """
+    device_id -> stored readings newer than its IoT Hub watermark, for the uplink_backlog_rows gauge.
+    Counted at scrape time over the primary key range of each device, on the scraping thread.
+    """
+    conn = storage.connection("reader", DB_FILE)
+    marks = storage.watermarks(conn)
+    return {(device_id,): conn.execute("SELECT COUNT(*) FROM bme280_data WHERE device_id = ? AND device_ts > ?",
+                                       (device_id, int(marks.get(device_id, 0)))).fetchone()[0]
+            for device_id in storage.device_ids(conn)}
+
+UPLINK_BACKLOG = metrics.Gauge("uplink_backlog_rows", "Stored readings not yet sent to IoT Hub", ["device_id"],
+                               function=uplink_backlog)
+
+def start_metrics_server(writer):
+    """Serve the metrics above on --metrics-port, the writer queue depth read at every scrape"""
+    WRITER_QUEUE.set_function(writer.queue.qsize)
+    try:
+        metrics.serve(ARGS.metrics_port)
+        log.info(f"Prometheus metrics on http://0.0.0.0:{ARGS.metrics_port}/metrics")
+    except OSError as e:
+        log.warning(f"Metrics port {ARGS.metrics_port} not available, metrics disabled:", e)
+# ============ END METRICS ============
+
 # ============ DB SETUP ============
 def setup_database():
     """
-    Set up the SQLite database to store BME280 data.
-    Stores device_ts, temp_c, hum_pct, pres_hpa
-    """
-    conn = sqlite3.connect('bme280_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bme280_data (
-            device_ts INTEGER PRIMARY KEY,
-            temp_c REAL NOT NULL,
-            hum_pct REAL NOT NULL,
-            pres_hpa REAL NOT NULL
-        )
-    ''')
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sync_state (
-            key   TEXT PRIMARY KEY,
-            value INTEGER
-        )
-    """)
-    conn.commit()
-    conn.close()
+    Create the SQLite database storing BME280 data, or upgrade it to the current schema
+    (see storage.MIGRATIONS): readings keyed on (device_id, device_ts), sync state, rollups.
+    """
+    storage.setup(DB_FILE)
 
 def get_sync_state():
     """
-    Get the last sync state from the database.
-    Returns the last synced timestamp or None if not found.
+    Get the last sync state of every device from the database.
+    Returns a dict of device_id -> last synced timestamp (empty if nothing was synced yet).
     """
-    conn = sqlite3.connect('bme280_data.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM sync_state WHERE key='last_sync_ts'")
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return storage.watermarks(storage.connection("writer", DB_FILE))
 
-def set_sync_state(ts):
+def set_sync_state(device_id, ts):
     """
-    Set the last sync state in the database.
+    Set the last sync state of one device in the database.
     """
-    conn = sqlite3.connect('bme280_data.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_sync_ts', ?)", (ts,))
-    conn.commit()
-    conn.close()
+    conn = storage.connection("writer", DB_FILE)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (storage.sync_key(device_id), ts))
+        # readings sent ahead are covered by the watermark from now on
+        conn.execute("DELETE FROM uplink_sent_ahead WHERE device_id = ? AND device_ts <= ?", (device_id, ts))
 
-def fetch_rows_newer_than(ts, limit=5000):
-    conn = sqlite3.connect('bme280_data.db')
-    c = conn.cursor()
-    c.execute("""
+def set_sent_ahead(device_id, timestamps):
+    """
+    Record readings of one device sent ahead of its watermark (see plan_messages), so the
+    backfill skips them after a restart too.
+    """
+    conn = storage.connection("writer", DB_FILE)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO uplink_sent_ahead (device_id, device_ts) VALUES (?, ?)",
+                         [(device_id, ts) for ts in timestamps])
+
+FETCH_LIMIT = 5000  # rows per device and sender round
+
+def fetch_rows_newer_than(watermarks, limit=FETCH_LIMIT):
+    """
+    Fetch unsynced rows per device, oldest-first.
+    `watermarks` is a dict of device_id -> last synced timestamp, devices missing from it start at 0.
+    Returns a list of (device_id, rows) with at most `limit` rows per device.
+    """
+    conn = storage.connection("writer", DB_FILE)
+    pending = []
+    for device_id in storage.device_ids(conn):
+        rows = conn.execute("""
+            SELECT device_ts, temp_c, hum_pct, pres_hpa
+            FROM bme280_data
+            WHERE device_id = ? AND device_ts > ?
+            ORDER BY device_ts ASC
+            LIMIT ?
+        """, (device_id, int(watermarks.get(device_id, 0)), int(limit))).fetchall()
+        if rows:
+            pending.append((device_id, rows))
+    return pending
+
+def fetch_newest_rows(device_id, after_ts, limit):
+    """
+    Fetch the `limit` newest rows of one device newer than `after_ts`, newest-first.
+    """
+    conn = storage.connection("writer", DB_FILE)
+    return conn.execute("""
         SELECT device_ts, temp_c, hum_pct, pres_hpa
         FROM bme280_data
-        WHERE device_ts > ?
-        ORDER BY device_ts ASC
+        WHERE device_id = ? AND device_ts > ?
+        ORDER BY device_ts DESC
         LIMIT ?
-    """, (int(ts), int(limit)))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    """, (device_id, int(after_ts), int(limit))).fetchall()
 # ============ END DB SETUP ============
 
 
+# ============ DB WRITER ============
+_STOP = object()  # sentinel telling the writer thread to flush and exit
+_CALIBRATION = object()  # queue items (_CALIBRATION, device_id, block) store a BME280 calibration
+_ACK = object()  # queue items (_ACK, mid, rows) carry the rows of a QoS 1 message, acknowledged once they are committed
+PRUNE_INTERVAL_S = 3600    # how often the writer checks for partitions to archive or past retention
+VACUUM_STEP_PAGES = 256    # pages given back to the file system per step after a prune
+VACUUM_STEP_PAUSE_S = 0.5  # between vacuum steps, ingest commits in between
+COMMIT_RETRY_MAX_S = 30    # longest wait between retries of a failed commit holding QoS 1 messages
+
+class IngestWriter(threading.Thread):
+    """
+    Dedicated thread owning one long-lived SQLite connection ("writer" profile, WAL mode).
+    Rows are put on a bounded queue and group-committed with `executemany`
+    every `batch_size` rows or after `flush_ms` milliseconds, whichever comes first.
+    Committed rows are also published to the shared-memory `ring` (if any) for webapp.py.
+    QoS 1 messages are acknowledged through `ack` only after the commit holding their rows, and a
+    commit is made early once half of `ack_window` messages wait for their ack: the broker sends
+    no more than `ack_window` unacknowledged messages, so waiting for `flush_ms` would stall it,
+    and the other half keeps arriving while the commit runs. A commit that fails is retried
+    (waiting up to COMMIT_RETRY_MAX_S) while it holds QoS 1 messages, which stay unacknowledged
+    until it succeeds; QoS 0 rows of a failed commit are lost.
+    Rows go to their time partition (storage.Partitions), the raw BME280 readout a row may carry
+    as sixth field goes to bme280_raw. Between commits the thread also moves
+    synced partitions older than `archive_days` into archive files, drops synced partitions and
+    archive files past `retention_days`, and afterwards gives the freed space back in small
+    incremental vacuum steps, one step at a time so ingest never waits long.
+
+    When the queue is full `drop_policy` decides what happens:
+      - "newest": the incoming row is dropped (never blocks the MQTT loop)
+      - "oldest": the oldest queued row is dropped to make room; calibration and ack items are
+                  never dropped and keep their order, without a queued row the incoming one is dropped
+      - "block":  the caller waits until there is room (backpressure onto the broker)
+    """
+
+    def __init__(self, db_file=DB_FILE, batch_size=200, flush_ms=500, queue_limit=10000, drop_policy="newest", ring=None,
+                 retention_days=0, archive_days=0, archive_dir=storage.ARCHIVE_DIR, ack=None, ack_window=800, durable=False):
+        super().__init__(name="ingest-writer", daemon=True)
+        self.db_file = db_file
+        self.ring = ring  # optional ringbuf.RingWriter, gets every committed batch
+        self.batch_size = max(1, batch_size)
+        self.flush_s = max(0, flush_ms) / 1000
+        self.drop_policy = drop_policy
+        self.queue = queue.Queue(maxsize=max(1, queue_limit))
+        self.dropped = 0  # rows lost to a full queue, reported on the next commit
+        self.dropped_lock = threading.Lock()  # put runs on paho's thread, the report on the writer's
+        self.retention_s = max(0, retention_days) * 86400
+        self.archive_s = max(0, archive_days) * 86400
+        self.archive_dir = archive_dir
+        self.archive = archive.Archive(archive_dir)
+        self.partitions = None  # storage.Partitions, created on the writer thread
+        self.ack = ack  # called with the mid of every committed QoS 1 message, see AckAfterCommitClient
+        self.ack_window = max(1, ack_window)
+        self.durable = durable  # fsync every commit (storage profile "writer-full"), for QoS 1 ingest
+        # device_id -> compensate.Calibration of ESPs publishing raw readouts, used by on_message
+        self.calibrations = {device_id: compensate.Calibration(block) for device_id, block
+                             in storage.calibrations(storage.connection("writer", db_file)).items()}
+
+    def put(self, row):
+        """Queue a `(device_id, device_ts, temp_c, hum_pct, pres_hpa)` row, applying the drop policy when full"""
+        if self.drop_policy == "block":
+            self.queue.put(row)
+            return True
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            pass
+        if self.drop_policy == "oldest":
+            # swap the oldest reading for the new row in place: calibration, ack and stop items are
+            # never dropped and keep their order; with no reading queued the new row is dropped
+            with self.queue.mutex:
+                items = self.queue.queue
+                oldest = next((i for i, item in enumerate(items)
+                               if item is not _STOP and item[0] is not _CALIBRATION and item[0] is not _ACK), None)
+                if oldest is not None:
+                    del items[oldest]
+                    items.append(row)
+        with self.dropped_lock:
+            self.dropped += 1
+        WRITER_DROPPED.inc()
+        return False
+
+    def put_calibration(self, device_id, block):
+        """
+        Use and store a calibration block a device sent (every MQTT session, retained).
+        Returns False if it is the one already known.
+        """
+        known = self.calibrations.get(device_id)
+        if known is not None and known.block == block:
+            return False
+        self.calibrations[device_id] = compensate.Calibration(block)
+        self.queue.put((_CALIBRATION, device_id, block))  # never dropped, rare and needed for reprocessing
+        return True
+
+    def put_ack(self, mid, rows=()):
+        """
+        Queue the rows of QoS 1 message `mid` as one item and acknowledge it once they are committed
+        (right away without rows). Never dropped: the broker redelivers what is not acknowledged.
+        """
+        self.queue.put((_ACK, mid, rows))
+
+    def stop(self):
+        """Flush whatever is queued and wait for the thread to finish"""
+        self.queue.put(_STOP)
+        self.join()
+
+    def _commit(self, conn, batch):
+        """Store `batch` in one transaction, returns whether it was committed"""
+        started = time.perf_counter()
+        try:
+            with conn:
+                conn.execute("BEGIN")  # a new partition (table + view) is created in the same transaction
+                tables, expired = self.partitions.split(batch)
+                raw = [(row[0], row[1], row[5]) for rows in tables.values() for row in rows if len(row) > 5]
+                if raw:
+                    conn.executemany("INSERT OR REPLACE INTO bme280_raw (device_id, device_ts, adc) VALUES (?, ?, ?)", raw)
+                    tables = {table: [row[:5] for row in rows] for table, rows in tables.items()}
+                stored = [row for rows in tables.values() for row in rows]
+                for table, rows in tables.items():
+                    conn.executemany(f'''
+                        INSERT OR REPLACE INTO {table} (device_id, device_ts, temp_c, hum_pct, pres_hpa)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', rows)
+                # same transaction, the rollups never lag the raw rows
+                rollup.update(conn, stored, self._archived_neighbours(stored))
+            COMMIT_SECONDS.observe(time.perf_counter() - started)
+            COMMIT_ROWS.observe(len(stored))
+            WRITER_ROWS.inc(len(stored))
+            log.info(f"Stored {len(stored)} rows to DB")
+            if expired:
+                log.warning(f"Skipped {len(expired)} rows older than the retention horizon")
+            if self.ring:
+                self.ring.append_many(stored)
+            committed = True
+        except sqlite3.Error as e:
+            self.partitions.reload()  # a partition created in the failed transaction is gone again
+            WRITER_ERRORS.inc()
+            log.error(f"Database error, {len(batch)} rows not stored:", e)
+            committed = False
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            log.warning(f"Writer queue full, dropped {dropped} rows (policy: {self.drop_policy})")
+        return committed
+
+    def _archived_neighbours(self, rows):
+        """
+        Archived readings in the minute buckets of the late `rows` of an archived month: its
+        recreated partition only holds the late ones, the rollups have to count both.
+        """
+        newest_start = self.partitions.bounds[-1][0]  # the newest partition is never archived
+        old = [row for row in rows if row[1] < newest_start]
+        last = self.archive.last_ts() if old else None
+        if last is None:
+            return []
+        res = min(rollup.ROLLUPS)
+        buckets = {}
+        for row in old:
+            if row[1] <= last:
+                buckets.setdefault(row[0], set()).add(row[1] // res * res)
+        neighbours = []
+        for device_id, minutes in buckets.items():
+            dev, ts, temp_c, hum_pct, pres_hpa = self.archive.read(min(minutes), max(minutes) + res - 1, device_id)
+            neighbours += [r for r in zip(dev.tolist(), ts.tolist(), temp_c.tolist(), hum_pct.tolist(), pres_hpa.tolist())
+                           if r[1] // res * res in minutes]
+        return neighbours
+
+    def _store_calibration(self, conn, device_id, block):
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO bme280_calibration (device_id, since_ts, calib) VALUES (?, ?, ?)",
+                             (device_id, int(time.time()), block))
+            log.info(f"Stored the BME280 calibration of {device_id}")
+        except sqlite3.Error as e:
+            log.error(f"Database error, calibration of {device_id} not stored:", e)
+
+    def _maintain(self, conn):
+        """
+        One maintenance step: a vacuum step while pages are free, else archive one partition,
+        else apply retention. Returns when to run the next one.
+        """
+        try:
+            if conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                left = storage.incremental_vacuum(conn, VACUUM_STEP_PAGES)
+                if left:
+                    return time.monotonic() + VACUUM_STEP_PAUSE_S
+                log.info("Incremental vacuum done")
+                return time.monotonic()
+            if self.archive_s:
+                archived = self.partitions.archive_oldest(self.archive_dir, self.archive_s)
+                if archived:
+                    log.info(f"Archived {archived[1]} readings of {archived[0]} to {self.archive_dir}/")
+                    return time.monotonic()
+            if self.retention_s:
+                dropped = self.partitions.prune(self.retention_s)
+                expired = archive.Archive(self.archive_dir).expire(time.time() - self.retention_s)
+                if dropped or expired:
+                    log.info(f"Retention: dropped {', '.join(dropped + [f'{name}{archive.SUFFIX}' for name in expired])}")
+                    return time.monotonic()
+        except (sqlite3.Error, OSError) as e:
+            self.partitions.reload()
+            log.error("Retention failed:", e)
+        return time.monotonic() + PRUNE_INTERVAL_S
+
+    def run(self):
+        conn = storage.open_db(self.db_file, "writer-full" if self.durable else "writer")
+        self.partitions = storage.Partitions(conn)
+
+        batch = []
+        acks = []  # mids of the QoS 1 messages whose rows are in `batch`
+        deadline = 0
+        retry_s, retry_at = 0, 0  # backoff of a failed commit holding QoS 1 messages
+        maintain = self.retention_s or self.archive_s
+        maintain_at = time.monotonic() if maintain else float("inf")
+        while True:
+            if batch:
+                timeout = max(0, max(deadline, retry_at) - time.monotonic())
+            else:
+                timeout = max(0, maintain_at - time.monotonic()) if maintain else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+            if item is not None and item[0] is _CALIBRATION:
+                self._store_calibration(conn, *item[1:])
+                item = None
+            if item is not None and item[0] is _ACK:
+                _, mid, rows = item
+                if rows and not batch:
+                    deadline = time.monotonic() + self.flush_s
+                batch.extend(rows)
+                acks.append(mid)
+                item = None
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_s
+                batch.append(item)
+
+            if batch and time.monotonic() >= retry_at and (len(batch) >= self.batch_size or len(acks) >= self.ack_window // 2
+                                                           or time.monotonic() >= deadline):
+                if self._commit(conn, batch) or not acks:
+                    batch = []
+                    retry_s = 0
+                else:
+                    # keep the rows and their unacknowledged mids: the broker sends them again if the Pi stops first
+                    retry_s = min(retry_s * 2 or 1, COMMIT_RETRY_MAX_S)
+                    retry_at = time.monotonic() + retry_s
+                    log.warning(f"{len(acks)} QoS 1 messages stay unacknowledged, retrying the commit in {retry_s}s")
+            if acks and not batch:
+                for mid in acks:
+                    self.ack(mid)
+                acks = []
+            if not batch and time.monotonic() >= maintain_at:
+                maintain_at = self._maintain(conn)
+
+        if not batch or self._commit(conn, batch):
+            for mid in acks:
+                self.ack(mid)
+        conn.close()
+
+def start_ring_buffer(capacity):
+    """
+    Create the shared-memory ring buffer and seed it with the newest rows from the DB,
+    so webapp.py can serve recent windows from it right away.
+    """
+    path = ringbuf.DEFAULT_PATH  # webapp.py maps the same file
+    try:
+        ring = ringbuf.RingWriter(path, capacity)
+    except OSError as e:
+        log.warning(f"Ring buffer {path} not available, webapp.py will read SQLite only:", e)
+        return None
+    rows = storage.connection("writer", DB_FILE).execute("""
+        SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa
+        FROM bme280_data ORDER BY device_ts DESC LIMIT ?
+    """, (capacity + 1,)).fetchall()
+    # one row more than fits tells whether the ring holds everything the DB has
+    ring.seed(rows[:capacity][::-1], complete=len(rows) <= capacity)
+    log.info(f"Ring buffer {path}: {capacity} readings, seeded with {min(len(rows), capacity)}")
+    return ring
+# ============ END DB WRITER ============
+
+
 # ============ MQTT ============
 def on_connect(client, userdata, flags, rc):
     """
     Callback function for when the MQTT client connects to the broker.
     """
     log.success("Connected to MQTT broker", client._host, "with result code", rc)
-    client.subscribe(ARGS.mqtt_topic)
+    client.subscribe(ARGS.mqtt_topic, qos=ARGS.mqtt_qos)
 
 def on_message(client, userdata, msg):
     """
     Callback function for when a message is received from the MQTT broker.
+    Only parses the payload and hands the row to the IngestWriter (`userdata`),
+    the paho network thread never touches the database.
+    The device id is the last level of the topic, e.g. iot/bme280/<device_id>.
+    The rows of a QoS 1 message go to the writer together with its mid, it acknowledges the
+    message once they are committed (malformed and dropped messages right away).
+    A payload is either binary (see payload.py: compensated readings, raw readouts compensated
+    here with compensate.py, or a calibration block) or JSON: one reading, or an array of
+    readings when an ESP replays its backlog.
     """
+    rows = []
+    MQTT_RECEIVED.inc()
     try:
-        payload = json.loads(msg.payload.decode('utf-8'))
-        log.info("Received message:", payload)
-        device_ts = int(payload["device_ts"])
-        temp_c    = float(payload["temp_c"])
-        hum_pct   = float(payload["hum_pct"])
-        pres_hpa  = float(payload["pres_hpa"])
-
-        # Store data in SQLite database
-        conn = sqlite3.connect('bme280_data.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO bme280_data (device_ts, temp_c, hum_pct, pres_hpa)
-            VALUES (?, ?, ?, ?)
-        ''', (device_ts, temp_c, hum_pct, pres_hpa))
-        conn.commit()
-        conn.close()
-        
-        log.info("Stored to DB\n")
+        device_id = msg.topic.rsplit("/", 1)[-1]
+        if payload.is_binary(msg.payload):
+            sender, version, records = payload.decode(msg.payload)
+            if sender != device_id:
+                log.warning(f"Dropped payload of {sender} published under {device_id}")
+                MQTT_REJECTED.labels("sender").inc()
+                return
+            if version == payload.VERSION_CALIBRATION:
+                MQTT_PARSED.labels("calibration").inc()
+                if userdata.put_calibration(device_id, records):
+                    log.info(f"Received the BME280 calibration of {device_id}")
+                return
+            if version == payload.VERSION_RAW:
+                calibration = userdata.calibrations.get(device_id)
+                ts, adc = records
+                if calibration is None:
+                    log.warning(f"Dropped {len(ts)} raw readings of {device_id}, no calibration received yet")
+                    MQTT_REJECTED.labels("no_calibration").inc()
+                    return
+                # compensated in one vectorized pass, the readout is stored along for reprocessing
+                rows = [row + (readout,) for row, readout in
+                        zip(compensate.rows(calibration, ts, adc), (a.tobytes() for a in adc))]
+                MQTT_PARSED.labels("raw").inc()
+            else:
+                rows = records
+                MQTT_PARSED.labels("readings").inc()
+        else:
+            readings = json.loads(msg.payload.decode('utf-8'))
+            if not isinstance(readings, list):
+                readings = [readings]
+            rows = [(int(reading["device_ts"]), float(reading["temp_c"]),
+                     float(reading["hum_pct"]), float(reading["pres_hpa"])) for reading in readings]
+            MQTT_PARSED.labels("json").inc()
+        MQTT_READINGS.inc(len(rows))
+        if len(rows) == 1:
+            log.debug(f"Received message from {device_id}:", rows[0][:4])
+        else:
+            log.debug(f"Received {len(rows)} buffered readings from {device_id}")
+
+        if not msg.qos:
+            for row in rows:
+                userdata.put((device_id,) + row)
 
-    except (KeyError, ValueError) as e:
-        log.error("Bad payload fields:", e)
     except json.JSONDecodeError as e:
+        MQTT_REJECTED.labels("json").inc()
         log.error("Failed to decode JSON message:", e)
-    except sqlite3.Error as e:
-        log.error("Database error:", e)
+    except (KeyError, TypeError, ValueError) as e:
+        MQTT_REJECTED.labels("payload").inc()
+        log.error("Bad payload fields:", e)
+    finally:
+        if msg.qos:
+            userdata.put_ack(msg.mid, [(device_id,) + row for row in rows])
+
+class AckAfterCommitClient(mqtt.Client):
+    """
+    paho client that leaves acknowledging QoS 1 messages to `ack`, called by the IngestWriter
+    once their rows are committed, instead of acknowledging them as soon as on_message returns.
+    paho-mqtt 1.x (azure-iot-device requires < 2.0) has no manual acks yet, so this holds back the
+    PUBACK it sends after on_message. A message never acknowledged (the Pi stopped before the commit)
+    is sent again by the broker when the persistent session resumes.
+    """
+
+    def _send_puback(self, mid):
+        return mqtt.MQTT_ERR_SUCCESS  # sent by ack()
 
-def start_mqtt_background():
-    client = mqtt.Client(client_id="raspberrypi-client")
+    def ack(self, mid):
+        """Send the PUBACK of `mid`, callable from any thread"""
+        return mqtt.Client._send_puback(self, mid)
+
+def start_mqtt_background(writer):
+    if ARGS.mqtt_qos:
+        # persistent session under the stable client id: the broker keeps messages for us while we are away
+        client = AckAfterCommitClient(client_id=ARGS.mqtt_client_id, clean_session=False, userdata=writer)
+        writer.ack = client.ack
+    else:
+        client = mqtt.Client(client_id=ARGS.mqtt_client_id, userdata=writer)
     if ARGS.mqtt_user:
         client.username_pw_set(ARGS.mqtt_user, ARGS.mqtt_pass)
     client.on_connect = on_connect
     client.on_message = on_message
-    log.info(f"MQTT connect -> {ARGS.mqtt_host}:{ARGS.mqtt_port}, topic='{ARGS.mqtt_topic}'")
+    log.info(f"MQTT connect -> {ARGS.mqtt_host}:{ARGS.mqtt_port}, topic='{ARGS.mqtt_topic}', QoS {ARGS.mqtt_qos}")
     client.connect(ARGS.mqtt_host, ARGS.mqtt_port, 60)
     client.loop_start()
     
@@ -162,25 +616,408 @@ def make_device_client(conn_string):
     log.success("Connected to IoT Hub")
     return dc    
 
-def send_message(device_client: IoTHubDeviceClient, message):
-    telemetry = Message(json.dumps(message))
+SEND_ERRORS = (ConnectionFailedError, ConnectionDroppedError, OperationTimeout, OperationCancelled, NoConnectionError)
+IOTHUB_MAX_MESSAGE_BYTES = 255 * 1024  # IoT Hub caps messages at 256 KB, leave room for the properties
+
+# Tier -> (messages/day per unit, min device-to-cloud sends/s, sends/s per unit, metering unit in bytes).
+# The daily quota counts a message once per started metering unit: 150 bytes cost as much as 4 KB.
+IOTHUB_TIERS = {
+    "F1": (8000, 100, 0, 512),
+    "B1": (400000, 100, 12, 4096), "S1": (400000, 100, 12, 4096),
+    "B2": (6000000, 0, 120, 4096), "S2": (6000000, 0, 120, 4096),
+    "B3": (300000000, 0, 6000, 4096), "S3": (300000000, 0, 6000, 4096),
+}
+UNIT_BYTES = IOTHUB_TIERS[ARGS.hub_tier][3] if ARGS.hub_tier in IOTHUB_TIERS else 4096
+UNIT_HEADROOM = 128  # bytes of a message's last unit left for the properties metered with the body
+
+def metered_units(size):
+    """Metering units a message body of `size` bytes counts for against the daily quota"""
+    return max(1, -(-(size + UNIT_HEADROOM) // UNIT_BYTES))
+
+def batch_size():
+    """
+    --batch-bytes, cut down to whole metering units (minus the headroom), so packed messages
+    never pay a whole unit for a few bytes past a boundary.
+    """
+    size = min(ARGS.batch_bytes, IOTHUB_MAX_MESSAGE_BYTES)
+    units = size // UNIT_BYTES
+    return units * UNIT_BYTES - UNIT_HEADROOM if units else size
+
+class Pacer:
+    """
+    Token buckets keeping the uplink within the hub tier (IOTHUB_TIERS, times `units` and `share`):
+    sends per second with a burst of one second, and metering units per day, spread evenly over
+    the day with at most `burst_s` seconds of it saved up. A backlog after an outage goes out at
+    the throttling limit until the saved-up quota is spent, then at the daily rate. (The hub resets
+    its quota at midnight UTC, an even spread never runs into that.)
+
+    `reserve` takes the tokens of one message and returns the seconds to wait before sending it.
+    The buckets may go below zero, the wait grows instead, so concurrent senders queue up in order.
+    """
+
+    def __init__(self, tier, units=1, share=1.0, burst_s=3600):
+        per_day, min_per_s, per_s, _ = IOTHUB_TIERS[tier]
+        share = min(max(share, 0.001), 1.0)
+        self.send_rate = max(min_per_s, per_s * units) * share
+        self.quota_rate = per_day * units * share / 86400
+        self.send_burst = max(1.0, self.send_rate)
+        self.quota_burst = max(self.quota_rate * burst_s, metered_units(IOTHUB_MAX_MESSAGE_BYTES))
+        self.sends, self.quota = self.send_burst, self.quota_burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units=1):
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self.stamp = now - self.stamp, now
+            self.sends = min(self.send_burst, self.sends + elapsed * self.send_rate) - 1
+            self.quota = min(self.quota_burst, self.quota + elapsed * self.quota_rate) - units
+            return max(0.0, -self.sends / self.send_rate, -self.quota / self.quota_rate)
+
+def make_pacer():
+    """The Pacer for --hub-tier, None with --hub-tier none"""
+    if ARGS.hub_tier not in IOTHUB_TIERS:
+        return None
+    pacer = Pacer(ARGS.hub_tier, max(1, ARGS.hub_units), ARGS.hub_share)
+    log.info(f"Pacing the uplink for {ARGS.hub_tier} x{max(1, ARGS.hub_units)}: {pacer.send_rate:g} messages/s, "
+             f"{pacer.quota_rate * 86400:.0f} units of {UNIT_BYTES} bytes/day")
+    return pacer
+
+class Backoff:
+    """Waits between retries of a failing send: from `base` seconds doubling up to `cap`, each randomized by ±50%"""
+
+    def __init__(self, base=0.5, cap=30):
+        self.base = base
+        self.cap = cap
+        self.delay = base
+
+    def next(self):
+        delay = self.delay * (0.5 + random.random())
+        self.delay = min(self.delay * 2, self.cap)
+        return delay
+
+    def reset(self):
+        self.delay = self.base
+
+def make_message(device_id, device_ts, temp_c, hum_pct, pres_hpa):
+    """
+    Build the telemetry dict for a single reading, as sent in one-message-per-reading mode.
+    """
+    return {
+        "DeviceID": device_id,
+        "temperature": temp_c,
+        "humidity": hum_pct,
+        "pressure": pres_hpa,
+        "rasptimestamp": int(time.time()),  # current time in seconds since epoch
+        "device_ts": device_ts
+    }
+
+def pack_batches(device_id, rows, max_bytes):
+    """
+    Pack rows of one device (oldest-first) into JSON messages of at most `max_bytes` bytes:
+    {"DeviceID": ..., "rasptimestamp": ..., "readings": [{...}, ...]}
+    Yields `(last_device_ts, count, body)` per message, in order.
+    """
+    max_bytes = min(max_bytes, IOTHUB_MAX_MESSAGE_BYTES)
+    head = json.dumps({"DeviceID": device_id, "rasptimestamp": int(time.time())},
+                      separators=(",", ":"))[:-1] + ',"readings":['
+    tail = "]}"
+
+    readings, size, last_ts = [], len(head) + len(tail), None
+    for device_ts, temp_c, hum_pct, pres_hpa in rows:
+        reading = json.dumps({"temperature": temp_c, "humidity": hum_pct, "pressure": pres_hpa,
+                              "device_ts": device_ts}, separators=(",", ":"))
+        extra = len(reading) + (1 if readings else 0)  # comma between elements
+        if readings and size + extra > max_bytes:
+            yield last_ts, len(readings), head + ",".join(readings) + tail
+            readings, size = [], len(head) + len(tail)
+            extra = len(reading)
+        readings.append(reading)
+        size += extra
+        last_ts = device_ts
+    if readings:
+        yield last_ts, len(readings), head + ",".join(readings) + tail
+
+def iter_messages(device_id, rows):
+    """
+    Yield `(last_device_ts, count, message)` for rows of one device, in the given order,
+    either one message per reading or packed into batches (--batch-bytes, see batch_size).
+    """
+    if ARGS.batch_bytes:
+        return pack_batches(device_id, rows, batch_size())
+    return ((row[0], 1, make_message(device_id, *row)) for row in rows)
+
+def message_bytes(message):
+    """Size of the body of a telemetry dict or an already encoded batch"""
+    return len(message if isinstance(message, str) else json.dumps(message))
+
+sent_ahead = {}  # device_id -> device_ts of readings sent ahead of its watermark (see plan_messages), loaded by main
+live_due = {}  # device_id -> time.monotonic() its next message of newest readings is due
+
+def plan_messages(device_id, rows, watermark):
+    """
+    The messages for the pending `rows` of one device (oldest-first, newer than `watermark`) in
+    sending order, as `(watermark, count, message, ahead)`: the watermark the device reaches once
+    this message and every one before it is sent, or None for a message sent ahead of the
+    watermark, whose readings' device_ts are `ahead` (to store with set_sent_ahead once it is sent).
+    A None message only moves the watermark over readings that were sent ahead.
+
+    A device with more than one message pending (catching up after an outage, or held back by
+    the pacer) first gets its newest readings sent, at most one unit of them every --time, so the
+    cloud sees live values while the backlog fills in oldest-first. The backfill skips readings
+    sent ahead and the watermark moves over them once everything before them is sent. They are
+    stored in uplink_sent_ahead until then, so a restart does not send them twice (a send
+    acknowledged right before a crash, before it was stored, is still sent again).
+    """
+    ahead = sent_ahead.setdefault(device_id, set())
+    ahead.difference_update([ts for ts in ahead if ts <= watermark])
+    backlog = [row for row in rows if row[0] not in ahead]
+    plan = []
+
+    now = time.monotonic()
+    if len(list(itertools.islice(iter_messages(device_id, backlog), 2))) > 1 and now >= live_due.get(device_id, 0):
+        live_due[device_id] = now + ARGS.time / 1000
+        newest = fetch_newest_rows(device_id, max(ahead, default=watermark), UNIT_BYTES // 32)  # more than fit in a unit
+        if newest:
+            if ARGS.batch_bytes:
+                size = min(batch_size(), UNIT_BYTES - UNIT_HEADROOM)
+                _, count, _ = next(pack_batches(device_id, newest, size))
+                _, count, message = next(pack_batches(device_id, newest[:count][::-1], size))
+            else:
+                count, message = 1, make_message(device_id, *newest[0])
+            sent = tuple(row[0] for row in newest[:count])
+            ahead.update(sent)
+            plan.append((None, count, message, sent))
+            backlog = [row for row in backlog if row[0] not in ahead]
+
+    position = {row[0]: i for i, row in enumerate(rows)}
+    for last_ts, count, message in iter_messages(device_id, backlog):
+        i = position[last_ts]
+        while i + 1 < len(rows) and rows[i + 1][0] in ahead:  # and past the readings sent ahead right after it
+            i += 1
+        plan.append((rows[i][0], count, message, ()))
+    if not backlog and rows:
+        plan.append((rows[-1][0], 0, None, ()))  # every pending reading went ahead already
+    return plan
+
+def sending_order(plans):
+    """
+    Yield `(device_id, watermark, count, message, ahead)` from `(device_id, plan)` pairs (see
+    plan_messages): the newest readings of every device first, then each device's backlog oldest-first.
+    """
+    for first in (True, False):
+        for device_id, plan in plans:
+            for watermark, count, message, ahead in plan:
+                if (watermark is None) == first:
+                    yield device_id, watermark, count, message, ahead
+
+def make_telemetry(message):
+    """
+    Wrap a telemetry dict, or an already encoded batch body, in an IoT Hub Message.
+    """
+    telemetry = Message(message if isinstance(message, str) else json.dumps(message))
     telemetry.content_encoding = "utf-8"
     telemetry.content_type = "application/json"
+    return telemetry
+
+def send_message(device_client: IoTHubDeviceClient, message, count=1):
+    """
+    Send a telemetry dict, or an already encoded batch body holding `count` readings.
+    """
+    telemetry = make_telemetry(message)
     
     try:
+        started = time.perf_counter()
         device_client.send_message(telemetry)
-        log.success("Message sent to IoT Hub", message)
+        IOTHUB_SECONDS.observe(time.perf_counter() - started)
+        IOTHUB_MESSAGES.inc()
+        IOTHUB_READINGS.inc(count)
+        IOTHUB_UNITS.inc(metered_units(len(telemetry.data)))
+        if count == 1:
+            log.debug("Message sent to IoT Hub", message)
+        else:
+            log.success(f"Batch of {count} readings sent to IoT Hub")
         return True
     
-    except (ConnectionFailedError, ConnectionDroppedError, OperationTimeout, OperationCancelled, NoConnectionError):
-        log.warning("Message failed to send, skipping")
+    except SEND_ERRORS as e:
+        IOTHUB_FAILURES.labels(type(e).__name__).inc()
+        log.warning(f"Message failed to send ({type(e).__name__})")
         return False
+
+def send_pending(device_client, pending, last_sent, pacer=None, backoff=None):
+    """
+    Send pending `(device_id, rows)` with the sync client (or just print them with --no-send) in
+    the order of plan_messages, advancing `last_sent` and the stored sync state per message.
+    Sends wait for the `pacer`; a failed send or reconnect is retried after the `backoff` wait,
+    throttling included, until it goes through.
+    Returns the client to use next round.
+    """
+    backoff = backoff or Backoff()
+    plans = [(device_id, plan_messages(device_id, rows, last_sent.get(device_id, 0))) for device_id, rows in pending]
+    for device_id, watermark, count, message, ahead in sending_order(plans):
+        if message is None:
+            pass
+        elif ARGS.no_send:
+            if count == 1:
+                log.warning("Not sending to IoTHub", message)
+            else:
+                log.warning(f"Not sending batch of {count} readings from {device_id} to IoTHub")
+        else:
+            if pacer:
+                wait = pacer.reserve(metered_units(message_bytes(message)))
+                if wait:
+                    UPLINK_PACED.inc(wait)
+                    time.sleep(wait)
+            while True:
+                if device_client is None:
+                    try:
+                        device_client = make_device_client(ARGS.connection)
+                    except Exception as e:
+                        delay = backoff.next()
+                        log.warning(f"IoT Hub reconnect failed, retrying in {delay:.1f}s:", e)
+                        time.sleep(delay)
+                        continue
+                if send_message(device_client, message, count):
+                    backoff.reset()
+                    break
+                # drop the client (a throttled or broken connection), wait and reconnect
+                try:
+                    device_client.shutdown()
+                except Exception:
+                    pass
+                device_client = None
+                delay = backoff.next()
+                log.info(f"Retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+            if not ARGS.batch_bytes and pacer is None:
+                time.sleep(0.05)
+
+        # advance the watermark once per message (so once per batch), record readings sent ahead
+        if watermark is not None:
+            last_sent[device_id] = watermark
+            set_sync_state(device_id, watermark)
+        elif not ARGS.no_send:
+            set_sent_ahead(device_id, ahead)
+    return device_client
+
 # ============ END Azure IoT Hub ============
 
+# ============ Async uplink ============
+
+class AsyncUplink:
+    """
+    Sends messages with `azure.iot.device.aio`, keeping up to `inflight` of them
+    unacknowledged at once, so a slow link costs one round-trip per window instead of per message.
+
+    Sends complete out of order, but a device's `last_sync_ts` only moves to its newest message
+    whose predecessors are all acknowledged. A failed send is retried (with backoff)
+    in its own slot, so the watermark can never skip past it. Sends wait for the `pacer`.
+    """
+
+    def __init__(self, conn_string, inflight=8, pacer=None):
+        self.conn_string = conn_string
+        self.inflight = max(1, inflight)
+        self.pacer = pacer
+        self.client = None
+        self._reconnect_lock = asyncio.Lock()
+
+    async def connect(self):
+        from azure.iot.device.aio import IoTHubDeviceClient as AsyncIoTHubDeviceClient
+        self.client = AsyncIoTHubDeviceClient.create_from_connection_string(self.conn_string, connection_retry=False)
+        await self.client.connect()
+        log.success(f"Connected to IoT Hub (async, {self.inflight} in flight)")
+
+    async def shutdown(self):
+        if self.client:
+            await self.client.shutdown()
+
+    async def _reconnect(self):
+        # Only one task reconnects, the others wait for it and then simply retry their send
+        async with self._reconnect_lock:
+            if self.client.connected:
+                return
+            try:
+                await self.client.connect()
+                log.success("Reconnected to IoT Hub")
+            except Exception as e:
+                log.warning("IoT Hub reconnect failed; will retry later:", e)
+
+    async def _send(self, message, count, window):
+        async with window:
+            units = metered_units(message_bytes(message))
+            if self.pacer:
+                wait = self.pacer.reserve(units)
+                if wait:
+                    UPLINK_PACED.inc(wait)
+                    await asyncio.sleep(wait)
+            backoff = Backoff()
+            while True:
+                try:
+                    started = time.perf_counter()
+                    await self.client.send_message(make_telemetry(message))
+                    IOTHUB_SECONDS.observe(time.perf_counter() - started)
+                    IOTHUB_MESSAGES.inc()
+                    IOTHUB_READINGS.inc(count)
+                    IOTHUB_UNITS.inc(units)
+                    return
+                except SEND_ERRORS as e:
+                    IOTHUB_FAILURES.labels(type(e).__name__).inc()
+                    delay = backoff.next()
+                    log.warning(f"Send of {count} readings failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    await self._reconnect()
+
+    async def _advance(self, device_id, tasks, last_sent):
+        # Tasks are in plan order (see plan_messages); awaiting them in that order walks the contiguous acknowledged prefix
+        for i, (watermark, task, ahead) in enumerate(tasks):
+            if task is not None:
+                await task
+            if watermark is None:
+                await asyncio.to_thread(set_sent_ahead, device_id, ahead)  # newest readings, sent ahead of the watermark
+                continue
+            last_sent[device_id] = watermark
+            # persist once the prefix stops growing instead of after every single ack
+            following = tasks[i + 1][1] if i + 1 < len(tasks) else None
+            if i + 1 == len(tasks) or (following is not None and not following.done()):
+                await asyncio.to_thread(set_sync_state, device_id, watermark)
+
+    async def drain(self, pending, last_sent):
+        """
+        Send all pending `(device_id, rows)` and advance the `last_sent` watermarks in place.
+        Every message is retried until acknowledged, `set_sync_state` is only called when
+        the contiguously acknowledged prefix of a device grows.
+        """
+        window = asyncio.Semaphore(self.inflight)  # shared by all devices, taken in the order the sends ask
+        plans = [(device_id, plan_messages(device_id, rows, last_sent.get(device_id, 0))) for device_id, rows in pending]
+        per_device = {device_id: [] for device_id, _ in plans}
+        for device_id, watermark, count, message, ahead in sending_order(plans):
+            task = asyncio.create_task(self._send(message, count, window)) if message is not None else None
+            per_device[device_id].append((watermark, task, ahead))
+        await asyncio.gather(*(self._advance(device_id, tasks, last_sent) for device_id, tasks in per_device.items()))
+
+        readings = sum(len(rows) for _, rows in pending)
+        messages = sum(task is not None for tasks in per_device.values() for _, task, _ in tasks)
+        log.success(f"Sent {readings} readings from {len(pending)} devices in {messages} messages to IoT Hub")
+
+    async def run(self, last_sent):
+        await self.connect()
+        try:
+            while True:
+                pending = await asyncio.to_thread(fetch_rows_newer_than, last_sent)
+                if pending:
+                    await self.drain(pending, last_sent)
+                # a device with more than a round of backlog goes on right away, the pacer sets the rate
+                if not any(len(rows) >= FETCH_LIMIT for _, rows in pending):
+                    await asyncio.sleep(ARGS.time / 1000)
+        finally:
+            await self.shutdown()
+# ============ END Async uplink ============
+
 # ============ Main ============
 def main():
     if not ARGS.connection and not ARGS.no_send:  # If no argument
-        log.error("IOTHUB_DEVICE_CONNECTION_STRING in config.py variable or argument not found, try supplying one as an argument or setting it in config.py")
+        log.error("IOTHUB_DEVICE_CONNECTION_STRING in config.py variable or argument not found, try supplying one as an argument or setting it in config.py", exit_after=True)
     if not ARGS.mqtt_host or not ARGS.mqtt_port:
         log.error("MQTT host or port not set, use --mqtt-host and --mqtt-port arguments to set them or config.py")
         return
@@ -195,10 +1032,37 @@ def main():
 
     setup_database()  # Ensure the database is set up
 
-    # Start MQTT client in background
-    mqtt_client = start_mqtt_background()
+    ring = start_ring_buffer(ARGS.ring_capacity) if ARGS.ring_capacity > 0 else None
+
+    # Start the DB writer, then the MQTT client feeding it in background
+    drop_policy = ARGS.writer_drop
+    if ARGS.mqtt_qos and drop_policy != "block":
+        log.info(f"QoS 1 ingest never drops readings: writer drop policy 'block' instead of '{drop_policy}'")
+        drop_policy = "block"
+    writer = IngestWriter(DB_FILE, ARGS.writer_batch, ARGS.writer_flush, ARGS.writer_queue, drop_policy, ring,
+                          ARGS.retention_days, ARGS.archive_days, ack_window=ARGS.mqtt_inflight,
+                          durable=bool(ARGS.mqtt_qos))
+    writer.start()
+    if ARGS.metrics_port:
+        start_metrics_server(writer)
+    mqtt_client = start_mqtt_background(writer)
+
+    # Main loop: read rows newer than each device's last_sent_ts and send (or just print if --no-send)
+    last_sent = get_sync_state()  # device_id -> last_sent_ts, unknown devices start at 0
+    sent_ahead.update(storage.sent_ahead(storage.connection("writer", DB_FILE)))
+
+    if ARGS.async_send and not ARGS.no_send:
+        log.info("Starting async sender loop; last_sent_ts =", dict(last_sent))
+        try:
+            asyncio.run(AsyncUplink(ARGS.connection, ARGS.inflight, make_pacer()).run(last_sent))
+        except KeyboardInterrupt:
+            log.error("Shutting down")
+            mqtt_client.loop_stop()
+            writer.stop()
+        return
 
     # setup iot hub client if not in no_send mode
+    device_client = None
     if not ARGS.no_send:
         try:
             device_client = make_device_client(ARGS.connection)
@@ -206,66 +1070,32 @@ def main():
             log.error("Failed to connect to IoT Hub:", e)
             return
         
-    # Main loop: read rows newer than last_sent_ts and send (or just print if --no-send)
-    last_sent_ts = get_sync_state() or 0  # Default to 0 if no state found
-    log.info("Starting sender loop; last_sent_ts =", last_sent_ts)
+    pacer = make_pacer() if not ARGS.no_send else None
+    backoff = Backoff()
+    log.info("Starting sender loop; last_sent_ts =", dict(last_sent))
 
     try:
         while True:
-            rows = fetch_rows_newer_than(last_sent_ts)
-            if not rows:
+            pending = fetch_rows_newer_than(last_sent)
+            if not pending:
                 # nothing new → just wait for the configured interval
                 time.sleep(ARGS.time / 1000)
                 continue
 
-            # send oldest-first
-            for device_ts, temp_c, hum_pct, pres_hpa in rows:
-                message = {
-                    "DeviceID": "raspberrypi-client",
-                    "temperature": temp_c,
-                    "humidity": hum_pct,
-                    "pressure": pres_hpa,
-                    "rasptimestamp": int(time.time()),  # current time in seconds since epoch
-                    "device_ts": device_ts
-                }
-
-                if ARGS.no_send:
-                    log.warning("Not sending to IoTHub", message)
-                    # Still advance last_sent_ts (since your criterion is time-based)
-                    last_sent_ts = device_ts
-                    set_sync_state(last_sent_ts)
-                else:
-                    if device_client is None:
-                        # try reconnect once
-                        try:
-                            device_client = make_device_client(ARGS.connection)
-                        except Exception as e:
-                            log.warning("IoT Hub reconnect failed; will retry later:", e)
-                            break  # leave loop to sleep then retry
-
-                    # send; on success, advance watermark
-                    if send_message(device_client, message):
-                        last_sent_ts = device_ts
-                        set_sync_state(last_sent_ts)
-                    else:
-                        # send failed → drop the client so next loop tries reconnect
-                        try:
-                            device_client.shutdown()
-                        except Exception:
-                            pass
-                        device_client = None
-                        # break to back off
-                        break
-
-                time.sleep(0.05)
+            device_client = send_pending(device_client, pending, last_sent, pacer, backoff)
 
-            # wait per your MESSAGE_TIMESPAN/--time before next DB check
-            time.sleep(ARGS.time / 1000)
+            # wait per your MESSAGE_TIMESPAN/--time before next DB check, unless a device has more
+            # than a round of backlog: then the pacer sets the rate
+            if not any(len(rows) >= FETCH_LIMIT for _, rows in pending):
+                time.sleep(ARGS.time / 1000)
 
     except KeyboardInterrupt:
         # Shut down the device client when Ctrl+C is pressed
-        log.error("Shutting down", exit_after=False)
-        device_client.shutdown()
+        log.error("Shutting down")
+        mqtt_client.loop_stop()
+        writer.stop()
+        if device_client:
+            device_client.shutdown()
 
 
 if __name__ == "__main__":
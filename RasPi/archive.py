@@ -0,0 +1,271 @@
+#!/bin/python3
+"""
+Compressed columnar archive for closed partitions of bme280_data.
+
+One file per partition (archive/<partition>.bma), written by app.py's ingest writer once the
+partition is old and synced, after which the partition table is dropped. webapp.py reads the
+files through `Archive` and merges them with the rows still in SQLite, including late readings
+that recreated the partition of an archived month until it is archived again.
+
+File layout (little-endian):
+  blocks, back to back: up to BLOCK_ROWS readings of one device, ascending device_ts
+      uint32 rows, then per column (ts, temp_c, hum_pct, pres_hpa): uint8 codec, uint8 param,
+      uint32 length, `length` bytes
+  index: one entry per block: 24 bytes device_id, int64 first_ts, int64 last_ts, uint32 rows,
+      uint64 offset, uint32 length
+  footer, 16 bytes: uint64 index offset, uint32 block count, magic "BMEA"
+
+Column codecs, all lossless and vectorized with NumPy, every payload byte-shuffled (byte i of
+every value together) and zlib compressed:
+  DOD      timestamps: delta-of-delta, zigzag. A steady cadence leaves only zeros.
+  XOR      floats: every value XORed with the previous one (Gorilla-style), unchanged leading
+           sign/exponent/mantissa bits become zero bytes
+  DECIMAL  floats that are exactly n / 10**param (the ESP sends float32 readings as short
+           decimal strings): delta of n, zigzag. Checked bit for bit, else XOR is used.
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import numpy as np
+
+BLOCK_ROWS = 8192  # readings per block, about a day at a 10 s cadence
+SUFFIX = ".bma"
+MAGIC = b"BMEA"
+
+DOD, XOR, DECIMAL = 1, 2, 3
+MAX_DECIMALS = 6
+
+_ROWS = struct.Struct("<I")
+_COLUMN = struct.Struct("<BBI")
+_ENTRY = struct.Struct("<24sqqIQI")
+_FOOTER = struct.Struct("<QI4s")
+
+
+# ---- codecs ----
+def _shuffle(a):
+    return zlib.compress(np.ascontiguousarray(a.view(np.uint8).reshape(-1, 8).T).tobytes(), 6)
+
+def _unshuffle(data, n):
+    return np.ascontiguousarray(np.frombuffer(zlib.decompress(data), np.uint8).reshape(8, n).T).view(np.int64).ravel()
+
+def _zigzag(a):
+    return (a << 1) ^ (a >> 63)
+
+def _unzigzag(z):
+    return (z.view(np.uint64) >> np.uint64(1)).view(np.int64) ^ -(z & 1)
+
+def encode_ts(ts):
+    # first value, first delta, then delta-of-delta; two cumsums undo it
+    return DOD, 0, _shuffle(_zigzag(np.diff(np.diff(ts, prepend=0), prepend=0)))
+
+def encode_values(v):
+    bits = v.view(np.int64)
+    for k in range(MAX_DECIMALS + 1):
+        n = np.rint(v * 10.0 ** k)
+        if np.all(np.abs(n) < 2 ** 53) and np.array_equal((n / 10.0 ** k).view(np.int64), bits):
+            return DECIMAL, k, _shuffle(_zigzag(np.diff(n.astype(np.int64), prepend=0)))
+    return XOR, 0, _shuffle(bits ^ np.concatenate(([0], bits[:-1])))
+
+def decode(codec, param, data, n):
+    a = _unshuffle(data, n)
+    if codec == DOD:
+        return np.cumsum(np.cumsum(_unzigzag(a)))
+    if codec == DECIMAL:
+        return np.cumsum(_unzigzag(a)) / 10.0 ** param
+    if codec == XOR:
+        return np.bitwise_xor.accumulate(a).view(np.float64)
+    raise ValueError(f"unknown codec {codec}")
+
+
+# ---- writing ----
+def _block(ts, values):
+    parts = [_ROWS.pack(len(ts))]
+    for codec, param, data in [encode_ts(np.asarray(ts, dtype=np.int64))] + \
+                              [encode_values(np.asarray(v, dtype=np.float64)) for v in values]:
+        parts.append(_COLUMN.pack(codec, param, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+def write(path, rows):
+    """
+    Write `(device_id, device_ts, temp_c, hum_pct, pres_hpa)` rows, ordered by (device_id, device_ts),
+    to an archive file. The file appears under `path` only once it is complete and on disk.
+    Returns the number of readings written.
+    """
+    tmp = path + ".tmp"
+    index, count = [], 0
+    with open(tmp, "wb") as f:
+        def flush(device_id, chunk):
+            cols = list(zip(*chunk))
+            body = _block(cols[1], cols[2:])
+            index.append(_ENTRY.pack(device_id.encode()[:24], cols[1][0], cols[1][-1], len(chunk), f.tell(), len(body)))
+            f.write(body)
+
+        device, chunk = None, []
+        for row in rows:
+            if row[0] != device or len(chunk) == BLOCK_ROWS:
+                if chunk:
+                    flush(device, chunk)
+                device, chunk = row[0], []
+            chunk.append(row)
+            count += 1
+        if chunk:
+            flush(device, chunk)
+        offset = f.tell()
+        f.write(b"".join(index))
+        f.write(_FOOTER.pack(offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+# ---- reading ----
+class ArchiveFile:
+    """One archive file; the block index is read once, blocks on demand"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            offset, blocks, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an archive file")
+            f.seek(offset)
+            raw = f.read(blocks * _ENTRY.size)
+        self.index = [(device.rstrip(b"\0").decode(), first, last, rows, off, length)
+                      for device, first, last, rows, off, length in _ENTRY.iter_unpack(raw)]
+        self.first_ts = min((e[1] for e in self.index), default=None)
+        self.last_ts = max((e[2] for e in self.index), default=None)
+
+    def read(self, since_unix=None, until_unix=None, device=None):
+        """(device_id, [ts, temp_c, hum_pct, pres_hpa] arrays) per block holding matching readings"""
+        out = []
+        with open(self.path, "rb") as f:
+            for device_id, first, last, rows, off, length in self.index:
+                if (device is not None and device_id != device) or \
+                        (since_unix is not None and last < since_unix) or (until_unix is not None and first > until_unix):
+                    continue
+                f.seek(off)
+                buf, pos = f.read(length), _ROWS.size
+                cols = []
+                for _ in range(4):
+                    codec, param, size = _COLUMN.unpack_from(buf, pos)
+                    pos += _COLUMN.size
+                    cols.append(decode(codec, param, buf[pos:pos + size], rows))
+                    pos += size
+                lo = np.searchsorted(cols[0], since_unix, "left") if since_unix is not None else 0
+                hi = np.searchsorted(cols[0], until_unix, "right") if until_unix is not None else rows
+                if hi > lo:
+                    out.append((device_id, [c[lo:hi] for c in cols]))
+        return out
+
+class Archive:
+    """The archive directory. Files are cached by name and mtime, so new ones are picked up."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def path(self, partition):
+        return os.path.join(self.directory, partition + SUFFIX)
+
+    def partitions(self):
+        """{partition name: ArchiveFile} of every complete file"""
+        try:
+            names = sorted(n for n in os.listdir(self.directory) if n.endswith(SUFFIX))
+        except FileNotFoundError:
+            return {}
+        current = {}
+        for name in names:
+            path = os.path.join(self.directory, name)
+            mtime = os.stat(path).st_mtime_ns
+            cached = self.files.get(name)
+            if cached is None or cached[0] != mtime:
+                cached = self.files[name] = (mtime, ArchiveFile(path))
+            current[name[:-len(SUFFIX)]] = cached[1]
+        self.files = {name: self.files[name] for name in (p + SUFFIX for p in current)}
+        return current
+
+    def last_ts(self):
+        """Newest archived device_ts, None if nothing is archived"""
+        return max((f.last_ts for f in self.partitions().values() if f.last_ts is not None), default=None)
+
+    def read(self, since_unix=None, until_unix=None, device=None):
+        """
+        Column arrays (device_id, ts, temp_c, hum_pct, pres_hpa) of the archived readings in
+        [since, until], ordered by (ts, device_id). SQLite may hold readings of the same months
+        too (late ones, or a partition archived but not dropped yet), the caller merges them.
+        """
+        blocks = [block for f in self.partitions().values()
+                  if f.first_ts is not None
+                  and (since_unix is None or f.last_ts >= since_unix) and (until_unix is None or f.first_ts <= until_unix)
+                  for block in f.read(since_unix, until_unix, device)]
+        # devices as small integer codes for the sort, strings only in the result
+        devices = sorted({device_id for device_id, _ in blocks})
+        codes = np.concatenate([np.full(len(cols[0]), devices.index(device_id), dtype=np.int32)
+                                for device_id, cols in blocks] or [np.array([], dtype=np.int32)])
+        cols = [np.concatenate([c[i] for _, c in blocks] or [np.array([], dtype=np.int64 if i == 0 else np.float64)])
+                for i in range(4)]
+        order = np.lexsort((codes, cols[0]))
+        return [np.array(devices, dtype=object)[codes[order]] if devices else np.array([], dtype=object)] + \
+               [c[order] for c in cols]
+
+    def expire(self, before_unix):
+        """Delete the files holding only readings before `before_unix`, returns their partition names"""
+        gone = [name for name, f in self.partitions().items() if f.last_ts is None or f.last_ts < before_unix]
+        for name in gone:
+            os.remove(self.path(name))
+        self.partitions()
+        return gone
+
+
+if __name__ == "__main__":
+    # Size and scan benchmark: one year of 10 s readings of one device, archive vs SQLite table
+    # usage: python3 archive.py [days]
+    import sqlite3
+    import tempfile
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+    n = days * 8640
+    rng = np.random.default_rng(0)
+    ts = 1700000000 + np.arange(n, dtype=np.int64) * 10 + (rng.random(n) < 0.01)  # some jitter
+    day = 2 * np.pi * np.arange(n) / 8640
+    # what the ESP sends: BME280 resolution, float32 printed as a short decimal string
+    temp = np.round(20 + 4 * np.sin(day) + np.cumsum(rng.normal(0, 0.01, n)) % 3, 2)
+    hum = np.array([float(f"{v:.7g}") for v in (50 + 10 * np.cos(day) + rng.normal(0, 0.05, n)).astype(np.float32)])
+    pres = np.array([float(f"{v:.7g}") for v in (101325 + np.cumsum(rng.normal(0, 1, n)) % 500).astype(np.float32)])
+    rows = list(zip(["esp32"] * n, ts.tolist(), temp.tolist(), hum.tolist(), pres.tolist()))
+
+    with tempfile.TemporaryDirectory() as d:
+        db = sqlite3.connect(os.path.join(d, "bench.db"))
+        db.execute("""CREATE TABLE bme280_data (device_id TEXT NOT NULL, device_ts INTEGER NOT NULL, temp_c REAL NOT NULL,
+                      hum_pct REAL NOT NULL, pres_hpa REAL NOT NULL, PRIMARY KEY (device_id, device_ts)) WITHOUT ROWID""")
+        db.execute("CREATE INDEX idx_bme280_data_ts ON bme280_data (device_ts)")
+        db.executemany("INSERT INTO bme280_data VALUES (?, ?, ?, ?, ?)", rows)
+        db.commit()
+        db.execute("VACUUM")
+        db_bytes = os.path.getsize(os.path.join(d, "bench.db"))
+
+        path = os.path.join(d, "bench" + SUFFIX)
+        t = time.perf_counter()
+        write(path, rows)
+        write_s = time.perf_counter() - t
+        arc_bytes = os.path.getsize(path)
+
+        t = time.perf_counter()
+        got = db.execute("SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM bme280_data ORDER BY device_ts").fetchall()
+        sqlite_s = time.perf_counter() - t
+        t = time.perf_counter()
+        cols = Archive(d).read()
+        archive_s = time.perf_counter() - t
+
+        assert np.array_equal(cols[1], ts) and all(np.array_equal(c.view(np.int64), v.view(np.int64))
+                                                   for c, v in zip(cols[2:], (temp, hum, pres)))
+        assert len(got) == n
+        print(f"{n:,} readings ({days} days)")
+        print(f"  SQLite table+index {db_bytes / 2**20:7.2f} MiB  {db_bytes / n:5.1f} B/reading  full scan {sqlite_s * 1000:7.1f} ms")
+        print(f"  archive            {arc_bytes / 2**20:7.2f} MiB  {arc_bytes / n:5.1f} B/reading  full scan {archive_s * 1000:7.1f} ms"
+              f"  (written in {write_s * 1000:.0f} ms)")
+        print(f"  {db_bytes / arc_bytes:.1f}x smaller, scan {sqlite_s / archive_s:.1f}x faster")
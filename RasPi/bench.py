@@ -0,0 +1,485 @@
+#!/bin/python3
+"""
+Benchmarks of ingest, the IoT Hub uplink and the dashboard API, written to JSON so a run can
+be compared with the one of another commit:
+
+    python3 bench.py -r 1M 10M                       -> bench-<commit>.json
+    python3 bench.py -c bench-1a2b3c4d.json bench-5e6f7a8b.json
+
+  ingest  rows/s from `on_message` until the IngestWriter committed them, into an empty
+          database, per payload shape (binary single reading, binary 16 reading batch, JSON)
+          and with QoS 1 ack-after-commit
+  sender  readings/s `send_pending` and `AsyncUplink.drain` hand to a stub IoT Hub client that
+          takes `--latency` ms per message, per --batch-bytes
+  api     p50/p99 latency of /api/latest and /api/series for every `last=` window, through the
+          Flask test client, with the response cache emptied before every request (cold) and
+          filled (warm); SQLite only, without ring buffer or archive. Fails if format=columnar
+          is not streamed, or a conditional request leaves its read transaction open
+
+The api and sender benchmarks run against a synthetic database per `--rows` size: `--devices`
+virtual ESPs reading every `--interval` seconds up to a fixed end time, signals as simulator.py
+makes them but generated with NumPy a partition at a time, loaded with the ts index dropped
+and the journal off, rollups rebuilt once at the end. The databases are kept in `--data-dir`
+and reused by later runs with the same parameters; 100M rows take about 12 GB.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import sqlite3
+import argparse
+import platform
+import itertools
+import contextlib
+import subprocess
+import types
+import numpy as np
+import rollup
+import storage
+import simulator
+from log import console, log
+
+END_TS = 1767225600  # 2026-01-01 UTC, the newest reading of every bench database and the API's "now"
+WINDOWS = ["15m", "1h", "6h", "24h", "7d"]  # the dashboard's ?last= choices
+DASHBOARD_POINTS = 1000  # max_points of the dashboard's binary chart query, about a chart's width
+SIZE_UNITS = {"k": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}
+
+
+def parse_size(text):
+    """'100k', '10M' or '250000' -> number of rows"""
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send the rich console (log.py) to /dev/null: app.py logs every message it handles"""
+    saved = console.file
+    with open(os.devnull, "w") as devnull:
+        console.file = devnull
+        try:
+            yield
+        finally:
+            log.flush()  # app.py logs from a background thread
+            console.file = saved
+
+
+def latency_stats(seconds):
+    p50, p99 = simulator.percentiles(seconds, (50, 99))
+    return {"p50_ms": round(p50 * 1000, 3), "p99_ms": round(p99 * 1000, 3), "requests": len(seconds)}
+
+
+def git_state():
+    """(commit sha, whether the tree has uncommitted changes), (None, None) outside a git checkout"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                                capture_output=True, text=True, check=True).stdout
+        return sha, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+# ---- synthetic databases ----
+def devices(count, seed):
+    """The virtual ESPs of simulator.py: ids and per-device signal parameters"""
+    weather = simulator.Weather(seed, END_TS - 5 * 365 * 86400, END_TS)
+    return [simulator.VirtualDevice(i, seed, weather) for i in range(count)]
+
+
+def signals(device, ts, rng):
+    """
+    VirtualDevice.reading over the int64 array `ts` at once: (temp_c, hum_pct, pres) float arrays,
+    pressure in Pa like the ESPs send it. The drift is a sum of slow sines instead of an AR(1)
+    process, which cannot be vectorized.
+    """
+    cycle = np.cos(2 * np.pi * ((ts % 86400) - device.warmest) / 86400)
+    drift = sum(0.25 * np.sin(2 * np.pi * ts / period + phase)
+                for period, phase in zip(rng.uniform(2, 9, 3) * 3600, rng.uniform(0, 2 * np.pi, 3)))
+    temp = device.temp_base + device.temp_swing * cycle + drift + rng.normal(0, 0.02, len(ts))
+    hum = np.clip(device.hum_base - 2.5 * (temp - device.temp_base) + rng.normal(0, 0.3, len(ts)), 0, 100)
+    pres = 101325 + device.altitude_pa + rng.normal(0, 3, len(ts))
+    for start, duration, depth in device.weather.fronts:
+        i, j = np.searchsorted(ts, (start, start + duration))
+        if i < j:
+            pres[i:j] += depth * 0.5 * (1 - np.cos(2 * np.pi * (ts[i:j] - start) / duration))
+    # float32 on the ESP
+    return temp.astype(np.float32), hum.astype(np.float32), pres.astype(np.float32)
+
+
+def db_path(args, rows):
+    return os.path.join(args.data_dir, f"bench-{rows}r-{args.devices}d-{args.interval}s-seed{args.seed}.db")
+
+
+def build_db(args, rows):
+    """
+    Generate the database of `rows` readings unless it exists. Returns (path, seconds it took to
+    build, 0 if it was reused). Written under a temporary name, an interrupted build is never reused.
+    """
+    path = db_path(args, rows)
+    if os.path.exists(path):
+        with quiet():
+            storage.setup(path)  # built by an older schema version
+        return path, 0.0
+    os.makedirs(args.data_dir, exist_ok=True)
+    partial = path + ".partial"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(partial + suffix):
+            os.remove(partial + suffix)
+
+    started = time.perf_counter()
+    with quiet():
+        storage.setup(partial)
+    conn = storage.open_db(partial, "writer")
+    conn.execute("PRAGMA journal_mode=OFF")  # a failed build is thrown away, nothing to roll back
+    conn.execute("PRAGMA synchronous=OFF")
+    partitions = storage.Partitions(conn)
+    fleet = devices(args.devices, args.seed)
+    # every device ends at END_TS, offset by a few seconds so the devices do not read in lockstep
+    counts = [rows // args.devices + (i < rows % args.devices) for i in range(args.devices)]
+    firsts = [END_TS - (i % args.interval) - (n - 1) * args.interval for i, n in enumerate(counts)]
+
+    start = storage.partition_bounds(min(firsts))[0]
+    written = 0
+    while start <= END_TS:
+        end = storage.partition_bounds(start)[1]
+        with conn:
+            table = partitions.table_for(start)
+            # one sorted index build after the load instead of an index insert per row
+            conn.execute(f"DROP INDEX IF EXISTS idx_{table}_ts")
+            for i, (device, first, n) in enumerate(zip(fleet, firsts, counts)):
+                last = first + (n - 1) * args.interval
+                lo = max(first, first + -(-(start - first) // args.interval) * args.interval)
+                if n == 0 or lo >= end or lo > last:
+                    continue
+                ts = np.arange(lo, min(end, last + 1), args.interval, dtype=np.int64)
+                temp, hum, pres = signals(device, ts, np.random.default_rng([args.seed, i, start]))
+                # device-major, ascending ts: every insert appends to the primary key b-tree
+                conn.executemany(f"INSERT INTO {table} (device_id, device_ts, temp_c, hum_pct, pres_hpa) VALUES (?, ?, ?, ?, ?)",
+                                 zip(itertools.repeat(device.device_id), ts.tolist(), temp.tolist(), hum.tolist(), pres.tolist()))
+                written += len(ts)
+            conn.execute(f"CREATE INDEX idx_{table}_ts ON {table} (device_ts)")
+        log.info(f"{os.path.basename(path)}: {table} done, {written}/{rows} rows")
+        start = end
+    with conn:
+        rollup.rebuild(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+    os.replace(partial, path)
+    return path, time.perf_counter() - started
+
+
+# ---- ingest ----
+def import_app():
+    """app.py parses its command line on import: import it as `app.py -n`"""
+    argv, sys.argv = sys.argv, ["app.py", "-n"]
+    try:
+        import app
+    finally:
+        sys.argv = argv
+    return app
+
+
+def ingest_messages(args, shape, per_message):
+    """`--messages` MQTT messages of `per_message` readings each, round robin over the devices"""
+    fleet = devices(args.devices, args.seed)
+    rng = np.random.default_rng(args.seed)
+    ts = END_TS + np.arange(per_message * (args.messages // args.devices + 1), dtype=np.int64) * args.interval
+    columns = {device.device_id: signals(device, ts, rng) for device in fleet}
+    prefix = simulator.topic_prefix()
+    messages = []
+    for k in range(args.messages):
+        device = fleet[k % len(fleet)]
+        i = (k // len(fleet)) * per_message
+        temp, hum, pres = (c[i:i + per_message].tolist() for c in columns[device.device_id])
+        batch = list(zip(ts[i:i + per_message].tolist(), temp, hum, pres))
+        messages.append(types.SimpleNamespace(topic=f"{prefix}/{device.device_id}", payload=simulator.encode(device.device_id, batch, shape),
+                                              qos=0, mid=k % 65535 + 1))
+    return messages
+
+
+def bench_ingest(args, app, workdir):
+    cases = [("binary", 1, 0), ("binary", 16, 0), ("json", 1, 0), ("json", 16, 0), ("binary", 1, 1)]
+    results = {}
+    for shape, per_message, qos in cases:
+        name = f"{shape}-{per_message}" + ("-qos1" if qos else "")
+        messages = ingest_messages(args, shape, per_message)
+        for msg in messages:
+            msg.qos = qos
+        path = os.path.join(workdir, f"ingest-{name}.db")
+        acked = []
+        with quiet():
+            storage.setup(path)
+            writer = app.IngestWriter(path, app.ARGS.writer_batch, app.ARGS.writer_flush, app.ARGS.writer_queue, "block",
+                                      ack=acked.append, ack_window=app.ARGS.mqtt_inflight, durable=bool(qos))
+            writer.start()
+            started = time.perf_counter()
+            for msg in messages:
+                app.on_message(None, writer, msg)
+            handled = time.perf_counter() - started
+            writer.stop()
+            elapsed = time.perf_counter() - started
+        conn = storage.open_db(path, "reader")
+        stored = conn.execute("SELECT COUNT(*) FROM bme280_data").fetchone()[0]
+        conn.close()
+        readings = len(messages) * per_message
+        if stored != readings or (qos and len(acked) != len(messages)):
+            log.warning(f"ingest {name}: {stored}/{readings} rows stored, {len(acked)} acks")
+        results[name] = {"messages": len(messages), "readings": readings, "stored": stored,
+                         "on_message_per_s": round(len(messages) / handled, 1), "rows_per_s": round(stored / elapsed, 1)}
+        log.info(f"ingest {name}: {results[name]['rows_per_s']:.0f} rows/s")
+    return results
+
+
+# ---- uplink ----
+class StubHub:
+    """IoTHubDeviceClient stand-in: every send takes `latency` seconds and succeeds"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.connected = True
+
+    def send_message(self, message):
+        time.sleep(self.latency)
+        self.sent += 1
+
+    def shutdown(self):
+        self.connected = False
+
+
+class AsyncStubHub(StubHub):
+    """azure.iot.device.aio stand-in: sends overlap, each takes `latency` seconds"""
+
+    async def send_message(self, message):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+    async def connect(self):
+        self.connected = True
+
+    async def shutdown(self):
+        self.connected = False
+
+
+def clear_sync_state(db_file):
+    conn = storage.open_db(db_file, "writer")
+    with conn:
+        conn.execute("DELETE FROM sync_state WHERE key LIKE 'last_sync_ts:%'")
+        conn.execute("DELETE FROM uplink_sent_ahead")
+    conn.close()
+
+
+def bench_sender(args, app, path):
+    """
+    One sender round from a database nothing was synced from: up to 5000 readings per device.
+    One message per reading is paced at 20 messages/s by app.py itself, so it only sends a sample.
+    """
+    app.DB_FILE = path
+    app.ARGS.no_send = False
+    latency = args.latency / 1000
+    results = {}
+    for batch_bytes in args.batch_bytes:
+        app.ARGS.batch_bytes = batch_bytes
+        for mode in ("sync", "async"):
+            clear_sync_state(path)
+            app.sent_ahead.clear()
+            app.live_due.clear()
+            started = time.perf_counter()
+            pending = app.fetch_rows_newer_than({})
+            fetched = time.perf_counter() - started
+            if not batch_bytes:
+                pending = [(pending[0][0], pending[0][1][:args.sample])] if pending else []
+            readings = sum(len(rows) for _, rows in pending)
+            last_sent = {}
+            with quiet():
+                started = time.perf_counter()
+                if mode == "sync":
+                    hub = StubHub(latency)
+                    app.send_pending(hub, pending, last_sent)
+                else:
+                    uplink = app.AsyncUplink(None, app.ARGS.inflight)
+                    hub = uplink.client = AsyncStubHub(latency)
+                    asyncio.run(uplink.drain(pending, last_sent))
+                elapsed = time.perf_counter() - started
+            name = f"{mode}-{batch_bytes}b"
+            results[name] = {"readings": readings, "messages": hub.sent, "fetch_ms": round(fetched * 1000, 3),
+                             "readings_per_s": round(readings / elapsed, 1), "messages_per_s": round(hub.sent / elapsed, 1)}
+            log.info(f"sender {name}: {results[name]['readings_per_s']:.0f} readings/s in {hub.sent} messages")
+    clear_sync_state(path)
+    return results
+
+
+# ---- dashboard API ----
+class FrozenClock:
+    """Stands in for webapp.py's `time` module: time() is the end of the bench data, the rest is time's"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return float(self.now)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def import_webapp(workdir):
+    import webapp
+    from ringbuf import RingReader
+    from archive import Archive
+    webapp.ring = RingReader(os.path.join(workdir, "no-ring"))  # never opens: every query goes to SQLite
+    webapp.archive = Archive(os.path.join(workdir, "no-archive"))
+    webapp.time = FrozenClock(END_TS)
+    return webapp
+
+
+def bench_api(args, webapp, path):
+    webapp.DB_FILE = path
+    if webapp._version_conn is not None:
+        webapp._version_conn.close()
+        webapp._version_conn = None
+    client = webapp.app.test_client()
+    headers = {"Accept-Encoding": "gzip"}  # like a browser: compression is part of the cost
+
+    def measure(url):
+        result = {}
+        for mode in ("cold", "warm"):
+            webapp.response_cache = webapp.ResponseCache()
+            if mode == "warm":
+                client.get(url, headers=headers).get_data()
+            seconds, size = [], 0
+            for _ in range(args.requests):
+                if mode == "cold":
+                    webapp.response_cache = webapp.ResponseCache()
+                started = time.perf_counter()
+                resp = client.get(url, headers=headers)
+                size = len(resp.get_data())
+                seconds.append(time.perf_counter() - started)
+                if resp.status_code != 200:
+                    log.error(f"{url} answered {resp.status_code}: {resp.get_data()[:200]}", exit_after=True)
+            result[mode] = latency_stats(seconds)
+        result["bytes"] = size
+        log.info(f"{url}: p50 {result['cold']['p50_ms']:.2f} ms cold, {result['warm']['p50_ms']:.2f} ms warm")
+        return result
+
+    # format=columnar|binary must reach the server as a stream, and a 304 or HEAD must not leave its
+    # read transaction open on the thread's connection (the next request would fail)
+    url = f"/api/series?format=columnar&last={WINDOWS[0]}&resolution=raw"
+    resp = client.get(url, headers=headers, buffered=False)
+    if "Content-Length" in resp.headers:
+        log.error(f"{url} was buffered instead of streamed", exit_after=True)
+    resp.get_data()
+    for method, extra in (("GET", {"If-None-Match": resp.headers["ETag"]}), ("HEAD", {}), ("GET", {})):
+        status = client.open(url, method=method, headers=dict(headers, **extra)).status_code
+        if status not in (200, 304):
+            log.error(f"{method} {url} answered {status} after a conditional request", exit_after=True)
+
+    results = {"latest": measure("/api/latest"), "series": {}, "series_binary": {}}
+    for window in WINDOWS:
+        results["series"][window] = measure(f"/api/series?last={window}")
+        results["series_binary"][window] = measure(f"/api/series?format=binary&last={window}&max_points={DASHBOARD_POINTS}")
+    return results
+
+
+# ---- results ----
+def flatten(tree, prefix=""):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(old_file, new_file, threshold):
+    """
+    Print every rate and latency of two result files with its change, a regression is worse than
+    `threshold` percent: a rate (`*_per_s`) lower or a latency (`*_ms`) higher. Returns the exit status.
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"{old_file}: {old['commit']}{' (dirty)' if old['dirty'] else ''}  ->  {new_file}: {new['commit']}{' (dirty)' if new['dirty'] else ''}")
+    before = dict(flatten(old["results"]))
+    regressions = 0
+    for key, value in flatten(new["results"]):
+        higher_better = key.endswith("_per_s")
+        if key not in before or not (higher_better or key.endswith("_ms")) or not before[key]:
+            continue
+        change = (value - before[key]) / before[key] * 100
+        worse = -change if higher_better else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif -worse > threshold:
+            flag = "  better"
+        print(f"{key:55s} {before[key]:12.3f} {value:12.3f} {change:+8.1f}%{flag}")
+    print(f"{regressions} regressions beyond {threshold}%")
+    return 1 if regressions else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, uplink and dashboard API, results as JSON")
+    parser.add_argument("-r", "--rows", nargs="+", default=["1M"], help="Sizes of the bench databases, e.g. 1M 10M 100M (default: 1M)")
+    parser.add_argument("-d", "--devices", type=int, default=10, help="Devices in the bench databases and the ingest messages (default: 10)")
+    parser.add_argument("-i", "--interval", type=int, default=10, help="Seconds between the readings of a device (default: 10, like the ESP)")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="Seed of the generated readings (default: 1)")
+    parser.add_argument("-dd", "--data-dir", type=str, default="bench_data", help="Where the bench databases are kept between runs (default: bench_data)")
+    parser.add_argument("-m", "--messages", type=int, default=20000, help="MQTT messages per ingest case (default: 20000)")
+    parser.add_argument("-n", "--requests", type=int, default=50, help="Requests per API query and cache state (default: 50)")
+    parser.add_argument("-l", "--latency", type=float, default=20, help="Milliseconds the stub IoT Hub client takes per message (default: 20)")
+    parser.add_argument("-b", "--batch-bytes", type=int, nargs="+", default=[0, 65536], help="--batch-bytes of app.py to run the sender with, 0 is a message per reading (default: 0 65536)")
+    parser.add_argument("-sa", "--sample", type=int, default=40, help="Readings sent with one message per reading, paced at 20/s by app.py (default: 40)")
+    parser.add_argument("-sk", "--skip", nargs="+", choices=["ingest", "sender", "api"], default=[], help="Benchmarks not to run")
+    parser.add_argument("-o", "--output", type=str, help="Result file (default: bench-<commit>.json)")
+    parser.add_argument("-c", "--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of benchmarking")
+    parser.add_argument("-th", "--threshold", type=float, default=10, help="Change in percent reported as a regression by --compare, which then exits with 1 (default: 10)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    if ARGS.compare:
+        sys.exit(compare(*ARGS.compare, ARGS.threshold))
+
+    sha, dirty = git_state()
+    output = ARGS.output or f"bench-{(sha or 'nogit')[:8]}{'-dirty' if dirty else ''}.json"
+    result = {
+        "commit": sha, "dirty": dirty, "created": int(time.time()),
+        "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "numpy": np.__version__,
+        "machine": platform.machine(), "cpus": os.cpu_count(),
+        "params": {key: value for key, value in vars(ARGS).items() if key not in ("compare", "output", "threshold")},
+        "results": {},
+    }
+    workdir = os.path.join(ARGS.data_dir, f"work-{os.getpid()}")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        app = import_app() if {"ingest", "sender"} - set(ARGS.skip) else None
+        if "ingest" not in ARGS.skip:
+            result["results"]["ingest"] = bench_ingest(ARGS, app, workdir)
+        log.configure(rate=0)  # measured with app.py's log settings, but this script's own lines all count
+        webapp = import_webapp(workdir) if "api" not in ARGS.skip else None
+        for size in ARGS.rows:
+            rows = parse_size(size)
+            if {"sender", "api"} <= set(ARGS.skip):
+                break
+            path, built = build_db(ARGS, rows)
+            entry = result["results"].setdefault(size, {"rows": rows, "db_bytes": os.path.getsize(path)})
+            if built:
+                entry["build_s"] = round(built, 1)
+            if "sender" not in ARGS.skip:
+                entry["sender"] = bench_sender(ARGS, app, path)
+            if webapp is not None:
+                entry["api"] = bench_api(ARGS, webapp, path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(result, f, indent=1)
+    log.success(f"Results written to {output}")
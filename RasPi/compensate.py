@@ -0,0 +1,222 @@
+#!/bin/python3
+"""
+BME280 compensation on the Pi, for ESPs publishing raw ADC readouts (PAYLOAD_FORMAT = "raw"
+in ESP/main.py, payload version 2) instead of compensated floats.
+
+The ESP publishes its calibration registers once per MQTT session (retained, payload version 3)
+and every reading as the 8 byte burst readout of registers 0xF7..0xFE. `compensate` runs the
+floating point formulas of ESP/bme280.py `read_compensated_data` over a whole batch with NumPy,
+in float32 and in the driver's order of operations: MicroPython on the ESP32 computes in single
+precision with one rounding per operation, so the results are bit-identical to what the ESP
+would have sent (`python3 compensate.py` checks that against the driver itself). Every constant
+is cast to float32 here, so `compensate` does not depend on NumPy's scalar promotion rules.
+
+The raw readouts are kept in bme280_raw (see storage.py), so history can be recomputed when
+this code changes: `python3 compensate.py reprocess [db_file]`.
+"""
+import sys
+import struct
+import numpy as np
+
+CALIBRATION_SIZE = 33  # registers 0x88..0xA1 (26 bytes), then 0xE1..0xE7 (7 bytes)
+READOUT_SIZE = 8
+
+F = np.float32
+
+
+class Calibration:
+    """The dig_* trimming parameters of one sensor, unpacked like ESP/bme280.py does, as float32"""
+
+    def __init__(self, block):
+        if len(block) != CALIBRATION_SIZE:
+            raise ValueError(f"calibration block is {len(block)} bytes, expected {CALIBRATION_SIZE}")
+        self.block = bytes(block)
+        (T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9,
+         _, H1) = struct.unpack("<HhhHhhhhhhhhBB", self.block[:26])
+        H2, H3, H4, H5, H6 = struct.unpack("<hBbhb", self.block[26:])
+        # unfold H4, H5, keeping care of a potential sign
+        H4 = (H4 * 16) + (H5 & 0xF)
+        H5 //= 16
+        for name, value in zip(("T1", "T2", "T3", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9",
+                                "H1", "H2", "H3", "H4", "H5", "H6"),
+                               (T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9, H1, H2, H3, H4, H5, H6)):
+            setattr(self, name, F(value))
+
+
+def unpack_readout(adc):
+    """Raw temperature, pressure and humidity ADC values (int32 arrays) of (n, 8) uint8 readouts"""
+    adc = np.asarray(adc, dtype=np.uint8).reshape(-1, READOUT_SIZE).astype(np.int32)
+    raw_press = ((adc[:, 0] << 16) | (adc[:, 1] << 8) | adc[:, 2]) >> 4
+    raw_temp = ((adc[:, 3] << 16) | (adc[:, 4] << 8) | adc[:, 5]) >> 4
+    raw_hum = (adc[:, 6] << 8) | adc[:, 7]
+    return raw_temp, raw_press, raw_hum
+
+
+def compensate(cal, adc):
+    """
+    (temp_c, pres, hum_pct) float32 arrays for (n, 8) uint8 readouts, in the units of
+    `read_compensated_data` (the ESP publishes its pressure, in Pa, as pres_hpa).
+    """
+    raw_temp, raw_press, raw_hum = (r.astype(F) for r in unpack_readout(adc))
+
+    # temperature
+    var1 = (raw_temp / F(16384.0) - cal.T1 / F(1024.0)) * cal.T2
+    var2 = raw_temp / F(131072.0) - cal.T1 / F(8192.0)
+    var2 = var2 * var2 * cal.T3
+    t_fine = (var1 + var2).astype(np.int32).astype(F)  # int() truncates towards zero
+    temp = (var1 + var2) / F(5120.0)
+    temp = np.maximum(F(-40), np.minimum(F(85), temp))
+
+    # pressure
+    var1 = (t_fine / F(2.0)) - F(64000.0)
+    var2 = var1 * var1 * cal.P6 / F(32768.0) + var1 * cal.P5 * F(2.0)
+    var2 = (var2 / F(4.0)) + (cal.P4 * F(65536.0))
+    var1 = (cal.P3 * var1 * var1 / F(524288.0) + cal.P2 * var1) / F(524288.0)
+    var1 = (F(1.0) + var1 / F(32768.0)) * cal.P1
+    zero = var1 == F(0.0)  # the driver returns 30000 instead of dividing by zero
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        p = ((F(1048576.0) - raw_press) - (var2 / F(4096.0))) * F(6250.0) / np.where(zero, F(1.0), var1)
+        var1 = cal.P9 * p * p / F(2147483648.0)
+        var2 = p * cal.P8 / F(32768.0)
+        pressure = p + (var1 + var2 + cal.P7) / F(16.0)
+    pressure = np.where(zero, F(30000), np.maximum(F(30000), np.minimum(F(110000), pressure)))
+
+    # humidity
+    h = t_fine - F(76800.0)
+    h = ((raw_hum - (cal.H4 * F(64.0) + cal.H5 / F(16384.0) * h)) *
+         (cal.H2 / F(65536.0) * (F(1.0) + cal.H6 / F(67108864.0) * h *
+                                 (F(1.0) + cal.H3 / F(67108864.0) * h))))
+    humidity = h * (F(1.0) - cal.H1 * h / F(524288.0))
+    humidity = np.where(humidity < 0, F(0), np.where(humidity > 100, F(100.0), humidity))
+
+    return temp, pressure, humidity
+
+
+def rows(cal, ts, adc):
+    """(device_ts, temp_c, hum_pct, pres_hpa) tuples for a batch, in the order the ingest path takes them"""
+    temp, pres, hum = compensate(cal, adc)
+    return list(zip(np.asarray(ts).tolist(), temp.tolist(), hum.tolist(), pres.tolist()))
+
+
+def reprocess(db_file):
+    """
+    Recompute every reading that has a raw readout in bme280_raw from it and the calibration
+    its device sent last before it (the oldest one for earlier readings), then rebuild the rollups.
+    """
+    import storage
+    import rollup
+    storage.setup(db_file)
+    conn = storage.open_db(db_file, "writer")
+    partitions = storage.Partitions(conn)
+    total = 0
+    with conn:
+        conn.execute("BEGIN")
+        for device_id in [r[0] for r in conn.execute("SELECT DISTINCT device_id FROM bme280_calibration")]:
+            cals = conn.execute("SELECT since_ts, calib FROM bme280_calibration WHERE device_id = ? ORDER BY since_ts",
+                                (device_id,)).fetchall()
+            raw = conn.execute("SELECT device_ts, adc FROM bme280_raw WHERE device_id = ? ORDER BY device_ts",
+                               (device_id,)).fetchall()
+            if not raw:
+                continue
+            ts = np.array([r[0] for r in raw], dtype=np.int64)
+            adc = np.frombuffer(b"".join(r[1] for r in raw), dtype=np.uint8).reshape(-1, READOUT_SIZE)
+            which = np.maximum(np.searchsorted([c[0] for c in cals], ts, side="right") - 1, 0)
+            out = []
+            for i, (_, block) in enumerate(cals):
+                sel = which == i
+                out += [(device_id,) + row for row in rows(Calibration(block), ts[sel], adc[sel])]
+            tables, _ = partitions.split(out)
+            for table, table_rows in tables.items():
+                conn.executemany(f"""
+                    INSERT OR REPLACE INTO {table} (device_id, device_ts, temp_c, hum_pct, pres_hpa)
+                    VALUES (?, ?, ?, ?, ?)
+                """, table_rows)
+                total += len(table_rows)
+        rollup.rebuild(conn, storage.rollup_floor(conn))
+    conn.close()
+    return total
+
+
+def _driver_reference(block, readouts):
+    """
+    Run ESP/bme280.py's own read_compensated_data on `readouts` with single precision arithmetic
+    like on the ESP32: calibration and ADC values are handed to it as float32 scalars, so every
+    operation of the driver rounds to float32. That needs NumPy 2 (NEP 50): NumPy 1.x turns
+    float32 scalar with Python float operations, all over the driver, into float64.
+    """
+    if int(np.__version__.split(".")[0]) < 2:
+        raise RuntimeError(f"the driver reference needs NumPy >= 2 scalar promotion, found {np.__version__}")
+    import os
+    import time
+    import types
+    import builtins
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ESP"))
+    sys.modules.setdefault("ustruct", struct)
+    builtins.const = getattr(builtins, "const", lambda x: x)
+    time.sleep_ms = getattr(time, "sleep_ms", lambda ms: None)
+    import bme280
+
+    class I2C:  # answers the calibration reads of the constructor
+        def readfrom_mem(self, address, reg, n):
+            return block[:26] if reg == 0x88 else block[26:] if reg == 0xE1 else b"\x00" * n
+        def writeto_mem(self, address, reg, buf):
+            pass
+
+    sensor = bme280.BME280(i2c=I2C())
+    for name in ("T1", "T2", "T3", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9",
+                 "H1", "H2", "H3", "H4", "H5", "H6"):
+        setattr(sensor, "dig_" + name, F(getattr(sensor, "dig_" + name)))
+    sensor.read_raw_data = types.MethodType(lambda self, result: None, sensor)  # reads _l3_resultarray as set below
+    out = np.empty((len(readouts), 3), dtype=F)
+    for i, raw in enumerate(zip(*unpack_readout(readouts))):
+        sensor._l3_resultarray = [F(v) for v in raw]
+        out[i] = sensor.read_compensated_data()
+    return out
+
+
+if __name__ == "__main__":
+    # usage: python3 compensate.py                     bit-identity check against ESP/bme280.py, and throughput
+    #        python3 compensate.py reprocess [db_file] recompute stored readings from their raw readouts
+    if len(sys.argv) > 1 and sys.argv[1] == "reprocess":
+        import storage
+        db_file = sys.argv[2] if len(sys.argv) > 2 else storage.DB_FILE
+        print(f"Recomputed {reprocess(db_file)} readings")
+        sys.exit()
+
+    import time
+    rng = np.random.default_rng(0)
+    # calibration registers of a real BME280, then a few random ones
+    blocks = [bytes.fromhex("706b4367 18fc7d8e 43d6d00b 270b8c00 f9ff8c3c f8c67017 004b 6a0100132b031e")]
+    for _ in range(4):
+        b = bytearray(rng.integers(0, 256, CALIBRATION_SIZE, dtype=np.uint8).tobytes())
+        struct.pack_into("<H", b, 0, int(rng.integers(27000, 29000)))   # dig_T1
+        struct.pack_into("<H", b, 6, int(rng.integers(36000, 38000)))   # dig_P1
+        blocks.append(bytes(b))
+
+    n = 20000
+    realistic = np.zeros((n, READOUT_SIZE), dtype=np.uint8)
+    press = rng.integers(0x40000, 0x60000, n) << 4
+    temp = rng.integers(0x70000, 0x88000, n) << 4
+    hum = rng.integers(0x5000, 0x9000, n)
+    realistic[:, 0], realistic[:, 1], realistic[:, 2] = press >> 16, (press >> 8) & 0xFF, press & 0xF0
+    realistic[:, 3], realistic[:, 4], realistic[:, 5] = temp >> 16, (temp >> 8) & 0xFF, temp & 0xF0
+    realistic[:, 6], realistic[:, 7] = hum >> 8, hum & 0xFF
+    full_range = rng.integers(0, 256, (n, READOUT_SIZE), dtype=np.uint8)
+
+    for block in blocks:
+        cal = Calibration(block)
+        for name, adc in (("realistic", realistic), ("full range", full_range)):
+            expected = _driver_reference(block, adc)
+            got = np.column_stack(compensate(cal, adc))
+            same = np.all(got.view(np.uint32) == expected.view(np.uint32), axis=1)
+            print(f"calibration {block[:4].hex()}.. {name:10s}: {same.sum()}/{n} readings bit-identical")
+            assert same.all(), (adc[~same][:3], got[~same][:3], expected[~same][:3])
+
+    adc = np.tile(realistic, (50, 1))
+    cal = Calibration(blocks[0])
+    best = float("inf")
+    for _ in range(5):
+        t = time.perf_counter()
+        compensate(cal, adc)
+        best = min(best, time.perf_counter() - t)
+    print(f"compensate: {len(adc) / best / 1e6:.1f} M readings/s")
@@ -9,4 +9,45 @@ SETUP_COMPLETED = True
 # MQTT broker info
 MQTT_HOST = "pi4b-iot"   # change to your Pi IP
 MQTT_PORT = 1883             # 1883 = no TLS
-MQTT_TOPIC = "iot/bme280/esp32"
\ No newline at end of file
+MQTT_TOPIC = "iot/bme280/+"     # last level is the device id, + subscribes to every device
+MQTT_CLIENT_ID = "raspberrypi-client"
+MQTT_QOS = 1                    # 1 = at-least-once: persistent session under MQTT_CLIENT_ID, messages acknowledged after their commit; 0 = at-most-once
+                                # (1 also fsyncs every commit, SQLite synchronous=FULL, so an acknowledged reading survives a power cut;
+                                # with 0 the last commits before a power cut can be lost)
+MQTT_INFLIGHT = 800             # QoS 1 messages the broker sends before waiting for acks (mosquitto/iot.conf: max_inflight_messages), keep it >= 4x WRITER_BATCH_SIZE
+LEGACY_DEVICE_ID = "esp32"      # device id given to rows stored before multi-device support
+
+# Ingest writer (MQTT -> SQLite)
+WRITER_BATCH_SIZE = 200       # max rows per commit
+WRITER_FLUSH_MS = 500         # max time a row waits before it is committed
+WRITER_QUEUE_LIMIT = 10000    # max rows waiting for the writer
+WRITER_DROP_POLICY = "newest" # when full: "newest" (drop incoming), "oldest" (drop oldest queued) or "block"
+
+# Storage: readings are kept in one table per month (or day); once synced, old ones are moved to
+# compressed archive files (~18x smaller, still served by webapp.py) and finally dropped
+PARTITION_SPAN = "month"      # "month" or "day"
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 31       # archive partitions older than this once all their rows are synced to IoT Hub, 0 disables
+RETENTION_DAYS = 0            # drop partitions and archive files older than this (synced rows only), 0 keeps everything
+
+# IoT Hub uplink
+UPLINK_BATCH_BYTES = 0        # 0 = one message per reading, otherwise max bytes per JSON-array message (IoT Hub limit: 256 KB),
+                              # cut down to whole metering units: 4096 fills one 4 KB unit per message (~50 readings instead of 1).
+                              # Batches need the Stream Analytics job of Azure/AnalyticsStreamJobBatched.sql
+UPLINK_ASYNC = False          # True = asyncio sender with UPLINK_INFLIGHT concurrent sends, False = one blocking send at a time
+UPLINK_INFLIGHT = 8           # max unacknowledged messages in async mode
+IOTHUB_TIER = "S1"            # hub tier pacing the uplink to its send rate and daily quota: "F1" (free, 8000 messages of 0.5 KB/day),
+                              # "S1"/"B1" (400000 of 4 KB per unit), "S2"/"B2", "S3"/"B3", "none" = unpaced
+IOTHUB_UNITS = 1              # units of the tier the hub runs
+IOTHUB_SHARE = 1.0            # share of the hub's quota for this Pi, lower it when other devices send to the same hub
+
+# Shared-memory ring buffer of recent readings (app.py writes, webapp.py reads)
+RING_CAPACITY = 131072        # readings (64 bytes each), 0 disables the ring
+
+# Prometheus metrics (see metrics.py): app.py serves them on this port, webapp.py at its own /metrics
+METRICS_PORT = 9108           # 0 disables
+
+# Console logging of app.py (see log.py)
+LOG_LEVEL = "info"            # "debug" adds a line per received and sent message
+LOG_FORMAT = "rich"           # "rich" (colors), "plain" or "json" (one object per line, for journald/log shippers)
+LOG_RATE = 5                  # max lines per second from one line of code, the rest is summarized, 0 = unlimited
@@ -0,0 +1,81 @@
+#!/bin/python3
+"""
+Largest-Triangle-Three-Buckets downsampling for chart series.
+
+The first and last points are always kept, the rest is split into equal buckets and
+from each bucket the point forming the largest triangle with the previously kept point
+and the average of the next bucket is kept. That preserves the visual peaks and troughs
+a plain stride or average would flatten.
+"""
+import time
+import numpy as np
+
+
+def lttb_indices(x, ys, n_out):
+    """
+    Indices of the points to keep when reducing `x` (ascending, length n) and the value
+    series `ys` (shape (k, n)) to `n_out` points. All series share one selection: the
+    triangle areas of each series are computed on a 0..1 scale and summed, so no single
+    series (e.g. pressure in Pa) dominates the choice.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    ys = np.atleast_2d(np.asarray(ys, dtype=np.float64))
+    x = (x - x[0]) / ((x[-1] - x[0]) or 1.0)
+    lo, span = ys.min(axis=1, keepdims=True), np.ptp(ys, axis=1, keepdims=True)
+    ys = (ys - lo) / np.where(span == 0, 1.0, span)
+
+    # n_out - 2 buckets over the points between the first and the last one
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    # average of every bucket (plus the last point as the "next bucket" of the final bucket)
+    avg_x = np.append(np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts, x[-1])
+    avg_y = np.column_stack([np.add.reduceat(ys[:, 1:n - 1], edges[:-1] - 1, axis=1) / counts, ys[:, -1]])
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        ax, ay = x[a], ys[:, a:a + 1]
+        cx, cy = avg_x[i + 1], avg_y[:, i + 1:i + 2]
+        area = np.abs((ax - cx) * (ys[:, start:stop] - ay) - (ax - x[start:stop]) * (cy - ay)).sum(axis=0)
+        a = start + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def downsample(rows, max_points, ts_col, value_cols):
+    """
+    Reduce fetched rows (tuples, ascending by `rows[i][ts_col]`) to at most `max_points`
+    rows with LTTB over the `value_cols` columns. Rows are returned untouched if they already fit.
+    """
+    if not max_points or len(rows) <= max_points:
+        return rows
+    cols = list(zip(*rows))
+    x = np.asarray(cols[ts_col], dtype=np.float64)
+    ys = np.asarray([cols[c] for c in value_cols], dtype=np.float64)
+    return [rows[i] for i in lttb_indices(x, ys, max_points)]
+
+
+if __name__ == "__main__":
+    # Throughput benchmark on 1M readings (10 s cadence, 3 series)
+    n = 1_000_000
+    rng = np.random.default_rng(0)
+    x = np.arange(n, dtype=np.float64) * 10
+    ys = np.vstack([
+        20 + 5 * np.sin(x / 86400 * 2 * np.pi) + rng.normal(0, 0.2, n),
+        55 + 10 * np.cos(x / 86400 * 2 * np.pi) + rng.normal(0, 0.5, n),
+        101325 + np.cumsum(rng.normal(0, 2, n)),
+    ])
+    for n_out in (300, 1000, 2000, 4000):
+        best = float("inf")
+        for _ in range(3):
+            t = time.perf_counter()
+            idx = lttb_indices(x, ys, n_out)
+            best = min(best, time.perf_counter() - t)
+        assert len(idx) == n_out and np.all(np.diff(idx) > 0)
+        print(f"LTTB {n:,} -> {n_out:>4} points: {best * 1000:7.1f} ms  ({n / best / 1e6:5.1f} M rows/s)")
@@ -1,24 +1,203 @@
+"""
+Console logging for the RasPi scripts: `log.info("Stored", n, "rows")` and friends.
+
+`log.configure` sets, usually from the command line (see app.py):
+  - the level: lines below it cost one comparison and are never formatted
+  - the format: "rich" (colored markup, the default), "plain" text or one JSON object per line,
+    both of which skip rich's rendering
+  - a rate limit per call site: at most `rate` lines per second from one line of code, the next
+    line that gets through says how many similar ones it stands for ("logged 1 of 500 similar")
+  - a background writer: lines go through a queue to a thread that renders and prints them, so
+    the caller never waits for the terminal. Arguments are rendered later on that thread, pass
+    values that do not change afterwards. When the queue is full lines are dropped and counted.
+
+Without `configure` every line is printed right away with rich, nothing is rate limited.
+`log.error` exits only when asked to (`exit_after=True`), after printing what is queued.
+"""
+import sys
+import json
+import time
+import queue
+import atexit
+import datetime
+import threading
 from rich.console import Console
+from rich.markup import render as render_markup
 
 console = Console()
 
+DEBUG, INFO, SUCCESS, WARNING, ERROR = 10, 20, 25, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "success": SUCCESS, "warning": WARNING, "error": ERROR}
+NAMES = {value: name for name, value in LEVELS.items()}
+PREFIXES = {
+    DEBUG: (r"\[[bright_black].[/bright_black]]", "[.]"),
+    INFO: (r"\[[bright_blue]*[/bright_blue]]", "[*]"),
+    SUCCESS: (r"\[[bright_green]+[/bright_green]]", "[+]"),
+    WARNING: (r"\[[bright_yellow]![/bright_yellow]]", "[!]"),
+    ERROR: (r"\[[bright_red]![/bright_red]]", "[!]"),
+}
+QUEUE_LIMIT = 10000  # lines waiting for the background writer
+
+
+class _Site:
+    """Rate limit state of one call site: lines let through in the current second, lines held back"""
+    __slots__ = ("second", "passed", "suppressed")
+
+    def __init__(self):
+        self.second = 0
+        self.passed = 0
+        self.suppressed = 0
+
+
+class _Logger:
+    def __init__(self):
+        self.level = INFO
+        self.format = "rich"
+        self.rate = 0  # lines per second per call site, 0 = unlimited
+        self.sites = {}  # (file, line) -> _Site
+        self.queue = None  # set while the background writer runs
+        self.thread = None
+        self.dropped = 0  # lines lost to a full queue, reported with the next line written
+
+    # ---- call site side ----
+    def emit(self, level, args, kwargs, depth=2):
+        similar = 1
+        if self.rate:
+            # lock-free: a race between two threads of one call site only blurs the counts
+            frame = sys._getframe(depth)
+            key = (frame.f_code.co_filename, frame.f_lineno)
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites.setdefault(key, _Site())
+            second = int(time.monotonic())
+            if second != site.second:
+                site.second, site.passed = second, 0
+            if site.passed >= self.rate:
+                site.suppressed += 1
+                return
+            site.passed += 1
+            similar, site.suppressed = site.suppressed + 1, 0
+        record = (level, time.time(), args, kwargs, similar)
+        if self.queue is None:
+            self.write(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # ---- writer side ----
+    def write(self, record):
+        level, ts, args, kwargs, similar = record
+        note = f"(logged 1 of {similar} similar)" if similar > 1 else None
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.write((WARNING, ts, (f"Log queue full, dropped {dropped} lines",), {}, 1))
+        if self.format == "rich":
+            console.print(PREFIXES[level][0], *args, *((f"[dim]{note}[/dim]",) if note else ()), **kwargs)
+            return
+        message = " ".join(self.plain(arg) for arg in args)
+        if self.format == "json":
+            line = {"ts": datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                    "level": NAMES[level], "message": message}
+            if similar > 1:
+                line["similar"] = similar
+            text = json.dumps(line)
+        else:
+            text = f"{PREFIXES[level][1]} {message}" + (f" {note}" if note else "")
+        print(text, file=console.file, flush=self.queue is None or self.queue.empty())
+
+    def plain(self, arg):
+        """An argument as text; strings may hold rich markup, which is stripped"""
+        if isinstance(arg, str):
+            try:
+                return render_markup(arg).plain
+            except Exception:
+                return arg
+        return str(arg)
+
+    def run(self, q):
+        while True:
+            record = q.get()
+            try:
+                if record is None:
+                    return
+                self.write(record)
+            except Exception as e:
+                print("log: failed to write a line:", e, file=sys.stderr)
+            finally:
+                q.task_done()
+
+    def start(self):
+        if self.thread is None:
+            self.queue = queue.Queue(maxsize=QUEUE_LIMIT)
+            self.thread = threading.Thread(target=self.run, args=(self.queue,), name="log-writer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Write what is queued and go back to writing on the calling thread"""
+        if self.thread is not None:
+            q, thread = self.queue, self.thread
+            self.queue, self.thread = None, None
+            q.put(None)
+            thread.join(timeout=5)
+
+_logger = _Logger()
+atexit.register(_logger.stop)
+
+
 class log:
+    def debug(*args, **kwargs):
+        """Print a debug message prefixed with `[.]`, hidden unless the level is "debug" """
+        if _logger.level <= DEBUG:
+            _logger.emit(DEBUG, args, kwargs)
+
     def info(*args, **kwargs):
         """Print an informational message prefixed with `[*]`"""
-        console.print(r"\[[bright_blue]*[/bright_blue]]", *args, **kwargs)
+        if _logger.level <= INFO:
+            _logger.emit(INFO, args, kwargs)
 
     def success(*args, **kwargs):
         """Print a successful message prefixed with `[+]`"""
-        console.print(r"\[[bright_green]+[/bright_green]]", *args, **kwargs)
+        if _logger.level <= SUCCESS:
+            _logger.emit(SUCCESS, args, kwargs)
 
     def warning(*args, **kwargs):
         """Print a warning message prefixed with `[!]`"""
-        console.print(r"\[[bright_yellow]![/bright_yellow]]", *args, **kwargs)
+        if _logger.level <= WARNING:
+            _logger.emit(WARNING, args, kwargs)
+
+    def error(*args, exit_after=False, **kwargs):
+        """Prints an error message prefixed with `[!]`. **Exits** after printing if `exit_after=True`"""
+        _logger.emit(ERROR, args, kwargs)
+        if exit_after:
+            _logger.stop()
+            exit()
+
+    def configure(level=None, format=None, rate=None, background=None):
+        """
+        Set the level ("debug", "info", "success", "warning", "error"), the format ("rich", "plain",
+        "json"), the lines per second per call site (0 = unlimited) and whether a background
+        thread writes the lines. Arguments left at None keep their setting.
+        """
+        if level is not None:
+            if level not in LEVELS:
+                raise ValueError(f"log level must be one of {', '.join(LEVELS)}")
+            _logger.level = LEVELS[level]
+        if format is not None:
+            if format not in ("rich", "plain", "json"):
+                raise ValueError("log format must be rich, plain or json")
+            _logger.format = format
+        if rate is not None:
+            _logger.rate = max(0, rate)
+        if background is not None:
+            _logger.start() if background else _logger.stop()
 
-    def error(*args, exit_after=True, **kwargs):
-        """Prints an error message prefixed with `[!]`. **Exits** after printing (unless `exit_after=False`)"""
-        console.print(r"\[[bright_red]![/bright_red]]", *args, **kwargs)
-        if exit_after: exit()
+    def flush():
+        """Wait until the background writer printed every queued line"""
+        q = _logger.queue
+        if q is not None:
+            q.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+#!/bin/python3
+"""
+Counters, gauges and histograms in the Prometheus text format, for app.py (served by `serve`
+on its own port) and webapp.py (its /metrics route), without a prometheus_client dependency.
+
+Updating a metric takes no lock: every thread adds into its own shard (a dict in a
+threading.local), only the scrape sums the shards. When a thread ends its shard is folded
+into the totals, so counters never go back and Flask's thread per request leaves nothing
+behind. Gauges are either set (one assignment) or computed by a function at scrape time.
+
+    RECEIVED = metrics.Counter("mqtt_messages_received_total", "MQTT messages received")
+    REJECTED = metrics.Counter("mqtt_messages_rejected_total", "Messages dropped", ["reason"])
+    RECEIVED.inc()
+    REJECTED.labels("json").inc()
+"""
+import math
+import bisect
+import weakref
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds, from a cached API response to an IoT Hub send on a slow link
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# ---- per-thread shards ----
+_local = threading.local()
+_shards = weakref.WeakSet()  # the _Shard of every live thread that updated a metric
+_retired = {}  # series -> what finished threads added to it
+_lock = threading.RLock()  # held by the scrape and by threads ending, never by an update
+
+class _Shard:
+    """One thread's additions, series -> number (or bucket list of a histogram)"""
+
+    def __init__(self):
+        self.values = {}
+
+    def __del__(self):
+        try:
+            with _lock:
+                _shards.discard(self)
+                for series, value in self.values.items():
+                    series.merge(_retired, value)
+        except Exception:
+            pass  # interpreter shutdown
+
+def _new_shard():
+    """This thread's first update: give it a shard, returns its values"""
+    shard = _local.shard = _Shard()
+    _local.values = shard.values
+    with _lock:
+        _shards.add(shard)
+    return shard.values
+
+
+# ---- series: one label combination of a metric ----
+class _CounterSeries:
+    __slots__ = ("labels",)
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def inc(self, amount=1):
+        try:
+            values = _local.values
+        except AttributeError:
+            values = _new_shard()
+        values[self] = values.get(self, 0) + amount
+
+    def merge(self, into, value):
+        into[self] = into.get(self, 0) + value
+
+    def total(self):
+        """Sum over the shards, call with _lock held"""
+        total = _retired.get(self, 0)
+        for shard in list(_shards):
+            total += shard.values.get(self, 0)
+        return total
+
+    def samples(self, name):
+        yield name, self.labels, self.total()
+
+class _HistogramSeries:
+    __slots__ = ("labels", "bounds")
+
+    def __init__(self, labels, bounds):
+        self.labels = labels
+        self.bounds = bounds
+
+    def observe(self, value):
+        try:
+            values = _local.values
+        except AttributeError:
+            values = _new_shard()
+        cell = values.get(self)
+        if cell is None:
+            cell = values[self] = [0] * (len(self.bounds) + 2)  # a count per bucket, +Inf, then the sum
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def merge(self, into, value):
+        cell = into.setdefault(self, [0] * len(value))
+        for i, v in enumerate(value):
+            cell[i] += v
+
+    def total(self):
+        total = list(_retired.get(self, [0] * (len(self.bounds) + 2)))
+        for shard in list(_shards):
+            cell = shard.values.get(self)
+            if cell is not None:
+                for i, v in enumerate(cell):
+                    total[i] += v
+        return total
+
+    def samples(self, name):
+        total = self.total()
+        count = 0
+        for bound, n in zip(self.bounds + (math.inf,), total):
+            count += n
+            yield name + "_bucket", self.labels + (("le", _number(bound)),), count
+        yield name + "_sum", self.labels, total[-1]
+        yield name + "_count", self.labels, count
+
+class _GaugeSeries:
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+
+# ---- metrics ----
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"metric {metric.name} is registered already")
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            try:
+                samples = metric.collect()
+            except Exception as e:
+                lines.append(f"# {metric.name} not collected: {type(e).__name__}: {e}".replace("\n", " "))
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                if labels:
+                    name += "{" + ",".join(f'{key}="{_escape(v)}"' for key, v in labels) + "}"
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class _Metric:
+    """
+    A metric and its series, one per combination of `labelnames` values (see `labels`). Without
+    labels the metric has a single series and its update methods are the metric's own.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._bind(self.labels())
+        registry.register(self)
+
+    def _bind(self, series):
+        pass
+
+    def _new_series(self, labels):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The series for these label values (in `labelnames` order), keep it to update it cheaply"""
+        series = self.series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+            with self._lock:
+                series = self.series.setdefault(values, self._new_series(tuple(zip(self.labelnames, map(str, values)))))
+        return series
+
+    def collect(self):
+        with _lock:
+            return [sample for series in list(self.series.values()) for sample in series.samples(self.name)]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_series(self, labels):
+        return _CounterSeries(labels)
+
+    def _bind(self, series):
+        self.inc = series.inc
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_series(self, labels):
+        return _HistogramSeries(labels, self.buckets)
+
+    def _bind(self, series):
+        self.observe = series.observe
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down: `set` it, or give `function`, called at every scrape, returning
+    the value (without labels) or a dict of label value tuples to values.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=REGISTRY):
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_series(self, labels):
+        return _GaugeSeries(labels)
+
+    def _bind(self, series):
+        self.set = series.set
+
+    def set_function(self, function):
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        value = self.function()
+        if not self.labelnames:
+            return [(self.name, (), value)]
+        return [(self.name, tuple(zip(self.labelnames, map(str, values))), v) for values, v in value.items()]
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render(registry=REGISTRY):
+    return registry.render()
+
+
+# ---- HTTP exposition for processes without a web server ----
+def serve(port, host="0.0.0.0", registry=REGISTRY):
+    """Serve GET /metrics on `port` from a daemon thread, returns the server (raises OSError if the port is taken)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # a scrape every few seconds is not worth a console line
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
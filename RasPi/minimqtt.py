@@ -0,0 +1,324 @@
+#!/bin/python3
+"""
+Minimal MQTT 3.1.1 over asyncio, for load tests without a mosquitto install (see simulator.py):
+a stand-in `Broker` app.py can subscribe to, and a publish-only `Client` cheap enough to run
+hundreds of virtual ESPs, each on its own connection, in one process.
+
+The broker does what app.py and the ESPs use: QoS 0 and 1 (QoS 2 is refused), `+`/`#`
+subscriptions, retained messages, and sessions kept in memory across reconnects when
+clean_session is off, with at most `max_inflight` unacknowledged QoS 1 messages per client
+(mosquitto's max_inflight_messages) and the rest queued. No authentication, no persistence
+to disk, no will messages: it is a test stand-in, not a broker to deploy.
+"""
+import struct
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def packet(kind, body=b"", flags=0):
+    """One MQTT packet: fixed header (type, flags, variable-length remaining length) and body"""
+    header = bytearray([(kind << 4) | flags])
+    n = len(body)
+    while True:
+        byte, n = n % 128, n // 128
+        header.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(header) + body
+
+
+def string(s):
+    s = s.encode() if isinstance(s, str) else s
+    return struct.pack("!H", len(s)) + s
+
+
+def publish_packet(topic, payload, qos=0, mid=0, retain=False, dup=False):
+    body = string(topic) + (struct.pack("!H", mid) if qos else b"") + payload
+    return packet(PUBLISH, body, (dup << 3) | (qos << 1) | retain)
+
+
+async def read_packet(reader):
+    """(type, flags, body) of the next packet, raises asyncio.IncompleteReadError on EOF"""
+    first = (await reader.readexactly(1))[0]
+    n, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return first >> 4, first & 0x0F, await reader.readexactly(n) if n else b""
+
+
+def topic_matches(topic_filter, topic):
+    f, t = topic_filter.split("/"), topic.split("/")
+    for i, level in enumerate(f):
+        if level == "#":
+            return True
+        if i >= len(t) or (level != "+" and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+class _Session:
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.subscriptions = {}  # topic filter -> granted QoS
+        self.inflight = OrderedDict()  # mid -> (topic, payload), QoS 1 sent and not acknowledged
+        self.queue = deque()  # (topic, payload, qos) waiting for an inflight slot or a connection
+        self.writer = None
+        self.next_mid = 0
+
+    def mid(self):
+        self.next_mid = self.next_mid % 65535 + 1
+        return self.next_mid
+
+
+class Broker:
+    """Stand-in MQTT broker on `host`:`port`, running its own event loop in a daemon thread"""
+
+    def __init__(self, host="127.0.0.1", port=1883, max_inflight=20, max_queued=100000):
+        self.host = host
+        self.port = port
+        self.max_inflight = max(1, max_inflight)
+        self.max_queued = max_queued
+        self.sessions = {}  # client id -> _Session
+        self.retained = {}  # topic -> payload
+        self.received = 0  # PUBLISH packets from clients
+        self.dropped = 0  # QoS 1 messages lost to a full session queue
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start listening, returns once connections are accepted"""
+        ready = threading.Event()
+        failed = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.server = self.loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+            except OSError as e:
+                failed.append(e)
+                ready.set()
+                return
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="mqtt-broker", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if failed:
+            raise failed[0]
+        return self
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def has_subscriber(self, topic):
+        """Whether a client (connected or not) subscribed to a filter matching `topic`"""
+        return any(topic_matches(f, topic) for session in list(self.sessions.values()) for f in list(session.subscriptions))
+
+    def _send(self, session, topic, payload, qos, retain=False):
+        if qos == 0:
+            if session.writer:
+                session.writer.write(publish_packet(topic, payload, retain=retain))
+        elif session.writer and len(session.inflight) < self.max_inflight:
+            mid = session.mid()
+            session.inflight[mid] = (topic, payload)
+            session.writer.write(publish_packet(topic, payload, 1, mid, retain))
+        elif len(session.queue) < self.max_queued:
+            session.queue.append((topic, payload, qos))
+        else:
+            self.dropped += 1
+
+    def _drain(self, session):
+        """Send queued messages while `session` has inflight slots"""
+        while session.queue and session.writer and len(session.inflight) < self.max_inflight:
+            self._send(session, *session.queue.popleft())
+
+    def _route(self, topic, payload, qos):
+        for session in self.sessions.values():
+            granted = [q for f, q in session.subscriptions.items() if topic_matches(f, topic)]
+            if granted:
+                self._send(session, topic, payload, min(qos, max(granted)))
+
+    async def _serve(self, reader, writer):
+        session = None
+        try:
+            kind, _, body = await read_packet(reader)
+            if kind != CONNECT:
+                return
+            session = self._connect(body, writer)
+            while True:
+                kind, flags, body = await read_packet(reader)
+                if kind == PUBLISH:
+                    qos, retain = (flags >> 1) & 3, flags & 1
+                    if qos > 1:
+                        return  # QoS 2 is not supported, drop the connection
+                    n = struct.unpack_from("!H", body)[0]
+                    topic, off = body[2:2 + n].decode(), 2 + n
+                    if qos:
+                        mid = struct.unpack_from("!H", body, off)[0]
+                        off += 2
+                    payload = bytes(body[off:])
+                    self.received += 1
+                    if retain:
+                        if payload:
+                            self.retained[topic] = payload
+                        else:
+                            self.retained.pop(topic, None)
+                    self._route(topic, payload, qos)
+                    if qos:
+                        writer.write(packet(PUBACK, struct.pack("!H", mid)))
+                    if writer.transport.get_write_buffer_size() > 1 << 20:
+                        await writer.drain()
+                elif kind == PUBACK:
+                    session.inflight.pop(struct.unpack("!H", body)[0], None)
+                    self._drain(session)
+                elif kind == SUBSCRIBE:
+                    mid, off, granted, filters = struct.unpack_from("!H", body)[0], 2, [], []
+                    while off < len(body):
+                        n = struct.unpack_from("!H", body, off)[0]
+                        topic_filter = body[off + 2:off + 2 + n].decode()
+                        qos = min(body[off + 2 + n], 1)
+                        session.subscriptions[topic_filter] = qos
+                        granted.append(qos)
+                        filters.append(topic_filter)
+                        off += 3 + n
+                    writer.write(packet(SUBACK, struct.pack("!H", mid) + bytes(granted)))
+                    for topic, payload in self.retained.items():
+                        for topic_filter, qos in zip(filters, granted):
+                            if topic_matches(topic_filter, topic):
+                                self._send(session, topic, payload, qos, retain=True)
+                                break
+                elif kind == UNSUBSCRIBE:
+                    mid, off = struct.unpack_from("!H", body)[0], 2
+                    while off < len(body):
+                        n = struct.unpack_from("!H", body, off)[0]
+                        session.subscriptions.pop(body[off + 2:off + 2 + n].decode(), None)
+                        off += 2 + n
+                    writer.write(packet(UNSUBACK, struct.pack("!H", mid)))
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif kind == DISCONNECT:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, struct.error, UnicodeDecodeError, IndexError):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    del self.sessions[session.client_id]
+            writer.close()
+
+    def _connect(self, body, writer):
+        n = struct.unpack_from("!H", body)[0]
+        off = 2 + n + 1  # protocol name, level
+        flags = body[off]
+        off += 3  # flags, keepalive
+        n = struct.unpack_from("!H", body, off)[0]
+        client_id = body[off + 2:off + 2 + n].decode() or f"auto-{id(writer):x}"
+        clean = bool(flags & 0x02)
+
+        session = self.sessions.get(client_id)
+        if session is not None and session.writer is not None:
+            session.writer.close()  # a client id connects once, the newer connection takes over
+            session.writer = None
+        present = session is not None and not clean
+        if not present:
+            session = self.sessions[client_id] = _Session(client_id, clean)
+        session.clean = clean
+        session.writer = writer
+        writer.write(packet(CONNACK, bytes([int(present), 0])))
+        # resume: unacknowledged messages again (DUP), then what was queued meanwhile
+        for mid, (topic, payload) in session.inflight.items():
+            writer.write(publish_packet(topic, payload, 1, mid, dup=True))
+        self._drain(session)
+        return session
+
+
+class Client:
+    """
+    Publish-only MQTT client on one connection. `publish` with qos=1 waits for the broker's
+    PUBACK before it returns, like umqtt.simple on the ESP32 does.
+    """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.reader = None
+        self.writer = None
+        self.acks = {}  # mid -> future resolved by the PUBACK
+        self.next_mid = 0
+        self.task = None
+
+    async def connect(self, host, port, clean_session=True, user=None, password=None):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        flags = (0x02 if clean_session else 0) | (0xC0 if user else 0)
+        body = string("MQTT") + bytes([4, flags]) + struct.pack("!H", 0) + string(self.client_id)  # keepalive off
+        if user:
+            body += string(user) + string(password or "")
+        self.writer.write(packet(CONNECT, body))
+        kind, _, body = await read_packet(self.reader)
+        if kind != CONNACK or body[1] != 0:
+            self.writer.close()
+            raise ConnectionError(f"MQTT connect refused (return code {body[1] if len(body) > 1 else '?'})")
+        self.task = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                kind, _, body = await read_packet(self.reader)
+                if kind == PUBACK:
+                    future = self.acks.pop(struct.unpack("!H", body)[0], None)
+                    if future and not future.done():
+                        future.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        for future in self.acks.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection lost before the PUBACK"))
+        self.acks.clear()
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("not connected")
+        if not qos:
+            self.writer.write(publish_packet(topic, payload, retain=retain))
+            await self.writer.drain()
+            return
+        self.next_mid = self.next_mid % 65535 + 1
+        future = self.acks[self.next_mid] = asyncio.get_running_loop().create_future()
+        self.writer.write(publish_packet(topic, payload, 1, self.next_mid, retain))
+        await self.writer.drain()
+        await future
+
+    async def disconnect(self):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(packet(DISCONNECT))
+            self.writer.close()
+        if self.task:
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.writer = None
+
+
+if __name__ == "__main__":
+    # usage: python3 minimqtt.py [port]   run the stand-in broker until Ctrl-C
+    import sys
+    import time
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1883
+    broker = Broker("0.0.0.0", port).start()
+    print(f"Stand-in MQTT broker on port {port}, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
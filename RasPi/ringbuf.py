@@ -0,0 +1,249 @@
+#!/bin/python3
+"""
+Memory-mapped ring buffer of the most recent readings, shared between app.py (the only
+writer) and webapp.py (readers), so the dashboard can answer /api/latest and short windows
+without touching the SQLite file the ingest writer is committing to.
+
+Layout (little-endian), in a file under /dev/shm so it lives in RAM:
+  header, 64 bytes: magic "BMER", uint32 version, uint64 capacity, uint64 head (records ever written),
+                    int64 covered_from, uint64 instance, padding
+  capacity records, 64 bytes each: uint64 seq, int64 device_ts, float64 temp_c, hum_pct, pres_hpa,
+                    24 bytes device_id (utf-8, NUL padded)
+
+Every slot is a seqlock: record number i is written to slot i % capacity with seq = 2*i + 1 while
+it is being written and 2*i + 2 once complete. Readers check seq before and after copying a slot
+and drop slots that are odd, changed, or hold another record number, so they never take a lock.
+`covered_from` is the device_ts from which the ring holds every stored reading; it only grows
+(before a slot is overwritten) and tells readers whether a window can be served from the ring.
+`instance` changes whenever app.py (re)creates the ring, readers then map it again.
+"""
+import mmap
+import os
+import struct
+import time
+import threading
+
+DEFAULT_PATH = "/dev/shm/bme280_ring" if os.path.isdir("/dev/shm") else "bme280_ring"
+DEFAULT_CAPACITY = 131072  # 64 bytes each: 8 MiB, 24 h of 10 s readings for 15 devices
+
+MAGIC = b"BMER"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQqQ")
+HEADER_SIZE = 64
+RECORD_SIZE = 64
+_SEQ = struct.Struct("<Q")
+_BODY = struct.Struct("<qddd24s")  # the record after its seq
+_HEAD_OFFSET = 16          # head, covered_from follow magic/version/capacity
+_COVERED_OFFSET = 24
+
+
+class RingWriter:
+    """Single writer side, used by the ingest writer thread after every commit."""
+
+    def __init__(self, path=DEFAULT_PATH, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # fresh ring: zero every seq so no slot validates, then publish the header
+        self.mm[HEADER_SIZE:] = bytes(capacity * RECORD_SIZE)
+        self.head = 0
+        self.covered_from = 0
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, capacity, 0, 0, time.time_ns())
+
+    def seed(self, rows, complete):
+        """
+        Fill the ring with rows from the DB (ascending device_ts). `complete` says whether these are
+        all rows the DB has; if not, the ring only covers what comes after the oldest one.
+        """
+        rows = rows[-self.capacity:]
+        if rows and not complete:
+            self._set_covered_from(rows[0][1] + 1)
+        self.append_many(rows)
+
+    def _set_covered_from(self, ts):
+        if ts > self.covered_from:
+            self.covered_from = ts
+            struct.pack_into("<q", self.mm, _COVERED_OFFSET, ts)
+
+    def append_many(self, rows):
+        """Publish committed `(device_id, device_ts, temp_c, hum_pct, pres_hpa)` rows"""
+        mm, cap = self.mm, self.capacity
+        for device_id, device_ts, temp_c, hum_pct, pres_hpa in rows:
+            i = self.head
+            off = HEADER_SIZE + (i % cap) * RECORD_SIZE
+            if i >= cap:
+                # the reading being evicted is no longer in the ring: raise coverage first
+                self._set_covered_from(struct.unpack_from("<q", mm, off + 8)[0] + 1)
+            _SEQ.pack_into(mm, off, 2 * i + 1)
+            _BODY.pack_into(mm, off + 8, device_ts, temp_c, hum_pct, pres_hpa, device_id.encode()[:24])
+            _SEQ.pack_into(mm, off, 2 * i + 2)
+            self.head = i + 1
+        struct.pack_into("<Q", mm, _HEAD_OFFSET, self.head)
+
+    def close(self):
+        self.mm.close()
+
+
+class RingReader:
+    """
+    Reader that never blocks the writer (see the seqlock above). The ring is mapped read-only and
+    viewed in place as a NumPy record array, a read copies only the slots it returns. webapp.py
+    shares one reader between its threads, so every public method holds `lock`. Every method returns None when the ring cannot
+    answer (no writer running, or the window is older than `covered_from`) so callers fall back to SQLite.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.mm = None
+        self.records = None
+        self.capacity = 0
+        self.instance = None  # header instance and inode of the mapped ring
+        self.inode = None
+        self.lock = threading.Lock()  # guards the mapping and the `newest` cache
+        self.newest = {}  # device_id bytes -> ((device_ts, record number), reading) of the records up to `seen`
+        self.seen = 0
+
+    def _open(self):
+        import numpy as np
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            stat = os.fstat(fd)
+            size = stat.st_size
+            if size < HEADER_SIZE:
+                return False
+            mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, capacity, _, _, instance = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or size != HEADER_SIZE + capacity * RECORD_SIZE:
+            mm.close()
+            return False
+        dtype = np.dtype([("seq", "<u8"), ("ts", "<i8"), ("temp_c", "<f8"), ("hum_pct", "<f8"),
+                          ("pres_hpa", "<f8"), ("device_id", "S24")])
+        self.mm, self.capacity, self.instance, self.inode = mm, capacity, instance, stat.st_ino
+        self.records = np.frombuffer(mm, dtype=dtype, count=capacity, offset=HEADER_SIZE)
+        self.newest, self.seen = {}, 0
+        return True
+
+    def _header(self):
+        if self.mm is None and not self._open():
+            return None
+        magic, version, capacity, head, covered_from, instance = HEADER.unpack_from(self.mm, 0)
+        try:
+            replaced = os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            replaced = True
+        if capacity != self.capacity or instance != self.instance or replaced:
+            # app.py restarted (a new ring, maybe in a new file or with another capacity): remap
+            mm, self.mm, self.records = self.mm, None, None
+            mm.close()  # under the lock no view of it is left, reads return copies
+            return self._header() if self._open() else None
+        return head, covered_from
+
+    def head(self):
+        """Number of readings ever written to the ring, None without a ring"""
+        with self.lock:
+            header = self._header()
+        return header[0] if header else None
+
+    def _select(self, head, since_unix=None, device=None):
+        """
+        Copy of the valid slots matching the filter, deduplicated on (device_id, ts) keeping the
+        newest write, sorted by ts. Filtering runs on views of the mapping, only matches are copied.
+        """
+        import numpy as np
+        n = min(head, self.capacity)
+        idx = np.arange(head - n, head, dtype=np.uint64)
+        slots = (idx % np.uint64(self.capacity)).astype(np.int64)
+        records = self.records
+
+        seq = records["seq"][slots]
+        ok = seq == 2 * idx + 2
+        if since_unix is not None:
+            ok &= records["ts"][slots] >= since_unix
+        if device is not None:
+            ok &= records["device_id"][slots] == device.encode()[:24]
+        slots, seq = slots[ok], seq[ok]
+        data = records[slots]
+        # seqlock check: drop slots the writer touched while we were copying them
+        data = data[(data["seq"] == seq) & (records["seq"][slots] == seq)]
+
+        # INSERT OR REPLACE semantics: the last write of a (device_id, ts) wins
+        data = data[np.lexsort((-np.arange(len(data)), data["device_id"], data["ts"]))]
+        keep = np.ones(len(data), dtype=bool)
+        keep[1:] = (data["ts"][1:] != data["ts"][:-1]) | (data["device_id"][1:] != data["device_id"][:-1])
+        return data[keep]
+
+    def rows_since(self, since_unix, until_unix=None, device=None):
+        """(device_id, device_ts, temp_c, hum_pct, pres_hpa) rows with since <= ts <= until, ascending"""
+        with self.lock:
+            header = self._header()
+            if header is None or since_unix < header[1]:
+                return None
+            data = self._select(header[0], since_unix, device)
+            # coverage may have moved on while copying; only trust the copy if it still holds
+            header = self._header()
+            if header is None or since_unix < header[1]:
+                return None
+        if until_unix is not None:
+            data = data[data["ts"] <= until_unix]
+        return list(zip([d.decode() for d in data["device_id"]], data["ts"].tolist(),
+                        data["temp_c"].tolist(), data["hum_pct"].tolist(), data["pres_hpa"].tolist()))
+
+    def _catch_up(self, head):
+        """
+        Fold the records written since the last call into `newest`: usually a handful, the whole
+        ring after a remap or once the writer lapped the records not looked at yet.
+        """
+        import numpy as np
+        if head < self.seen or head - self.seen > self.capacity:
+            self.newest, self.seen = {}, max(0, head - self.capacity)
+        if head == self.seen:
+            return
+        numbers = np.arange(self.seen, head, dtype=np.int64)
+        slots = numbers % self.capacity
+        data = self.records[slots]
+        # seqlock check: drop slots being written or already holding a later record
+        ok = (data["seq"] == 2 * numbers + 2) & (self.records["seq"][slots] == data["seq"])
+        data, numbers = data[ok], numbers[ok]
+        # per device the last of the newest ts, INSERT OR REPLACE semantics: the last write wins
+        order = np.lexsort((numbers, data["ts"]))[::-1]
+        devices, first = np.unique(data["device_id"][order], return_index=True)
+        for device, i in zip(devices, order[first]):
+            r = data[i]
+            key = (int(r["ts"]), int(numbers[i]))
+            known = self.newest.get(device)
+            if known is None or key > known[0]:
+                self.newest[device] = (key, (device.decode(), key[0], float(r["temp_c"]), float(r["hum_pct"]),
+                                             float(r["pres_hpa"])))
+        self.seen = head
+
+    def latest(self, device=None):
+        """
+        Newest reading (by device_ts) in the ring, or None if the ring is unavailable or empty.
+        Only the records written since the previous call are read (see _catch_up).
+        """
+        with self.lock:
+            header = self._header()
+            if header is None:
+                return None
+            head, covered_from = header
+            self._catch_up(head)
+            if device is None:
+                known = max(self.newest.values(), default=None)
+            else:
+                known = self.newest.get(device.encode()[:24])
+        # a late reading older than covered_from may be all the ring has of this device,
+        # while a newer one was already evicted: only answer from the covered range
+        if known is None or known[0][0] < covered_from:
+            return None
+        return known[1]
@@ -0,0 +1,140 @@
+#!/bin/python3
+"""
+Minute / quarter / hour rollups of bme280_data, so long chart windows read a few
+hundred pre-aggregated rows instead of every 10 s reading.
+
+Each rollup table holds count/min/max/avg of temperature, humidity and pressure per
+(device_id, bucket_ts). The ingest writer refreshes the buckets touched by every commit
+(see `update`), `python3 rollup.py` rebuilds them from scratch.
+"""
+import sys
+
+# bucket size in seconds -> table, finest first; every level is built from the one before it
+ROLLUPS = {
+    60:   "bme280_rollup_1m",
+    900:  "bme280_rollup_15m",
+    3600: "bme280_rollup_1h",
+}
+
+COLUMNS = "device_id, bucket_ts, n, temp_min, temp_max, temp_avg, hum_min, hum_max, hum_avg, pres_min, pres_max, pres_avg"
+
+# aggregate raw readings into the finest level
+_FROM_RAW = """
+    SELECT device_id, (device_ts / {res}) * {res}, COUNT(*),
+           MIN(temp_c), MAX(temp_c), AVG(temp_c),
+           MIN(hum_pct), MAX(hum_pct), AVG(hum_pct),
+           MIN(pres_hpa), MAX(pres_hpa), AVG(pres_hpa)
+    FROM {src}
+"""
+
+# bme280_data plus temp.rollup_extra (see `update`), a reading in bme280_data wins
+_WITH_EXTRA = """(
+    SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM bme280_data
+    UNION ALL
+    SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM temp.rollup_extra e
+    WHERE NOT EXISTS (SELECT 1 FROM bme280_data d WHERE d.device_id = e.device_id AND d.device_ts = e.device_ts)
+)"""
+
+# combine buckets of the previous level, averages weighted by their count
+_FROM_ROLLUP = """
+    SELECT device_id, (bucket_ts / {res}) * {res}, SUM(n),
+           MIN(temp_min), MAX(temp_max), SUM(temp_avg * n) / SUM(n),
+           MIN(hum_min), MAX(hum_max), SUM(hum_avg * n) / SUM(n),
+           MIN(pres_min), MAX(pres_max), SUM(pres_avg * n) / SUM(n)
+    FROM {src}
+"""
+
+
+def create_tables(cursor):
+    """Create the rollup tables (if missing). Returns True if any of them was new."""
+    created = False
+    for table in ROLLUPS.values():
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                device_id TEXT NOT NULL,
+                bucket_ts INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                temp_min REAL, temp_max REAL, temp_avg REAL,
+                hum_min REAL,  hum_max REAL,  hum_avg REAL,
+                pres_min REAL, pres_max REAL, pres_avg REAL,
+                PRIMARY KEY (device_id, bucket_ts)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table} (bucket_ts)")
+        created = created or not exists
+    return created
+
+
+def _level_sources(raw="bme280_data"):
+    """Yield (res, table, select, time column of the source) per level, finest first"""
+    src = None
+    for res, table in ROLLUPS.items():
+        if src is None:
+            yield res, table, _FROM_RAW.format(res=res, src=raw), "device_ts"
+        else:
+            yield res, table, _FROM_ROLLUP.format(res=res, src=src), "bucket_ts"
+        src = table
+
+
+def update(conn, rows, extra=()):
+    """
+    Refresh the buckets touched by `rows` ((device_id, device_ts, ...) tuples) in every level.
+    Buckets are recomputed from the level below instead of being incremented, so replaced
+    readings are not counted twice. `extra` are readings of those buckets that are not in
+    bme280_data, the archived ones of a month that got late readings (see app.py).
+    Call it inside the transaction that stored the rows.
+    """
+    raw = "bme280_data"
+    if extra:
+        conn.execute("""CREATE TEMP TABLE IF NOT EXISTS rollup_extra (
+                            device_id TEXT NOT NULL, device_ts INTEGER NOT NULL,
+                            temp_c REAL, hum_pct REAL, pres_hpa REAL,
+                            PRIMARY KEY (device_id, device_ts)
+                        ) WITHOUT ROWID""")
+        conn.execute("DELETE FROM temp.rollup_extra")
+        conn.executemany("INSERT OR REPLACE INTO temp.rollup_extra VALUES (?, ?, ?, ?, ?)", extra)
+        raw = _WITH_EXTRA
+    for res, table, select, key in _level_sources(raw):
+        buckets = {(row[0], (row[1] // res) * res) for row in rows}
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO {table} ({COLUMNS})
+            {select}
+            WHERE device_id = ?1 AND {key} >= ?2 AND {key} < ?2 + {res}
+            GROUP BY device_id
+        """, sorted(buckets))
+
+
+def rebuild(conn, since_unix=0):
+    """
+    Recompute every rollup level from bme280_data, from `since_unix` on (a multiple of an hour);
+    older buckets are kept, they outlive the raw readings dropped by retention.
+    Call it inside a transaction.
+    """
+    for res, table, select, key in _level_sources():
+        conn.execute(f"DELETE FROM {table} WHERE bucket_ts >= ?", (since_unix,))
+        conn.execute(f"INSERT INTO {table} ({COLUMNS}) {select} WHERE {key} >= ? GROUP BY 1, 2", (since_unix,))
+
+
+def pick_resolution(span_s, min_points):
+    """
+    Coarsest bucket size (seconds) that still gives at least `min_points` points over `span_s`,
+    or None if even the finest rollup would be too coarse and raw rows should be used.
+    """
+    for res in sorted(ROLLUPS, reverse=True):
+        if span_s // res >= min_points:
+            return res
+    return None
+
+
+if __name__ == "__main__":
+    # usage: python3 rollup.py [db_file]
+    import storage
+    db_file = sys.argv[1] if len(sys.argv) > 1 else storage.DB_FILE
+    storage.setup(db_file)
+    conn = storage.open_db(db_file, "writer")
+    with conn:
+        rebuild(conn, storage.rollup_floor(conn))
+    for table in ROLLUPS.values():
+        print(f"{table}: {conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]} rows")
+    conn.close()
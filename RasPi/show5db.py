@@ -1,10 +1,10 @@
 #!/bin/python3
-import sqlite3
+import storage
 
-DB_FILE = "bme280_data.db"
+DB_FILE = storage.DB_FILE
 
 def show_last_records(n=5):
-    conn = sqlite3.connect(DB_FILE)
+    conn = storage.open_db(DB_FILE, "reader")
     cursor = conn.cursor()
     cursor.execute("""
         SELECT *
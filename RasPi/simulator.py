@@ -1,14 +1,356 @@
+#!/bin/python3
+"""
+Simulated BME280 readings and a load generator publishing them the way the ESP32s do.
+
+`Weather` and `VirtualDevice` produce realistic, seeded signals: a daily temperature cycle per
+device, humidity moving against the temperature, slow drift and sensor noise, and pressure
+fronts shared by all devices of a run. The same seed gives the same readings.
+
+The load generator runs N virtual ESPs, each on its own MQTT connection, sampling every
+`--interval` simulated seconds (`--speed` compresses time) into a backlog that is published
+oldest first in batches, as ESP/main.py does. Outages (`--outage`, `--herd`) and a backlog at
+start (`--backlog`) make the reconnect bursts app.py has to absorb. It reports the publish rate
+and the end-to-end ingest lag: from publish until the row can be read from the database app.py
+writes. Run app.py against the same broker (a local mosquitto, see mosquitto/iot.conf, or the
+stand-in broker `--stand-in` starts in this process, see minimqtt.py):
+
+    python3 simulator.py -d 50 -x 100 -t 60 --stand-in -mpo 1884 &
+    python3 app.py -n -mh 127.0.0.1 -mpo 1884
+"""
+import os
+import json
+import math
+import time
 import random
+import asyncio
+import argparse
+import threading
+from collections import deque
+import config
+import secrets
+import payload
+import storage
+import minimqtt
+from log import log
+
+
+class Weather:
+    """Pressure fronts of one run, shared by every device: lows and highs lasting 6-36 hours"""
+
+    def __init__(self, seed, start_ts, end_ts):
+        rng = random.Random(f"weather:{seed}")
+        self.fronts = []  # (start_ts, duration_s, depth_pa)
+        ts = start_ts - 36 * 3600
+        while ts < end_ts:
+            ts += rng.expovariate(1 / (2 * 86400))  # one every ~2 days
+            self.fronts.append((ts, rng.uniform(6, 36) * 3600, rng.uniform(-2500, 1500)))
+
+    def pressure_offset(self, ts):
+        """Pa the fronts add at `ts`, each a smooth bell over its duration"""
+        offset = 0.0
+        for start, duration, depth in self.fronts:
+            if start <= ts < start + duration:
+                offset += depth * 0.5 * (1 - math.cos(2 * math.pi * (ts - start) / duration))
+        return offset
+
+
+class VirtualDevice:
+    """
+    One simulated ESP with its BME280: `reading(ts)` returns (device_ts, temp_c, hum_pct, pres_hpa)
+    with the pressure in Pa like the real ones send it. Readings must be asked for in time order.
+    """
+
+    def __init__(self, index, seed, weather):
+        rng = self.rng = random.Random(f"device:{seed}:{index}")
+        self.device_id = f"esp32-02{index:010x}"  # locally administered MAC, cannot clash with a real ESP
+        self.weather = weather
+        self.temp_base = rng.uniform(17, 24)
+        self.temp_swing = rng.uniform(1, 4)  # half the day/night difference
+        self.warmest = (14 + rng.uniform(-1.5, 1.5)) * 3600  # UTC second of the day
+        self.hum_base = rng.uniform(40, 60)
+        self.altitude_pa = rng.uniform(-1200, 200)  # ~12 Pa per meter above sea level
+        self.drift = 0.0  # slow AR(1) deviation from the daily cycle, in C
+        self.last_ts = None
+
+    def reading(self, ts):
+        dt = 0 if self.last_ts is None else max(0, ts - self.last_ts)
+        self.last_ts = ts
+        keep = math.exp(-dt / 3600)  # drift decorrelates over about an hour
+        self.drift = self.drift * keep + self.rng.gauss(0, 0.4) * math.sqrt(1 - keep * keep)
+        cycle = math.cos(2 * math.pi * (ts % 86400 - self.warmest) / 86400)
+        temp = self.temp_base + self.temp_swing * cycle + self.drift + self.rng.gauss(0, 0.02)
+        # relative humidity drops when the air warms up
+        hum = self.hum_base - 2.5 * (temp - self.temp_base) + self.rng.gauss(0, 0.3)
+        pres = 101325 + self.altitude_pa + self.weather.pressure_offset(ts) + self.rng.gauss(0, 3)
+        return int(ts), temp, min(100.0, max(0.0, hum)), pres
+
 
 class BME280SensorSimulator:
+    """Stand-in for a BME280 on the Pi, reading a VirtualDevice at the current time"""
+
+    def __init__(self, seed=None):
+        seed = seed if seed is not None else random.randrange(1 << 32)
+        now = time.time()
+        self.device = VirtualDevice(0, seed, Weather(seed, now, now + 30 * 86400))
+
+    def _read(self):
+        return self.device.reading(max(time.time(), self.device.last_ts or 0))
 
-    def __init__(self):
-        pass
-    
     @property
     def temperature(self):
-        return random.uniform(20, 30)
+        return self._read()[1]
 
     @property
     def humidity(self):
-        return random.uniform(60, 80)
+        return self._read()[2]
+
+    @property
+    def pressure(self):
+        return self._read()[3]
+
+
+# ---- load generator ----
+class IngestProbe(threading.Thread):
+    """
+    Polls the database for the readings the generator published and records how long after
+    their publish each one could be read, every `poll_s` seconds (the lag resolution).
+    """
+
+    def __init__(self, db_file, poll_s=0.1):
+        super().__init__(name="ingest-probe", daemon=True)
+        self.db_file = db_file
+        self.poll_s = poll_s
+        self.lock = threading.Lock()
+        self.pending = {}  # device_id -> {device_ts: publish time}
+        self.lags = []  # seconds, of every reading seen
+        self.running = True
+
+    def sent(self, device_id, timestamps, wall):
+        with self.lock:
+            pending = self.pending.setdefault(device_id, {})
+            for ts in timestamps:
+                pending[ts] = wall
+
+    def waiting(self):
+        with self.lock:
+            return sum(len(p) for p in self.pending.values())
+
+    def run(self):
+        conn = storage.open_db(self.db_file, "reader", check_same_thread=False)
+        while self.running:
+            with self.lock:
+                ranges = [(d, min(p), max(p)) for d, p in self.pending.items() if p]
+            for device_id, lo, hi in ranges:
+                found = conn.execute("SELECT device_ts FROM bme280_data WHERE device_id = ? AND device_ts BETWEEN ? AND ?",
+                                     (device_id, lo, hi)).fetchall()
+                now = time.time()
+                with self.lock:
+                    pending = self.pending[device_id]
+                    for (ts,) in found:
+                        wall = pending.pop(ts, None)
+                        if wall is not None:
+                            self.lags.append(now - wall)
+            time.sleep(self.poll_s)
+        conn.close()
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    ordered = sorted(values)
+    if not ordered:
+        return [float("nan")] * len(ps)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in ps]
+
+
+class Stats:
+    def __init__(self):
+        self.messages = 0
+        self.readings = 0
+        self.connects = 0
+        self.errors = 0  # failed connects and publishes, retried
+        self.backlog = 0  # readings buffered by all devices
+
+
+def encode(device_id, batch, shape):
+    if shape == "binary":
+        return payload.encode(device_id, batch)
+    readings = [{"temp_c": t, "hum_pct": h, "pres_hpa": p, "device_ts": ts} for ts, t, h, p in batch]
+    return json.dumps(readings[0] if len(readings) == 1 else readings).encode()
+
+
+def outage_schedule(spec, herd, seed, index):
+    """Function telling whether a device is offline at simulated time `ts`, None without outages"""
+    if not spec:
+        return None
+    every, duration = (float(v) for v in spec.split(":"))
+    phase = random.Random(f"outage:{seed}:{0 if herd else index}").uniform(0, every)
+    return lambda ts: (ts - phase) % every < duration
+
+
+def topic_prefix():
+    """Topic levels before the device id, the ESPs publish to <prefix>/<device_id>"""
+    return config.MQTT_TOPIC.rsplit("/", 1)[0] if hasattr(config, 'MQTT_TOPIC') else "iot/bme280"
+
+
+async def run_device(args, device, start_ts, wall_start, wall_end, topic, stats, probe, offline):
+    """Sample on schedule, publish the backlog oldest first whenever connected"""
+    client = minimqtt.Client(device.device_id)
+    connected = False
+    step = args.interval / args.speed  # wall seconds between samples
+    phase = device.rng.uniform(0, step)  # devices do not sample in lockstep
+    k = 0
+    pending = deque()
+    for i in range(args.backlog, 0, -1):
+        pending.append(device.reading(start_ts - i * args.interval))
+    stats.backlog += len(pending)
+
+    while True:
+        now = time.time()
+        if now >= wall_end:
+            break
+        due = wall_start + phase + k * step
+        if due > now:
+            await asyncio.sleep(due - now)
+            continue
+        while wall_start + phase + k * step <= now:  # catch up on samples missed while publishing
+            ts = start_ts + k * args.interval
+            pending.append(device.reading(ts))
+            stats.backlog += 1
+            k += 1
+
+        if offline is not None and offline(ts):
+            if connected:
+                await client.disconnect()
+                connected = False
+            continue
+        if not connected:
+            try:
+                await client.connect(args.mqtt_host, args.mqtt_port, user=args.mqtt_user, password=args.mqtt_pass)
+                connected = True
+                stats.connects += 1
+            except (OSError, ConnectionError):
+                stats.errors += 1
+                continue
+        try:
+            while pending and time.time() < wall_end:
+                batch = [pending[i] for i in range(min(args.replay_batch, len(pending)))]
+                if probe:
+                    probe.sent(device.device_id, [r[0] for r in batch], time.time())
+                await client.publish(topic, encode(device.device_id, batch, args.payload), args.qos)
+                for _ in batch:
+                    pending.popleft()
+                stats.messages += 1
+                stats.readings += len(batch)
+                stats.backlog -= len(batch)
+        except (OSError, ConnectionError):
+            stats.errors += 1
+            connected = False
+    if connected:
+        await client.disconnect()
+
+
+async def report(args, stats, probe, wall_start, wall_end):
+    last_messages, last_readings, last_lags, last = 0, 0, 0, wall_start
+    while time.time() < wall_end:
+        await asyncio.sleep(args.report)
+        now = time.time()
+        dt = now - last
+        line = (f"{now - wall_start:5.0f}s: {(stats.messages - last_messages) / dt:8.1f} msg/s "
+                f"{(stats.readings - last_readings) / dt:8.1f} readings/s, backlog {stats.backlog}")
+        if probe:
+            p50, p95, _ = percentiles(probe.lags[last_lags:])
+            line += f", ingest lag p50 {p50 * 1000:.0f} ms p95 {p95 * 1000:.0f} ms, waiting {probe.waiting()}"
+            last_lags = len(probe.lags)
+        log.info(line)
+        last_messages, last_readings, last = stats.messages, stats.readings, now
+
+
+async def generate(args, probe):
+    wall_start = time.time()
+    wall_end = wall_start + args.duration
+    # simulated time ends about now, so a long sped-up run does not write readings from the future
+    start_ts = int(wall_start - args.duration * (args.speed - 1))
+    weather = Weather(args.seed, start_ts - args.backlog * args.interval, start_ts + args.duration * args.speed)
+    prefix = topic_prefix()
+    stats = Stats()
+    devices = [VirtualDevice(i, args.seed, weather) for i in range(args.devices)]
+    tasks = [run_device(args, device, start_ts, wall_start, wall_end, f"{prefix}/{device.device_id}", stats, probe,
+                        outage_schedule(args.outage, args.herd, args.seed, i))
+             for i, device in enumerate(devices)]
+    await asyncio.gather(report(args, stats, probe, wall_start, wall_end), *tasks)
+    return stats, time.time() - wall_start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Publish readings of simulated ESPs over MQTT and measure the ingest lag")
+    parser.add_argument("-d", "--devices", type=int, default=10, help="Virtual ESPs, each on its own MQTT connection (default: 10)")
+    parser.add_argument("-i", "--interval", type=float, default=10, help="Simulated seconds between the readings of a device (default: 10, like the ESP)")
+    parser.add_argument("-x", "--speed", type=float, default=1, help="Simulated seconds per second: a device publishes every interval/speed seconds (default: 1)")
+    parser.add_argument("-t", "--duration", type=float, default=60, help="Seconds to publish for (default: 60)")
+    parser.add_argument("-p", "--payload", choices=["binary", "json"], default="binary",
+                        help="Payload shape: binary (payload.py) or JSON (an object per reading, an array per batch) (default: binary)")
+    parser.add_argument("-q", "--qos", type=int, choices=[0, 1], help="Publish QoS, 1 waits for every PUBACK like the ESP (default: config.MQTT_QOS)",
+                        default=config.MQTT_QOS if hasattr(config, 'MQTT_QOS') else 0)
+    parser.add_argument("-rb", "--replay-batch", type=int, default=16, help="Max readings per message while a device catches up (default: 16, like the ESP)")
+    parser.add_argument("-o", "--outage", type=str, help="EVERY:FOR in simulated seconds, e.g. 3600:600: every device goes offline for FOR seconds every EVERY seconds, buffering its readings")
+    parser.add_argument("--herd", action="store_true", help="All devices share their outages (a broker or Wi-Fi outage) and reconnect at once")
+    parser.add_argument("-bl", "--backlog", type=int, default=0, help="Readings every device has buffered at start, replayed right away (default: 0)")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="Seed of the signals, outages and start phases (default: 1)")
+    parser.add_argument("-mh", "--mqtt-host", type=str, help="MQTT host, if not set will use config.MQTT_HOST",
+                        default=config.MQTT_HOST if hasattr(config, 'MQTT_HOST') else "127.0.0.1")
+    parser.add_argument("-mpo", "--mqtt-port", type=int, help="MQTT port, if not set will use config.MQTT_PORT",
+                        default=config.MQTT_PORT if hasattr(config, 'MQTT_PORT') else 1883)
+    parser.add_argument("-mu", "--mqtt-user", type=str, help="MQTT username, if not set will use secrets.MQTT_USER",
+                        default=secrets.MQTT_USER if hasattr(secrets, 'MQTT_USER') else None)
+    parser.add_argument("-mp", "--mqtt-pass", type=str, help="MQTT password, if not set will use secrets.MQTT_PASS",
+                        default=secrets.MQTT_PASS if hasattr(secrets, 'MQTT_PASS') else None)
+    parser.add_argument("-sb", "--stand-in", action="store_true", help="Start the stand-in broker (minimqtt.py) on --mqtt-port in this process")
+    parser.add_argument("-db", "--db-file", type=str, help="Database app.py writes, polled for the ingest lag (default: storage.DB_FILE)")
+    parser.add_argument("-g", "--grace", type=float, default=10, help="Seconds to wait after publishing for the last rows to show up (default: 10)")
+    parser.add_argument("-r", "--report", type=float, default=5, help="Seconds between progress lines (default: 5)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    broker = None
+    if ARGS.stand_in:
+        broker = minimqtt.Broker("0.0.0.0", ARGS.mqtt_port,
+                                 config.MQTT_INFLIGHT if hasattr(config, 'MQTT_INFLIGHT') else 20).start()
+        log.info(f"Stand-in MQTT broker on port {ARGS.mqtt_port}")
+        ARGS.mqtt_host = "127.0.0.1"
+        # nothing published before app.py subscribes would reach it
+        log.info("Waiting for app.py to subscribe...")
+        while not broker.has_subscriber(f"{topic_prefix()}/esp32-020000000000"):
+            time.sleep(0.2)
+
+    db_file = ARGS.db_file or storage.DB_FILE
+    probe = None
+    if os.path.exists(db_file):
+        probe = IngestProbe(db_file)
+        probe.start()
+    else:
+        log.warning(f"{db_file} does not exist, not measuring the ingest lag")
+
+    log.info(f"{ARGS.devices} devices, a reading every {ARGS.interval:g} s at {ARGS.speed:g}x "
+             f"({ARGS.devices * ARGS.speed / ARGS.interval:.1f} readings/s), {ARGS.payload} payload, QoS {ARGS.qos}, "
+             f"MQTT {ARGS.mqtt_host}:{ARGS.mqtt_port}")
+    try:
+        stats, elapsed = asyncio.run(generate(ARGS, probe))
+    except KeyboardInterrupt:
+        exit()
+
+    log.success(f"Published {stats.readings} readings in {stats.messages} messages in {elapsed:.1f} s: "
+                f"{stats.messages / elapsed:.1f} msg/s, {stats.readings / elapsed:.1f} readings/s "
+                f"({stats.connects} connects, {stats.errors} errors, {stats.backlog} readings left buffered)")
+    if probe:
+        deadline = time.time() + ARGS.grace
+        while probe.waiting() and time.time() < deadline:
+            time.sleep(0.1)
+        probe.running = False
+        p50, p95, p99 = percentiles(probe.lags)
+        log.success(f"Ingest lag over {len(probe.lags)} readings: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, "
+                    f"p99 {p99 * 1000:.0f} ms, max {max(probe.lags, default=float('nan')) * 1000:.0f} ms")
+        if probe.waiting():
+            log.warning(f"{probe.waiting()} published readings not in {db_file} after {ARGS.grace:g} s")
+    if broker:
+        broker.stop()
@@ -0,0 +1,463 @@
+#!/bin/python3
+"""
+SQLite access shared by app.py, webapp.py, rollup.py and show5db.py: the schema and its
+versioned migrations, tuned connection profiles and per-thread persistent connections.
+
+Readings live in time partitions, one table per month (or day) named bme280_data_<YYYYMM[DD]>,
+and are read through the bme280_data view over all of them; SQLite merges the ordered index
+scans of the partitions, so readers query the view like a single table. Only writes go to a
+partition directly (see Partitions). Old partitions are moved into compressed archive files
+(archive.py) or dropped whole once every row in them was synced, which frees their pages
+without a row-by-row DELETE.
+
+Opening a connection and applying the pragmas costs more than the small queries the
+dashboard and the uplink run, so every thread keeps its connection open and reuses it,
+and with it sqlite3's prepared statement cache. Connections of threads that finished are
+kept for the next thread instead of being closed (Flask may start a thread per request).
+"""
+import os
+import sqlite3
+import calendar
+import datetime
+import threading
+import config
+import rollup
+
+DB_FILE = "bme280_data.db"
+LEGACY_DEVICE_ID = config.LEGACY_DEVICE_ID if hasattr(config, 'LEGACY_DEVICE_ID') else "esp32"
+PARTITION_SPAN = config.PARTITION_SPAN if hasattr(config, 'PARTITION_SPAN') else "month"  # or "day"
+PARTITION_PREFIX = "bme280_data_"
+ARCHIVE_DIR = config.ARCHIVE_DIR if hasattr(config, 'ARCHIVE_DIR') else "archive"  # see archive.py
+HORIZON_KEY = "retention_horizon"  # sync_state key: readings before it were dropped by retention
+ARCHIVED_KEY = "archived_until"  # sync_state key: partitions ending by it were moved to the archive
+
+# pragmas per connection profile
+PROFILES = {
+    # app.py: ingest writer, sync state. WAL lets readers run while it commits; NORMAL is durable
+    # at checkpoints, no fsync per commit
+    "writer": {
+        # first: on a new file it only takes effect before journal_mode writes the header
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16384,        # KiB (negative) -> 16 MiB page cache
+        "mmap_size": 64 << 20,       # read pages straight from the OS page cache
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 1000,  # pages
+    },
+    # webapp.py, show5db.py: opened with mode=ro, can never write or take the write lock
+    "reader": {
+        "cache_size": -8192,
+        "mmap_size": 64 << 20,
+        "temp_store": "MEMORY",
+    },
+}
+# app.py's ingest writer with QoS 1: messages are acknowledged to the broker after their commit,
+# so the commit must survive a power cut, FULL syncs the WAL on every commit
+PROFILES["writer-full"] = dict(PROFILES["writer"], synchronous="FULL")
+
+BUSY_TIMEOUT_S = 5.0      # wait this long for a lock held by another connection
+CACHED_STATEMENTS = 256   # prepared statements kept per connection (sqlite3 default: 128)
+IDLE_MAX = 8              # connections of finished threads kept per (db_file, profile)
+
+
+def open_db(db_file=DB_FILE, profile="reader", check_same_thread=True):
+    """A new connection with the pragmas of `profile`, read-only (mode=ro) for "reader", read-write otherwise."""
+    if profile == "reader":
+        # autocommit: a reader never holds a transaction between calls unless it BEGINs one itself
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_S, isolation_level=None,
+                               cached_statements=CACHED_STATEMENTS, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_S,
+                               cached_statements=CACHED_STATEMENTS, check_same_thread=check_same_thread)
+    for pragma, value in PROFILES[profile].items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    return conn
+
+
+# ---- per-thread connections ----
+_local = threading.local()
+_idle = {}  # (db_file, profile) -> connections left behind by finished threads
+_idle_lock = threading.Lock()
+
+class _Slot:
+    """Holds a thread's connection; when the thread ends it goes back to the idle pool"""
+
+    def __init__(self, key, conn):
+        self.key = key
+        self.conn = conn
+
+    def __del__(self):
+        conn = self.conn
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            with _idle_lock:
+                idle = _idle.setdefault(self.key, [])
+                if len(idle) < IDLE_MAX:
+                    idle.append(conn)
+                    return
+            conn.close()
+        except Exception:
+            pass  # interpreter shutdown
+
+def connection(profile="reader", db_file=DB_FILE):
+    """
+    This thread's persistent connection for `profile`. Don't close it; a caller that opens
+    a transaction must end it (commit/rollback) before returning.
+    """
+    slots = _local.__dict__.setdefault("slots", {})
+    key = (db_file, profile)
+    slot = slots.get(key)
+    if slot is None:
+        with _idle_lock:
+            idle = _idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = open_db(db_file, profile, check_same_thread=False)
+        slot = slots[key] = _Slot(key, conn)
+    return slot.conn
+
+
+# ---- schema ----
+def sync_key(device_id):
+    """sync_state key holding the uplink watermark of one device"""
+    return f"last_sync_ts:{device_id}"
+
+def _migrate_multi_device(cursor, log):
+    """v1: bme280_data keyed on (device_id, device_ts), sync_state, migrating single-device databases"""
+    columns = [r[1] for r in cursor.execute("PRAGMA table_info(bme280_data)")]
+    legacy = bool(columns) and "device_id" not in columns
+    if legacy:
+        log.warning(f"Migrating bme280_data to multi-device schema (existing rows -> '{LEGACY_DEVICE_ID}')")
+        cursor.execute("ALTER TABLE bme280_data RENAME TO bme280_data_old")
+    # WITHOUT ROWID: the (device_id, device_ts) key is the table itself, so per-device ranges are index-only
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bme280_data (
+            device_id TEXT NOT NULL,
+            device_ts INTEGER NOT NULL,
+            temp_c REAL NOT NULL,
+            hum_pct REAL NOT NULL,
+            pres_hpa REAL NOT NULL,
+            PRIMARY KEY (device_id, device_ts)
+        ) WITHOUT ROWID
+    ''')
+    # time-ordered access across all devices (/api/latest, /api/series without a device filter)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bme280_data_ts ON bme280_data (device_ts)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key   TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    if legacy:
+        cursor.execute("""
+            INSERT INTO bme280_data (device_id, device_ts, temp_c, hum_pct, pres_hpa)
+            SELECT ?, device_ts, temp_c, hum_pct, pres_hpa FROM bme280_data_old
+        """, (LEGACY_DEVICE_ID,))
+        cursor.execute("DROP TABLE bme280_data_old")
+        cursor.execute("UPDATE sync_state SET key = ? WHERE key = 'last_sync_ts'", (sync_key(LEGACY_DEVICE_ID),))
+
+def _migrate_rollups(cursor, log):
+    """v2: 1m/15m/1h rollup tables, filled from the existing readings"""
+    if rollup.create_tables(cursor) and cursor.execute("SELECT 1 FROM bme280_data LIMIT 1").fetchone():
+        log.info("Filling the rollup tables from the existing readings")
+        rollup.rebuild(cursor.connection)
+
+def _migrate_partitions(cursor, log):
+    """v3: bme280_data split into time partitions behind a view"""
+    conn = cursor.connection
+    if cursor.execute("SELECT type FROM sqlite_master WHERE name = 'bme280_data'").fetchone()[0] == "view":
+        return
+    cursor.execute("ALTER TABLE bme280_data RENAME TO bme280_data_unpartitioned")  # keeps its ts index for the copy
+    first, last = cursor.execute("SELECT MIN(device_ts), MAX(device_ts) FROM bme280_data_unpartitioned").fetchone()
+    names = []
+    ts = first
+    while ts is not None and ts <= last:
+        start, end = partition_bounds(ts, PARTITION_SPAN)
+        name = _create_partition_table(cursor, start)
+        cursor.execute(f"""
+            INSERT INTO {name} SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa
+            FROM bme280_data_unpartitioned WHERE device_ts >= ? AND device_ts < ?
+        """, (start, end))
+        names.append(name)
+        ts = cursor.execute("SELECT MIN(device_ts) FROM bme280_data_unpartitioned WHERE device_ts >= ?", (end,)).fetchone()[0]
+    if not names:
+        names.append(_create_partition_table(cursor, partition_bounds(int(datetime.datetime.now().timestamp()), PARTITION_SPAN)[0]))
+    cursor.execute("DROP TABLE bme280_data_unpartitioned")
+    _create_view(conn)
+    log.info(f"Readings split into {len(names)} partitions: {names[0]} .. {names[-1]}")
+
+def _migrate_raw_readouts(cursor, log):
+    """v4: BME280 calibration blocks and raw ADC readouts of ESPs that publish raw (see compensate.py)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bme280_calibration (
+            device_id TEXT NOT NULL,
+            since_ts INTEGER NOT NULL,
+            calib BLOB NOT NULL,
+            PRIMARY KEY (device_id, since_ts)
+        ) WITHOUT ROWID
+    """)
+    # kept as long as the partition holding the compensated reading, for `compensate.py reprocess`
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bme280_raw (
+            device_id TEXT NOT NULL,
+            device_ts INTEGER NOT NULL,
+            adc BLOB NOT NULL,
+            PRIMARY KEY (device_id, device_ts)
+        ) WITHOUT ROWID
+    """)
+
+def _migrate_sent_ahead(cursor, log):
+    """v5: readings the uplink sent ahead of a device's watermark (newest first while catching up)"""
+    # deleted once the watermark (sync_state) passes them, so the backfill never sends them twice
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS uplink_sent_ahead (
+            device_id TEXT NOT NULL,
+            device_ts INTEGER NOT NULL,
+            PRIMARY KEY (device_id, device_ts)
+        ) WITHOUT ROWID
+    """)
+
+# user_version N means MIGRATIONS[:N] have been applied. Append only, never reorder.
+# Databases from before versioning report 0, every step is safe to run on them again.
+MIGRATIONS = [
+    _migrate_multi_device,
+    _migrate_rollups,
+    _migrate_partitions,
+    _migrate_raw_readouts,
+    _migrate_sent_ahead,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def setup(db_file=DB_FILE):
+    """
+    Create or upgrade the database to SCHEMA_VERSION, each migration in its own transaction
+    together with the new user_version. Run by app.py before anything else touches the file.
+    """
+    from log import log
+    conn = open_db(db_file, "writer")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        log.error(f"{db_file} has schema version {version}, newer than this code ({SCHEMA_VERSION})", exit_after=True)
+    for number, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            conn.execute("BEGIN")
+            migrate(conn.cursor(), log)
+            conn.execute(f"PRAGMA user_version = {number}")
+        log.info(f"Database schema at version {number}: {migrate.__doc__.split(':', 1)[1].strip()}")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # once, before ingest starts: pages freed by dropped partitions can then be given back in small steps
+        log.warning(f"Rewriting {db_file} once (VACUUM) to enable incremental vacuum, this can take a while")
+        conn.execute("VACUUM")
+    conn.close()
+
+def device_ids(conn, tables=None):
+    """
+    Every device_id in bme280_data (or in the given partition tables), by a skip-scan over the
+    primary key of every partition: one seek per device and partition.
+    """
+    tables = tables if tables is not None else [name for _, _, name in partitions(conn)]
+    devices = set()
+    for table in tables:
+        devices.update(r[0] for r in conn.execute(f"""
+            WITH RECURSIVE d(device_id) AS (
+                SELECT MIN(device_id) FROM {table}
+                UNION ALL
+                SELECT (SELECT MIN(device_id) FROM {table} WHERE device_id > d.device_id) FROM d
+                WHERE d.device_id IS NOT NULL
+            )
+            SELECT device_id FROM d WHERE device_id IS NOT NULL
+        """))
+    return sorted(devices)
+
+def watermarks(conn):
+    """device_id -> last device_ts synced to IoT Hub, from sync_state"""
+    rows = conn.execute("SELECT key, value FROM sync_state WHERE key LIKE 'last_sync_ts:%'").fetchall()
+    return {key.split(":", 1)[1]: value for key, value in rows}
+
+def sent_ahead(conn):
+    """device_id -> set of device_ts sent to IoT Hub ahead of its watermark, from uplink_sent_ahead"""
+    ahead = {}
+    for device_id, device_ts in conn.execute("SELECT device_id, device_ts FROM uplink_sent_ahead"):
+        ahead.setdefault(device_id, set()).add(device_ts)
+    return ahead
+
+def calibrations(conn):
+    """device_id -> the newest BME280 calibration block it sent (see compensate.py)"""
+    rows = conn.execute("""
+        SELECT device_id, calib FROM bme280_calibration c
+        WHERE since_ts = (SELECT MAX(since_ts) FROM bme280_calibration WHERE device_id = c.device_id)
+    """).fetchall()
+    return dict(rows)
+
+def retention_horizon(conn):
+    """device_ts before which readings were dropped by retention (0 if none were)"""
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (HORIZON_KEY,)).fetchone()
+    return row[0] if row else 0
+
+def rollup_floor(conn):
+    """device_ts from which rollup.rebuild may recompute; older buckets summarize readings no longer in bme280_data"""
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (ARCHIVED_KEY,)).fetchone()
+    return max(retention_horizon(conn), row[0] if row else 0)
+
+
+# ---- time partitions ----
+def partition_bounds(ts, span=PARTITION_SPAN):
+    """[start, end) in Unix seconds of the UTC month or day holding `ts`"""
+    d = datetime.datetime.fromtimestamp(int(ts), datetime.timezone.utc)
+    if span == "day":
+        start = datetime.datetime(d.year, d.month, d.day, tzinfo=datetime.timezone.utc)
+        return int(start.timestamp()), int(start.timestamp()) + 86400
+    start = datetime.datetime(d.year, d.month, 1, tzinfo=datetime.timezone.utc)
+    return int(start.timestamp()), int(start.timestamp()) + calendar.monthrange(d.year, d.month)[1] * 86400
+
+def _name_bounds(name):
+    """[start, end) of a partition from its name: YYYYMM is a month, YYYYMMDD a day"""
+    suffix = name[len(PARTITION_PREFIX):]
+    start = calendar.timegm(datetime.datetime.strptime(suffix, "%Y%m%d" if len(suffix) == 8 else "%Y%m").timetuple())
+    return partition_bounds(start, "day" if len(suffix) == 8 else "month")
+
+def partitions(conn):
+    """Sorted (start, end, table) of every partition"""
+    names = [r[0] for r in conn.execute(f"""SELECT name FROM sqlite_master
+                                            WHERE type = 'table' AND name GLOB '{PARTITION_PREFIX}[0-9]*'""")]
+    return sorted(_name_bounds(name) + (name,) for name in names)
+
+def _create_partition_table(cursor, start, span=PARTITION_SPAN):
+    name = PARTITION_PREFIX + datetime.datetime.fromtimestamp(start, datetime.timezone.utc).strftime(
+        "%Y%m%d" if span == "day" else "%Y%m")
+    # WITHOUT ROWID: the (device_id, device_ts) key is the table itself, so per-device ranges are index-only
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
+            device_id TEXT NOT NULL,
+            device_ts INTEGER NOT NULL,
+            temp_c REAL NOT NULL,
+            hum_pct REAL NOT NULL,
+            pres_hpa REAL NOT NULL,
+            PRIMARY KEY (device_id, device_ts)
+        ) WITHOUT ROWID
+    ''')
+    # time-ordered access across all devices (/api/latest, /api/series without a device filter)
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_ts ON {name} (device_ts)")
+    return name
+
+def _create_view(conn):
+    """(Re)create the bme280_data view over the current partitions, in the caller's transaction"""
+    arms = " UNION ALL ".join(f"SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM {name}"
+                              for _, _, name in partitions(conn))
+    conn.execute("DROP VIEW IF EXISTS bme280_data")
+    conn.execute(f"CREATE VIEW bme280_data AS {arms}")
+
+class Partitions:
+    """
+    Routes rows to their partition table for the connection that writes them, creating
+    partitions on first use. Only one connection (app.py's ingest writer) may create or drop
+    partitions, the cached bounds would go stale otherwise.
+    """
+
+    def __init__(self, conn, span=PARTITION_SPAN):
+        self.conn = conn
+        self.span = span
+        self.reload()
+
+    def reload(self):
+        self.bounds = partitions(self.conn)
+        self.horizon = retention_horizon(self.conn)
+
+    def table_for(self, ts):
+        for start, end, name in self.bounds:
+            if start <= ts < end:
+                return name
+        # new partition; changes the schema, so call inside the transaction writing the rows
+        name = _create_partition_table(self.conn.cursor(), partition_bounds(ts, self.span)[0], self.span)
+        _create_view(self.conn)
+        self.bounds = partitions(self.conn)
+        return name
+
+    def split(self, rows):
+        """
+        {table: rows} for `(device_id, device_ts, ...)` rows, and the rows older than the retention
+        horizon, which are not stored (their partition is gone and would only be dropped again).
+        """
+        tables, expired = {}, []
+        for row in rows:
+            if row[1] < self.horizon:
+                expired.append(row)
+            else:
+                tables.setdefault(self.table_for(row[1]), []).append(row)
+        return tables, expired
+
+    def _closed(self, age_s, now=None):
+        """
+        Yield the oldest partitions, oldest first, while they ended more than `age_s` ago and hold
+        no reading newer than its device's sync watermark; devices that never synced keep theirs.
+        The newest partition is never yielded.
+        """
+        now = now if now is not None else int(datetime.datetime.now().timestamp())
+        marks = watermarks(self.conn)
+        for start, end, name in self.bounds[:-1]:
+            if end > now - age_s:
+                return
+            synced = all(device in marks and self.conn.execute(
+                             f"SELECT MAX(device_ts) FROM {name} WHERE device_id = ?", (device,)).fetchone()[0] <= marks[device]
+                         for device in device_ids(self.conn, [name]))
+            if not synced:
+                return
+            yield start, end, name
+
+    def _drop(self, name, end, expire):
+        with self.conn:
+            self.conn.execute("BEGIN")  # table and view change together for the readers
+            self.conn.execute(f"DROP TABLE {name}")
+            self.conn.execute("DELETE FROM bme280_raw WHERE device_ts < ?", (end,))
+            _create_view(self.conn)
+            # only retention expires readings; late ones for an archived month are still stored
+            key = HORIZON_KEY if expire else ARCHIVED_KEY
+            self.conn.execute("""INSERT OR REPLACE INTO sync_state (key, value)
+                                 VALUES (?1, MAX(?2, COALESCE((SELECT value FROM sync_state WHERE key = ?1), 0)))""",
+                              (key, end))
+
+    def prune(self, retention_s, now=None):
+        """Drop the closed partitions (see _closed) past `retention_s`. Returns the dropped table names."""
+        dropped = []
+        for _, end, name in list(self._closed(retention_s, now)):
+            self._drop(name, end, expire=True)
+            dropped.append(name)
+        self.reload()
+        return dropped
+
+    def archive_oldest(self, archive_dir, age_s, now=None):
+        """
+        Move the oldest closed partition (see _closed) older than `age_s` into an archive file
+        (archive.py) and drop it. The file is complete and on disk before the table goes, readers
+        merge a file with a table of the same month (see webapp.archive_page). An existing file is
+        rewritten here merged with the table: it holds late readings for an archived month, or the
+        same rows after a crash.
+        Returns (table name, readings) or None if no partition is due.
+        """
+        import archive
+        for _, end, name in self._closed(age_s, now):
+            os.makedirs(archive_dir, exist_ok=True)
+            path = os.path.join(archive_dir, name + archive.SUFFIX)
+            rows = self.conn.execute(f"""SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa
+                                         FROM {name} ORDER BY device_id, device_ts""")
+            if os.path.exists(path):
+                merged = {(device_id, int(ts)): (device_id, int(ts), float(t), float(h), float(p))
+                          for device_id, (tss, temp_c, hum_pct, pres_hpa) in archive.ArchiveFile(path).read()
+                          for ts, t, h, p in zip(tss, temp_c, hum_pct, pres_hpa)}
+                merged.update(((row[0], row[1]), row) for row in rows)  # the table wins, as INSERT OR REPLACE would
+                rows = [merged[key] for key in sorted(merged)]
+            count = archive.write(path, rows)
+            if sum(entry[3] for entry in archive.ArchiveFile(path).index) != count:
+                raise OSError(f"{path} does not hold the {count} readings written to it")
+            self._drop(name, end, expire=False)
+            self.reload()
+            return name, count
+        return None
+
+def incremental_vacuum(conn, pages):
+    """Give up to `pages` free pages back to the file system, returns how many are still free"""
+    # executescript steps the pragma to completion, execute() stops after the first page
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
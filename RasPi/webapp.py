@@ -1,67 +1,596 @@
 #!/usr/bin/env python3
-import sqlite3, time, datetime
-from flask import Flask, jsonify, request, Response
+import time, datetime, json, struct, threading, queue, gzip, zlib, collections, base64
+from flask import Flask, jsonify, request, Response, g
+import rollup
+import storage
+import metrics
+from ringbuf import RingReader
+from archive import Archive
+from downsample import downsample
 
-DB_FILE = "bme280_data.db"  # same DB your app.py writes to
+DB_FILE = storage.DB_FILE  # same DB your app.py writes to, opened read-only
+SERIES_MIN_POINTS = 300     # /api/series uses the coarsest rollup that still gives this many points
+STREAM_CHUNK_ROWS = 2000    # rows per fetchmany() when streaming format=columnar|binary
+BINARY_MAGIC = b"BME1"
+STREAM_POLL_S = 1.0         # how often the shared live-feed watcher checks the DB for commits
+STREAM_KEEPALIVE_S = 15     # SSE comment sent when nothing happened, keeps proxies from closing the stream
+SERIES_NOW_STEP = 10        # ?last= windows end on a multiple of this, so repeated refreshes hit the same cache entry
+COMPRESS_MIN_BYTES = 1024   # smaller responses are sent uncompressed
+CACHE_MAX_BYTES = 16 << 20  # in-process response cache budget
+CACHE_MAX_ENTRY = 2 << 20   # larger bodies are never cached
+SERIES_MAX_LIMIT = 10000    # hard cap of rows per /api/series page, also the default page size for from/to
 
 app = Flask(__name__)
+ring = RingReader()  # recent readings published by app.py; every lookup falls back to SQLite when it can't answer
+archive = Archive(storage.ARCHIVE_DIR)  # partitions app.py moved out of SQLite, merged in front of the SQLite rows
+
+HTTP_SECONDS = metrics.Histogram("http_request_duration_seconds",
+                                 "Time until the response is handed to the server (a streamed body not included), per endpoint", ["endpoint"])
+HTTP_REQUESTS = metrics.Counter("http_requests_total", "Requests per endpoint and status", ["endpoint", "status"])
+CACHE_LOOKUPS = metrics.Counter("response_cache_lookups_total", "Response cache lookups of /api/latest and /api/series", ["result"])
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(resp):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"  # bounded label values, not the raw path
+    if "started" in g:
+        HTTP_SECONDS.labels(endpoint).observe(time.perf_counter() - g.started)
+    HTTP_REQUESTS.labels(endpoint, resp.status_code).inc()
+    return resp
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 def iso(ts_int):
     # ts_int is Unix seconds (from your pipeline)
     return datetime.datetime.utcfromtimestamp(int(ts_int)).isoformat() + "Z"
 
-def rows_between(since_unix=None):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    if since_unix is None:
-        cur.execute("""SELECT device_ts, temp_c, hum_pct, pres_hpa
-                       FROM bme280_data ORDER BY device_ts DESC LIMIT 300""")
+def reading_dict(r):
+    # r is (device_id, device_ts, temp_c, hum_pct, pres_hpa)
+    return {"device_id": r[0], "ts": r[1], "iso": iso(r[1]), "temp_c": r[2], "hum_pct": r[3], "pres_hpa": r[4]}
+
+def encode_cursor(ts, device_id):
+    # opaque keyset cursor: the (ts, device_id) of the last row of a page
+    return base64.urlsafe_b64encode(json.dumps([ts, device_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        ts, device_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(ts), str(device_id)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+
+def fetch_page(conn, select, sql, params, limit, key):
+    """
+    Rows of `SELECT {select} {sql}`, at most `limit` of them, and the cursor of the next page
+    (None on the last one). One extra row is fetched to know whether there is a next page.
+    `key(row)` gives the (ts, device_id) of a row.
+    """
+    if limit is None:
+        return conn.execute(f"SELECT {select} {sql}", params).fetchall(), None
+    rows = conn.execute(f"SELECT {select} {sql} LIMIT ?", params + [limit + 1]).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], encode_cursor(*key(rows[limit - 1]))
+
+def ring_page(rows, after_key, limit):
+    """The keyset page of ring rows (ascending by (ts, device_id)) and the cursor of the next one"""
+    if after_key is not None:
+        rows = [r for r in rows if (r[1], r[0]) > after_key]
+    if limit is not None and len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1][1], rows[limit - 1][0])
+    return rows, None
+
+READING_COLUMNS = "device_id, device_ts, temp_c, hum_pct, pres_hpa"
+
+def archive_page(since_unix, until_unix, device, after_key, limit):
+    """
+    Page of raw rows for a window reaching back into the archive: the archived readings merged
+    with the ones SQLite holds for the same range (late readings of an archived month), then the
+    SQLite rows after it. None if neither has anything there.
+    """
+    last = archive.last_ts()
+    if last is None or since_unix > last:
+        return None
+    conn = storage.connection("reader", DB_FILE)
+    until = last if until_unix is None or until_unix > last else until_unix
+    since = since_unix if after_key is None else max(since_unix, after_key[0])
+    dev, ts, temp_c, hum_pct, pres_hpa = archive.read(since, until, device)
+    if after_key is not None:
+        keep = (ts > after_key[0]) | ((ts == after_key[0]) & (dev > after_key[1]))
+        dev, ts, temp_c, hum_pct, pres_hpa = dev[keep], ts[keep], temp_c[keep], hum_pct[keep], pres_hpa[keep]
+    n = len(ts) if limit is None else limit + 1
+    rows = list(zip(dev[:n].tolist(), ts[:n].tolist(), temp_c[:n].tolist(), hum_pct[:n].tolist(), pres_hpa[:n].tolist()))
+    sql, params, _ = series_sql(None, since_unix, until, device, after_key)
+    late = conn.execute(f"SELECT {READING_COLUMNS} {sql}" + ("" if limit is None else " LIMIT ?"),
+                        params + ([] if limit is None else [n])).fetchall()
+    if late:
+        # the first n of the union are among the first n of either side; SQLite wins like INSERT OR REPLACE
+        merged = {(r[1], r[0]): r for r in rows}
+        merged.update(((r[1], r[0]), r) for r in late)
+        rows = [merged[key] for key in sorted(merged)][:n]
+    if not rows:
+        return None
+
+    sql, params, _ = series_sql(None, max(since_unix, last + 1), until_unix, device, after_key)
+    if limit is not None and len(rows) >= limit:
+        # a full page from the archived range alone, anything after it makes a next page
+        more = len(rows) > limit or conn.execute(f"SELECT 1 {sql} LIMIT 1", params).fetchone() is not None
+        rows = rows[:limit]
+        return rows, (encode_cursor(rows[-1][1], rows[-1][0]) if more else None)
+    rest, next_cursor = fetch_page(conn, READING_COLUMNS, sql, params,
+                                   None if limit is None else limit - len(rows), lambda r: (r[1], r[0]))
+    return rows + rest, next_cursor
+
+def raw_page(since_unix, until_unix, device, after_key, limit):
+    """Page of raw rows from the ring or the archive, None if neither holds the window"""
+    rows = ring.rows_since(since_unix, until_unix, device)
+    if rows is not None:
+        return ring_page(rows, after_key, limit)
+    return archive_page(since_unix, until_unix, device, after_key, limit)
+
+def rows_between(since_unix=None, until_unix=None, device=None, max_points=None, after_key=None, limit=None):
+    """Raw readings as dicts, ascending, and the cursor of the next page"""
+    page = raw_page(since_unix, until_unix, device, after_key, limit) if since_unix is not None else None
+    if page is not None:
+        rows, next_cursor = page
     else:
-        cur.execute("""SELECT device_ts, temp_c, hum_pct, pres_hpa
-                       FROM bme280_data WHERE device_ts >= ? ORDER BY device_ts ASC""",
-                    (int(since_unix),))
-    rows = cur.fetchall()
-    conn.close()
-    # normalize to ascending order
-    rows = rows[::-1] if since_unix is None else rows
-    return [{"ts": r[0], "iso": iso(r[0]), "temp_c": r[1], "hum_pct": r[2], "pres_hpa": r[3]} for r in rows]
+        sql, params, _ = series_sql(None, since_unix, until_unix, device, after_key)
+        rows, next_cursor = fetch_page(storage.connection("reader", DB_FILE), READING_COLUMNS,
+                                       sql, params, limit, lambda r: (r[1], r[0]))
+    rows = downsample(rows, max_points, 1, (2, 3, 4))
+    return [reading_dict(r) for r in rows], next_cursor
+
+def rollup_between(res, since_unix, until_unix=None, device=None, max_points=None, after_key=None, limit=None):
+    """Rollup buckets as dicts, ascending, and the cursor of the next page"""
+    sql, params, _ = series_sql(res, since_unix, until_unix, device, after_key)
+    rows, next_cursor = fetch_page(storage.connection("reader", DB_FILE), rollup.COLUMNS, sql, params,
+                                   limit, lambda r: (r[1], r[0]))
+    rows = downsample(rows, max_points, 1, (5, 8, 11))
+    # temp_c/hum_pct/pres_hpa carry the bucket average so the dashboard can plot them like raw rows
+    return [{"device_id": r[0], "ts": r[1], "iso": iso(r[1]), "n": r[2],
+             "temp_c": r[5], "temp_min": r[3], "temp_max": r[4],
+             "hum_pct": r[8], "hum_min": r[6], "hum_max": r[7],
+             "pres_hpa": r[11], "pres_min": r[9], "pres_max": r[10]} for r in rows], next_cursor
+
+# ---- format=columnar|binary: column-major series streamed straight from the cursor ----
+def series_sql(res, since_unix=None, until_unix=None, device=None, after_key=None):
+    """
+    FROM/WHERE/ORDER part of a series query and the output column -> SQL expression mapping,
+    for raw rows (res None) or rollup buckets of `res` seconds (values are the bucket averages).
+    Rows are ordered by (ts, device_id); `after_key` continues after that key (keyset pagination),
+    which the ts index serves as a range seek however deep the page is.
+    """
+    if res is None:
+        table, ts = "bme280_data", "device_ts"
+        values = {"temp_c": "temp_c", "hum_pct": "hum_pct", "pres_hpa": "pres_hpa"}
+    else:
+        table, ts = rollup.ROLLUPS[res], "bucket_ts"
+        values = {"temp_c": "temp_avg", "hum_pct": "hum_avg", "pres_hpa": "pres_avg"}
+        since_unix = None if since_unix is None else (int(since_unix) // res) * res
+
+    where, params = [], []
+    if device is not None:
+        where.append("device_id = ?")
+        params.append(device)
+    if since_unix is not None:
+        where.append(f"{ts} >= ?")
+        params.append(int(since_unix))
+    if until_unix is not None:
+        where.append(f"{ts} <= ?")
+        params.append(int(until_unix))
+    if after_key is not None:
+        where.append(f"{ts} >= ? AND ({ts}, device_id) > (?, ?)")
+        params += [after_key[0], *after_key]
+    where = ("WHERE " + " AND ".join(where)) if where else ""
+
+    if since_unix is None:  # the latest 300
+        sql = f"FROM (SELECT * FROM {table} {where} ORDER BY {ts} DESC, device_id DESC LIMIT 300) ORDER BY {ts} ASC, device_id ASC"
+    else:
+        sql = f"FROM {table} {where} ORDER BY {ts} ASC, device_id ASC"
+    return sql, params, {"device_id": "device_id", "ts": ts, **values}
+
+def column_chunks(conn, expr, sql, params):
+    """One column of the series, as lists of at most STREAM_CHUNK_ROWS values"""
+    cur = conn.execute(f"SELECT {expr} {sql}", params)
+    while True:
+        chunk = cur.fetchmany(STREAM_CHUNK_ROWS)
+        if not chunk:
+            return
+        yield [v for (v,) in chunk]
+
+def render_columnar(count, res, columns, next_cursor=None):
+    """{"ok", "count", "resolution", "next", "data": {name: [...], ...}} as a stream of text chunks"""
+    yield '{"ok":true,"count":%d,"resolution":%s,"next":%s,"data":{' % (count, json.dumps(res or "raw"), json.dumps(next_cursor))
+    for i, (name, chunks) in enumerate(columns):
+        yield ("," if i else "") + json.dumps(name) + ":["
+        sep = ""
+        for chunk in chunks:
+            yield sep + json.dumps(chunk)[1:-1]
+            sep = ","
+        yield "]"
+    yield "}}"
+
+def render_binary(count, columns):
+    """
+    16 byte header: magic "BME1", uint16 version, uint16 column count, uint32 row count, uint32 reserved;
+    then every column back to back, little-endian: ts as int64, the values as float32.
+    The ts column starts 8-byte aligned and the float columns 4-byte aligned, ready for typed arrays.
+    """
+    yield struct.pack("<4sHHII", BINARY_MAGIC, 1, len(columns), count, 0)
+    for name, chunks in columns:
+        code = "q" if name == "ts" else "f"
+        for chunk in chunks:
+            yield struct.pack(f"<{len(chunk)}{code}", *chunk)
+
+def series_response(fmt, res, since_unix, until_unix, device, max_points, after_key=None, limit=None):
+    sql, params, columns = series_sql(res, since_unix, until_unix, device, after_key)
+    if fmt == "binary":
+        del columns["device_id"]  # numeric columns only: ts, temp_c, hum_pct, pres_hpa
+    names, exprs = list(columns), list(columns.values())
+
+    next_cursor, rows = None, None
+    page = raw_page(since_unix, until_unix, device, after_key, limit) if res is None and since_unix is not None else None
+    if page is not None:
+        rows, next_cursor = page
+        # ring/archive rows are (device_id, ts, temp_c, hum_pct, pres_hpa), reorder to the requested columns
+        pos = {"device_id": 0, "ts": 1, "temp_c": 2, "hum_pct": 3, "pres_hpa": 4}
+        rows = [tuple(r[pos[name]] for name in names) for r in rows]
+    elif max_points:
+        # LTTB needs the whole window anyway; the result is at most max_points rows
+        rows = storage.connection("reader", DB_FILE).execute(f"SELECT {', '.join(exprs)} {sql}", params).fetchall()
+
+    conn = None
+    if rows is not None:
+        rows = downsample(rows, max_points, names.index("ts"), [names.index(c) for c in ("temp_c", "hum_pct", "pres_hpa")])
+        count = len(rows)
+        newest = rows[-1][names.index("ts")] if rows else 0
+        cols = list(zip(*rows)) if rows else [()] * len(names)
+        body = [(name, [list(col)]) for name, col in zip(names, cols)]
+    else:
+        # one read transaction: every column pass sees the same snapshot while the writer keeps committing
+        conn = storage.connection("reader", DB_FILE)
+        if conn.in_transaction:  # left open by a response that was built but never sent
+            conn.rollback()
+        conn.execute("BEGIN")
+        if limit is not None:
+            # key of the last row of this page, if a row follows it
+            last = conn.execute(f"SELECT {columns['ts']}, device_id {sql} LIMIT 2 OFFSET ?", params + [limit - 1]).fetchall()
+            if len(last) == 2:
+                next_cursor = encode_cursor(*last[0])
+            sql, params = sql + " LIMIT ?", params + [limit]
+        # readings behind the rows (SUM(n) for rollups) go into the ETag: a bucket changes in place
+        count, newest, readings = conn.execute(f"""SELECT COUNT(*), MAX(ts), SUM(w)
+                                                   FROM (SELECT {columns['ts']} AS ts, {"n" if res else "1"} AS w {sql})""",
+                                               params).fetchone()
+        body = [(name, column_chunks(conn, expr, sql, params)) for name, expr in columns.items()]
+
+    if fmt == "binary":
+        stream, mimetype = render_binary(count, body), "application/octet-stream"
+    else:
+        stream, mimetype = render_columnar(count, res, body, next_cursor), "application/json"
+    resp = Response(stream, mimetype=mimetype)
+    if conn is not None:
+        # ends the read transaction once the server is done with the response, also when the body
+        # is never iterated (304, HEAD); the connection stays with the thread
+        resp.call_on_close(conn.rollback)
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp, newest or 0, (count if conn is None else f"{count}.{readings or 0}")
+
+# ---- conditional GET, compression and response cache for /api/latest and /api/series ----
+class ResponseCache:
+    """
+    LRU of finished response bodies keyed by the normalized query. An entry is only valid for the
+    data version it was built at, so everything is invalidated as soon as the writer commits.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["version"] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if len(entry["body"]) > CACHE_MAX_ENTRY:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old["body"])
+            self.entries[key] = entry
+            self.size += len(entry["body"])
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["body"])
+
+response_cache = ResponseCache()
+_version_conn = None
+_version_lock = threading.Lock()
+
+def data_version():
+    """
+    Changes whenever app.py commits (PRAGMA data_version moves on every commit by another
+    connection) or publishes to the ring buffer, costs no table reads.
+    """
+    global _version_conn
+    with _version_lock:
+        if _version_conn is None:
+            # one connection for every thread: data_version is only comparable within a connection
+            _version_conn = storage.open_db(DB_FILE, "reader", check_same_thread=False)
+        version = _version_conn.execute("PRAGMA data_version").fetchone()[0]
+    return version, ring.head()
+
+def pick_encoding():
+    accepted = request.accept_encodings
+    if accepted["gzip"]:
+        return "gzip"
+    if accepted["deflate"]:
+        return "deflate"
+    return None
+
+def compress(body, encoding):
+    return gzip.compress(body, compresslevel=6) if encoding == "gzip" else zlib.compress(body, 6)
+
+def compress_stream(chunks, encoding):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    try:
+        for chunk in chunks:
+            out = z.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if out:
+                yield out
+        yield z.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def with_validators(resp, etag):
+    # no Last-Modified: a backfilled reading changes the data but not the newest device_ts of the window
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"  # always revalidate, a 304 costs a few bytes
+    resp.vary.add("Accept-Encoding")
+    return resp.make_conditional(request)
+
+def send_cached(key, build):
+    """
+    Answer from the cache for `key` or call `build()` -> (Response, newest device_ts, row count).
+    The ETag is derived from the query, the newest device_ts and the row count (plus a checksum
+    of the body when there is one, rollup buckets change in place), so unchanged data answers
+    If-None-Match with 304.
+    Streamed responses skip the cache and are compressed on the fly.
+    """
+    version = data_version()
+    entry = response_cache.get(key, version)
+    CACHE_LOOKUPS.labels("miss" if entry is None else "hit").inc()
+    if entry is None:
+        resp, newest, count = build()
+        if resp.status_code != 200:
+            return resp
+        etag = f"{zlib.crc32(repr(key).encode()):08x}-{newest}-{count}"
+        if resp.is_streamed:
+            encoding = pick_encoding()
+            if encoding:
+                resp.response = compress_stream(resp.response, encoding)
+                resp.headers["Content-Encoding"] = encoding
+            resp.automatically_set_content_length = False  # make_conditional would buffer the whole body for it
+            return with_validators(resp, etag)
+        body = resp.get_data()
+        entry = {"version": version, "body": body, "mimetype": resp.mimetype,
+                 "headers": {k: v for k, v in resp.headers.items() if k.startswith("X-")},
+                 "etag": f"{etag}-{zlib.crc32(body):08x}", "compressed": {}}
+        response_cache.put(key, entry)
+
+    body, encoding = entry["body"], None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = pick_encoding()
+        if encoding:
+            if encoding not in entry["compressed"]:
+                entry["compressed"][encoding] = compress(body, encoding)
+            body = entry["compressed"][encoding]
+    resp = Response(body, mimetype=entry["mimetype"], headers=entry["headers"])
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    return with_validators(resp, entry["etag"])
 
 @app.get("/api/latest")
 def api_latest():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""SELECT device_ts, temp_c, hum_pct, pres_hpa
-                   FROM bme280_data ORDER BY device_ts DESC LIMIT 1""")
+    # accept ?device=<device_id> to get the latest reading of one device instead of any device
+    device = request.args.get("device")
+    return send_cached(("latest", device), lambda: latest_response(device))
+
+def latest_response(device):
+    r = ring.latest(device)
+    if r:
+        return jsonify({"ok": True, "data": reading_dict(r)}), r[1], 1
+    cur = storage.connection("reader", DB_FILE).cursor()
+    if device is None:
+        cur.execute("""SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa
+                       FROM bme280_data ORDER BY device_ts DESC LIMIT 1""")
+    else:
+        cur.execute("""SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa
+                       FROM bme280_data WHERE device_id = ? ORDER BY device_ts DESC LIMIT 1""", (device,))
     r = cur.fetchone()
-    conn.close()
     if not r:
-        return jsonify({"ok": True, "data": None})
-    return jsonify({"ok": True, "data": {"ts": r[0], "iso": iso(r[0]), "temp_c": r[1], "hum_pct": r[2], "pres_hpa": r[3]}})
+        return jsonify({"ok": True, "data": None}), 0, 0
+    return jsonify({"ok": True, "data": reading_dict(r)}), r[1], 1
 
 @app.get("/api/series")
 def api_series():
-    # accept ?last=15m|1h|6h|24h|7d  OR  ?from=<unix>&to=<unix>
+    # accept ?last=15m|1h|6h|24h|7d  OR  ?from=<unix>&to=<unix>, optionally &device=<device_id>
+    # and &resolution=raw|60|900|3600 to override the automatic choice of rollup,
+    # &max_points=<n> reduces the result to n points (LTTB), e.g. the chart width in pixels,
+    # &format=rows (default, list of dicts) | columnar ({ts: [...], temp_c: [...]}) | binary (see render_binary)
+    # ?after=<ts> returns the raw rows newer than ts, to resume a live chart after a reconnect
+    # &limit=<n> returns at most n rows (from/to pages default to SERIES_MAX_LIMIT); when more follow, the
+    # response carries "next" (and the X-Next-Cursor header), pass it back as &cursor=<next> for the next page
+    after = request.args.get("after", type=int)
     last = request.args.get("last")
-    f = request.args.get("from")
-    t = request.args.get("to")
-    now = int(time.time())
-    since = None
+    f = request.args.get("from", type=int)
+    t = request.args.get("to", type=int)
+    device = request.args.get("device")
+    resolution = request.args.get("resolution")
+    max_points = request.args.get("max_points", type=int)
+    fmt = request.args.get("format", "rows")
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    now = int(time.time()) // SERIES_NOW_STEP * SERIES_NOW_STEP
+    since = until = None
 
     if last:
         mult = {"m":60, "h":3600, "d":86400}
         unit = last[-1].lower()
         num = int(last[:-1])
         since = now - num * mult[unit]
-    elif f and t:
-        since = int(f)
-        # we’ll filter client-side by `to`, but fetch a bit more is fine
+    elif f is not None and t is not None:
+        since, until = f, t
+        if limit is None and not max_points:
+            limit = SERIES_MAX_LIMIT
+    elif after is not None:
+        since = after + 1
+
+    res = None
+    if after is not None:
+        pass  # deltas are always raw rows
+    elif resolution and resolution != "raw":
+        res = int(resolution) if resolution.isdigit() else None
+        if res not in rollup.ROLLUPS:
+            return jsonify({"ok": False, "error": f"resolution must be raw or one of {sorted(rollup.ROLLUPS)}"}), 400
+    elif resolution is None and since is not None:
+        res = rollup.pick_resolution((until if until is not None else now) - since, SERIES_MIN_POINTS)
+
+    if fmt not in ("rows", "columnar", "binary"):
+        return jsonify({"ok": False, "error": "format must be rows, columnar or binary"}), 400
+    if since is None:
+        res = None
+
+    after_key = None
+    if limit is not None or cursor:
+        if since is None:
+            return jsonify({"ok": False, "error": "limit and cursor need last, from/to or after"}), 400
+        if max_points:
+            return jsonify({"ok": False, "error": "limit and cursor can't be combined with max_points"}), 400
+        if limit is not None and limit < 1:
+            return jsonify({"ok": False, "error": "limit must be positive"}), 400
+        limit = min(limit or SERIES_MAX_LIMIT, SERIES_MAX_LIMIT)
+        try:
+            after_key = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+
+    # everything the response depends on, as the cache key and ETag seed
+    key = ("series", fmt, device, res, since, until, max_points, after_key, limit)
+    if fmt in ("columnar", "binary"):
+        return send_cached(key, lambda: series_response(fmt, res, since, until, device, max_points, after_key, limit))
+    return send_cached(key, lambda: series_rows_response(res, since, until, device, max_points, after_key, limit))
+
+def series_rows_response(res, since, until, device, max_points, after_key=None, limit=None):
+    if res is not None:
+        data, next_cursor = rollup_between(res, since, until, device, max_points, after_key, limit)
+    else:
+        data, next_cursor = rows_between(since, until, device, max_points, after_key, limit)
+
+    newest = data[-1]["ts"] if data else 0
+    resp = jsonify({"ok": True, "count": len(data), "resolution": res or "raw", "next": next_cursor, "data": data})
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp, newest, len(data)
+
+# ---- live feed: one watcher thread for all /api/stream clients ----
+class LiveFeed:
+    """
+    Single watcher shared by every SSE client. It checks `PRAGMA data_version` (changes whenever
+    another connection commits) once per STREAM_POLL_S and only then queries the rows newer than
+    the last one seen per device, so the DB cost does not grow with the number of open dashboards.
+    """
+
+    def __init__(self, db_file=DB_FILE, poll_s=STREAM_POLL_S):
+        self.db_file = db_file
+        self.poll_s = poll_s
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.clients.add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="live-feed", daemon=True)
+                self.thread.start()
+        return q
 
-    data = rows_between(since)
-    if f and t:
-        to_int = int(t)
-        data = [d for d in data if d["ts"] <= to_int]
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.discard(q)
 
-    return jsonify({"ok": True, "count": len(data), "data": data})
+    def _publish(self, reading):
+        with self.lock:
+            clients = list(self.clients)
+        for q in clients:
+            try:
+                q.put_nowait(reading)
+            except queue.Full:
+                pass  # client stopped reading, it resumes with /api/series?after= when it reconnects
+
+    def _run(self):
+        conn = storage.connection("reader", self.db_file)
+        last = {}  # device_id -> newest device_ts already published
+        version = None
+        while True:
+            current = conn.execute("PRAGMA data_version").fetchone()[0]
+            if current != version:
+                version = current
+                for device_id in storage.device_ids(conn):
+                    if device_id not in last:
+                        # device seen for the first time: start from its latest reading, not its history
+                        rows = conn.execute("""SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM bme280_data
+                                               WHERE device_id = ? ORDER BY device_ts DESC LIMIT 1""", (device_id,)).fetchall()
+                    else:
+                        rows = conn.execute("""SELECT device_id, device_ts, temp_c, hum_pct, pres_hpa FROM bme280_data
+                                               WHERE device_id = ? AND device_ts > ? ORDER BY device_ts ASC LIMIT 1000""",
+                                            (device_id, last[device_id])).fetchall()
+                    for r in rows:
+                        last[device_id] = r[1]
+                        self._publish(reading_dict(r))
+            time.sleep(self.poll_s)
+
+live_feed = LiveFeed()
+
+@app.get("/api/stream")
+def api_stream():
+    # Server-Sent Events: one `reading` event per newly committed row, optionally ?device=<device_id>.
+    # The event id is the reading's ts; after a reconnect fetch /api/series?after=<id> to fill the gap.
+    device = request.args.get("device")
+    q = live_feed.subscribe()
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    reading = q.get(timeout=STREAM_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if device is None or reading["device_id"] == device:
+                    yield f"id: {reading['ts']}\nevent: reading\ndata: {json.dumps(reading)}\n\n"
+        finally:
+            live_feed.unsubscribe(q)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/")
 def index():
@@ -128,6 +657,9 @@ def index():
   </div>
 
 <script>
+// open the page as /?device=<device_id> to follow a single sensor
+const DEVICE = new URLSearchParams(location.search).get('device');
+const devQ = DEVICE ? 'device='+encodeURIComponent(DEVICE) : '';
 const fmt = n => (n===null||n===undefined) ? "—" : n.toFixed(2);
 const doughnut = (ctx,label,units,min,max) => new Chart(ctx,{type:'doughnut',
   data:{labels:[label],datasets:[{data:[0,1],borderWidth:0,cutout:'75%'}]},
@@ -170,22 +702,54 @@ function setGauge(g, val, min, max, labelElem, units){
   labelElem.textContent = fmt(val)+" "+units;
 }
 
-async function refreshGauges(){
-  const r = await fetch('/api/latest'); const js = await r.json();
-  const d = js.ok && js.data ? js.data : null;
+function showLatest(d){
   setGauge(gTemp, d?d.temp_c:null, -10, 40, document.getElementById('tLabel'), "°C");
   setGauge(gHum,  d?d.hum_pct:null,  0, 100, document.getElementById('hLabel'), "%");
   setGauge(gPres, d?(d.pres_hpa/100.0):null,  950, 1050, document.getElementById('pLabel'), "hPa");
   if(d) document.getElementById('updated').textContent = "Updated: "+d.iso;
 }
 
+async function refreshGauges(){
+  const r = await fetch('/api/latest?'+devQ); const js = await r.json();
+  showLatest(js.ok && js.data ? js.data : null);
+}
+
+// chart x values as unix seconds, to append live points and drop the ones leaving the window
+let chartTs = [];
+const WINDOW_S = {m:60, h:3600, d:86400};
+function windowSeconds(){
+  const last = document.getElementById('range').value;
+  return parseInt(last) * WINDOW_S[last.slice(-1)];
+}
+
+function appendPoint(d){
+  if(chartTs.length && d.ts <= chartTs[chartTs.length-1]) return;
+  chartTs.push(d.ts);
+  line.data.labels.push(d.iso);
+  line.data.datasets[0].data.push(d.temp_c);
+  line.data.datasets[1].data.push(d.hum_pct);
+  line.data.datasets[2].data.push(d.pres_hpa/100.0);
+  const cutoff = d.ts - windowSeconds();
+  while(chartTs.length && chartTs[0] < cutoff){
+    chartTs.shift(); line.data.labels.shift();
+    line.data.datasets.forEach(ds => ds.data.shift());
+  }
+}
+
 async function loadSeries(){
   const last = document.getElementById('range').value;
-  const r = await fetch('/api/series?last='+last); const js = await r.json();
-  const xs = js.data.map(p=>p.iso);
-  const ysT= js.data.map(p=>p.temp_c);
-  const ysH= js.data.map(p=>p.hum_pct);
-  const ysP= js.data.map(p=>p.pres_hpa/100.0);
+  // ask for no more points than the chart has pixels, the server keeps the peaks (LTTB)
+  const width = Math.round(document.getElementById('lineChart').clientWidth) || 1000;
+  const r = await fetch('/api/series?format=binary&last='+last+'&max_points='+width+'&'+devQ);
+  // binary layout (see render_binary): 16 byte header, int64 ts[n], float32 temp[n], hum[n], pres[n]
+  const buf = await r.arrayBuffer();
+  const n = new DataView(buf).getUint32(8, true);
+  const ts = new BigInt64Array(buf, 16, n);
+  chartTs = Array.from(ts, Number);
+  const xs = Array.from(ts, v => new Date(Number(v)*1000).toISOString().slice(0,19)+"Z");
+  const ysT= Array.from(new Float32Array(buf, 16+8*n, n));
+  const ysH= Array.from(new Float32Array(buf, 16+12*n, n));
+  const ysP= Array.from(new Float32Array(buf, 16+16*n, n), v=>v/100.0);
   line.data.labels = xs;
   line.data.datasets[0].data = ysT;
   line.data.datasets[1].data = ysH;
@@ -193,9 +757,24 @@ async function loadSeries(){
   line.update();
 }
 
+// live updates pushed by the server (SSE) instead of polling; after a dropped connection
+// the gap is filled from /api/series?after=<newest ts on the chart>
+const stream = new EventSource('/api/stream?'+devQ);
+let streamDropped = false;
+stream.addEventListener('reading', e => {
+  const d = JSON.parse(e.data);
+  showLatest(d); appendPoint(d); line.update('none');
+});
+stream.onerror = () => { streamDropped = true; };
+stream.onopen = async () => {
+  if(!streamDropped || !chartTs.length) return;
+  streamDropped = false;
+  const r = await fetch('/api/series?after='+chartTs[chartTs.length-1]+'&'+devQ); const js = await r.json();
+  js.data.forEach(appendPoint); line.update('none');
+};
+
 document.getElementById('range').addEventListener('change', loadSeries);
 refreshGauges(); loadSeries();
-setInterval(()=>{ refreshGauges(); }, 5000);
 </script>
 </body>
 </html>